@@ -5,4 +5,4 @@ def mapper(k, v):
     yield k, v
 
 if __name__ == '__main__':
-    hadoopy.run(mapper)
+    hadoopy.run(mapper, raw_values=True)
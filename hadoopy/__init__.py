@@ -23,8 +23,8 @@ from _hdfs import get, put, readtb, writetb, writetb_parts, ls, exists, rmr, ise
 from _job_cli import run
 from _reporter import status, counter
 from _test import Test
-from _hadoopy_typedbytes import TypedBytesFile
-import _hadoopy_typedbytes as _typedbytes
-import _hadoopy_main as _main
-from _hadoopy_main import GroupedValues
+from _native import typedbytes as _typedbytes, main as _main
+TypedBytesFile = _typedbytes.TypedBytesFile
+GroupedValues = _main.GroupedValues
+import typedbytes
 from _freeze import freeze_script
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# (C) Copyright 2010 Brandyn A. White
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Read-ahead and write-behind of file descriptors on helper threads
+
+os.read/os.write release the GIL, so the thread moves blocks through the pipe
+while the task decodes, runs user code, and encodes.  These are used as
+stream objects by cookiefile.h (read(size) -> str, write(str), close()).  A
+read error is raised by read once the blocks before it are consumed, a write
+error by the next write/flush, the owner also raises .error after closing.
+"""
+__author__ = 'Brandyn A. White <bwhite@cs.umd.edu>'
+__license__ = 'GPL V3'
+
+import os
+import threading
+import Queue
+
+
+class ReadAhead(object):
+
+    def __init__(self, fd, block_size=1048576, num_blocks=4):
+        """Read blocks from fd (which this now owns) ahead of the consumer
+
+        :param fd: File descriptor to read from, closed when done
+        :param block_size: Max size of each os.read (default 1048576)
+        :param num_blocks: Max number of blocks read ahead (default 4)
+        """
+        self.error = None
+        self._fd = fd
+        self._block_size = block_size
+        self._blocks = Queue.Queue(num_blocks)
+        self._block = ''
+        self._offset = 0
+        self._done = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, block):
+        """Queue a block unless closed (a closed reader may never take it)
+
+        :returns: True if the block was queued
+        """
+        while not self._closed:
+            try:
+                self._blocks.put(block, timeout=.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            while True:
+                block = os.read(self._fd, self._block_size)
+                if not self._put(block) or not block:
+                    break
+        except Exception, e:
+            self.error = e
+            self._put('')
+        finally:
+            # Closed here so that the fd can't be reused while in os.read
+            os.close(self._fd)
+
+    def read(self, size):
+        """
+        :param size: Max number of bytes
+        :returns: Up to size bytes, empty at the end of the stream
+        :raises: The error that stopped the thread (once the blocks before it are read)
+        """
+        if self._offset >= len(self._block):
+            if not self._done:
+                self._block = self._blocks.get()
+                self._offset = 0
+                self._done = not self._block
+            if self._done:
+                if self.error is not None:
+                    raise self.error
+                return ''
+        out = self._block[self._offset:self._offset + size]
+        self._offset += len(out)
+        return out
+
+    def close(self):
+        self._closed = True
+        # Unblock the thread if it is waiting on a full queue
+        try:
+            self._blocks.get_nowait()
+        except Queue.Empty:
+            pass
+
+
+class WriteBehind(object):
+
+    def __init__(self, fd, num_blocks=4):
+        """Write blocks to fd (which this now owns) behind the producer
+
+        :param fd: File descriptor to write to, closed by close
+        :param num_blocks: Max number of blocks waiting to be written (default 4)
+        """
+        self.error = None
+        self._fd = fd
+        self._blocks = Queue.Queue(num_blocks)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            block = self._blocks.get()
+            try:
+                if block is None:
+                    return
+                if self.error is None:
+                    self._write_all(block)
+            except Exception, e:
+                self.error = e  # Remaining blocks are dropped
+            finally:
+                self._blocks.task_done()
+
+    def _write_all(self, block):
+        num_written = 0
+        while num_written < len(block):
+            num_written += os.write(self._fd, buffer(block, num_written))
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, block):
+        self._check()
+        self._blocks.put(block)
+
+    def flush(self):
+        """Wait until all written blocks are in the fd"""
+        self._blocks.join()
+        self._check()
+
+    def close(self):
+        self._blocks.put(None)
+        self._thread.join()
+        os.close(self._fd)
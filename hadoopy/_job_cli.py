@@ -6,7 +6,7 @@ import json
 import subprocess
 import inspect
 import logging
-from _hadoopy_main import HadoopyTask
+import _native
 
 
 def run_freeze(tar_path, Z):
@@ -65,9 +65,11 @@ def change_dir():
             sys.stderr.write('HADOOPY: Failed to chdir to [%s]\n' % d)
 
 
-def run_task(mapper, reducer, combiner, command, read_fd=None, write_fd=None):
+def run_task(mapper, reducer, combiner, command, read_fd=None, write_fd=None, map_schema=None, reduce_schema=None,
+             raw_values=False, ordered_keys=False, batch_size=None, batch_dtypes=None, combine_buffer_size=None):
     change_dir()
-    return HadoopyTask(mapper, reducer, combiner, command, read_fd, write_fd).run()
+    return _native.main.HadoopyTask(mapper, reducer, combiner, command, read_fd, write_fd, map_schema, reduce_schema,
+                                    raw_values, ordered_keys, batch_size, batch_dtypes, combine_buffer_size).run()
 
 
 def disable_stdout_buffering():
@@ -79,7 +81,8 @@ def disable_stdout_buffering():
     return stdout_orig
 
 
-def run(mapper=None, reducer=None, combiner=None, script_path=None, jobconfs=(), **kw):
+def run(mapper=None, reducer=None, combiner=None, script_path=None, jobconfs=(), map_schema=None, reduce_schema=None,
+        raw_values=False, ordered_keys=False, batch_size=None, batch_dtypes=None, combine_buffer_size=None, **kw):
     """Hadoopy entrance function
 
     This is to be called in all Hadoopy job's.  Handles arguments passed in,
@@ -158,9 +161,47 @@ def run(mapper=None, reducer=None, combiner=None, script_path=None, jobconfs=(),
     | Expected return
     |     None or Iterator of (key, value)
 
+    | **Schemas**
+    | With TypedBytes, jobs whose records have a fixed shape can declare it as
+    | (key_spec, value_spec), e.g., map_schema=(str, (int, float, str)).  A
+    | specialized encoder/decoder is compiled for it (see TypedBytesFile), the
+    | output is still standard TypedBytes and non-matching values are encoded
+    | generically.  map_schema is used for the mapper output, combiner
+    | input/output, and reducer input; reduce_schema for the reducer output.
+
+    | **Batches**
+    | With batch_size=N, the mapper/reducer/combiner are called with up to N
+    | inputs at a time so that per-record work can be vectorized
+    |     mapper(keys, values) with keys[i], values[i] being an input KeyValue pair
+    |     reducer(keys, values) with values[i] being a list of the values of keys[i]
+    | The expected return is unchanged (None or Iterator of (key, value)).  With
+    | TypedBytes, batch_dtypes=(key_dtype, value_dtype) gives the mapper numpy
+    | arrays instead of lists (see hadoopy.TypedBytesFile.read_batch).
+
+    | **In-mapper combining**
+    | With combine_buffer_size=N, mapper output is grouped by key in memory
+    | and passed through the combiner (or the reducer if it has an attribute
+    | associative = True) whenever about N bytes are pending and after the
+    | mapper's close().  This is like running the combiner on each spill, so
+    | it must be safe to apply any number of times, but far fewer records are
+    | sent to Hadoop.
+
+    | **Task environment variables** (e.g., set with launch's cmdenvs)
+    |     hadoopy_flush_tb_writes: Flush TypedBytes output every N records, any value that isn't a positive int means every record (unset: only full 1MB buffers are written)
+    |     hadoopy_flush_tb_interval: Also flush TypedBytes output when this many seconds have passed since the last flush
+    |     hadoopy_background_io: Read ahead/write behind the task's pipes on helper threads
+    |     hadoopy_text_record_separator: Separator written after each Text output record (default \\n)
+
     :param mapper: Function or class following the above spec
     :param reducer: Function or class following the above spec
     :param combiner: Function or class following the above spec
+    :param map_schema: (key_spec, value_spec) of the mapper output or None (default)
+    :param reduce_schema: (key_spec, value_spec) of the reducer output or None (default)
+    :param raw_values: If True, TypedBytes input values are given as hadoopy.typedbytes.RawValue which are only decoded when their .value is used and are written verbatim when emitted.  Useful for identity/filter jobs that don't look at (or change) their values. (default False)
+    :param ordered_keys: If True, the mapper/combiner output keys use the order-preserving encoding (see hadoopy.typedbytes.dumps) so that Hadoop's raw byte sort orders keys of the same type as Python does (e.g., -1 < 2 < 10, floats and ints compare by value, str and unicode compare as text); mixed types are ordered None, numbers, lists, str/unicode, then tuples.  Keys are limited to None, numbers, str, unicode, and tuples/lists of them; requires TypedBytes. (default False)
+    :param batch_size: If not None, call the mapper/reducer/combiner with (keys, values) lists of up to this many inputs (see above) (default None)
+    :param batch_dtypes: If not None (and batch_size is set), the mapper is given (keys, values) numpy arrays of these (key_dtype, value_dtype), requires TypedBytes and numpy. (default None)
+    :param combine_buffer_size: If not None, approximate number of bytes of mapper output to combine in memory before it is written (see above) (default None)
     :param doc: If specified, on error print this and call sys.exit(1)
     """
     if script_path is None:
@@ -192,17 +233,29 @@ def run(mapper=None, reducer=None, combiner=None, script_path=None, jobconfs=(),
     parser_map = subparsers.add_parser('map', help='Internal: Run map task.')
     parser_map.add_argument('read_fd', type=int, help='Read file descriptor', nargs='?')
     parser_map.add_argument('write_fd', type=int, help='Write file descriptor', nargs='?')
-    parser_map.set_defaults(func=lambda **y: run_task(mapper, reducer, combiner, command='map', **y))
+    parser_map.set_defaults(func=lambda **y: run_task(mapper, reducer, combiner, command='map',
+                                                      map_schema=map_schema, reduce_schema=reduce_schema,
+                                                      raw_values=raw_values, ordered_keys=ordered_keys,
+                                                      batch_size=batch_size, batch_dtypes=batch_dtypes,
+                                                      combine_buffer_size=combine_buffer_size, **y))
 
     parser_combine = subparsers.add_parser('combine', help='Internal: Run combine task.')
     parser_combine.add_argument('read_fd', type=int, help='Read file descriptor', nargs='?')
     parser_combine.add_argument('write_fd', type=int, help='Write file descriptor', nargs='?')
-    parser_combine.set_defaults(func=lambda **y: run_task(mapper, reducer, combiner, command='combine', **y))
+    parser_combine.set_defaults(func=lambda **y: run_task(mapper, reducer, combiner, command='combine',
+                                                      map_schema=map_schema, reduce_schema=reduce_schema,
+                                                      raw_values=raw_values, ordered_keys=ordered_keys,
+                                                      batch_size=batch_size, batch_dtypes=batch_dtypes,
+                                                      combine_buffer_size=combine_buffer_size, **y))
 
     parser_reduce = subparsers.add_parser('reduce', help='Internal: Run reduce task.')
     parser_reduce.add_argument('read_fd', type=int, help='Read file descriptor', nargs='?')
     parser_reduce.add_argument('write_fd', type=int, help='Write file descriptor', nargs='?')
-    parser_reduce.set_defaults(func=lambda **y: run_task(mapper, reducer, combiner, command='reduce', **y))
+    parser_reduce.set_defaults(func=lambda **y: run_task(mapper, reducer, combiner, command='reduce',
+                                                      map_schema=map_schema, reduce_schema=reduce_schema,
+                                                      raw_values=raw_values, ordered_keys=ordered_keys,
+                                                      batch_size=batch_size, batch_dtypes=batch_dtypes,
+                                                      combine_buffer_size=combine_buffer_size, **y))
 
     args = vars(parser.parse_args())
     # Handle logging arguments
@@ -63,7 +63,12 @@ class LocalTask(object):
         env.update(cmdenvs)
         return env
 
-    def run_task(self, kvs, cmdenvs=(), poll=None):
+    def run_task(self, kvs, cmdenvs=(), poll=None, raw=False):
+        """Run the task on kvs
+
+        :param raw: If True, output keys and values are RawValues (written verbatim if passed to another task)
+        :returns: Iterator of the task's output (key, value)
+        """
         env = self._setup_env(cmdenvs)
         # Setup pipes
         task = 'pipe %s' % self.task if self.pipe else self.task
@@ -84,6 +89,7 @@ class LocalTask(object):
             a.close()
             b.close()
             with hadoopy.TypedBytesFile(read_fd=out_r_fd, unbuffered_reads=True) as tbfp_r:
+                read_kv = (lambda: tbfp_r.read_key_raw_value(raw_key=True)) if raw else tbfp_r.next
                 with hadoopy.TypedBytesFile(write_fd=in_w_fd, flush_writes=True) as tbfp_w:
                     for num, kv in enumerate(kvs):
                         if self.max_input is not None and self.max_input <= num:
@@ -93,7 +99,7 @@ class LocalTask(object):
                         while True:
                             r, w, _ = select.select([out_r_fd], [in_w_fd], [], timeout)
                             if r:  # If data is available to be read, than get it
-                                yield tbfp_r.next()
+                                yield read_kv()
                             elif w and not wrote:
                                 tbfp_w.write(kv)
                                 wrote = True
@@ -104,7 +110,7 @@ class LocalTask(object):
                 # Get any remaining values
                 while True:
                     try:
-                        yield tbfp_r.next()
+                        yield read_kv()
                     except EOFError:
                         break
         finally:
@@ -116,6 +122,18 @@ class LocalTask(object):
                 pass
 
 
+def _sort_raw_kv(kvs):
+    """Stable sort by the encoded keys, as Hadoop's shuffle compares them
+
+    :param kvs: Iterator of (key, value), keys are RawValues or Python values (encoded with dumps)
+    :returns: List of (key, value)
+    """
+    kvs = list(kvs)
+    raw_value = hadoopy.typedbytes.RawValue
+    kvs.sort(key=lambda kv: kv[0].raw if isinstance(kv[0], raw_value) else hadoopy.typedbytes.dumps(kv[0]))
+    return kvs
+
+
 def launch_local(in_name, out_name, script_path, poll=None, max_input=None,
                  files=(), cmdenvs=(), pipe=True, python_cmd='python', remove_tempdir=True,
                  identity_mapper=False, num_reducers=None,
@@ -174,12 +192,13 @@ def launch_local(in_name, out_name, script_path, poll=None, max_input=None,
             kvs = in_kvs
         else:
             kvs = list(LocalTask(script_path, 'map', files, max_input, pipe,
-                                 python_cmd, remove_tempdir).run_task(in_kvs, cmdenvs, poll))
+                                 python_cmd, remove_tempdir).run_task(in_kvs, cmdenvs, poll, raw=True))
+        # Sorted by the encoded keys (e.g., ordered_keys) like Hadoop, the values are passed through verbatim
         if 'combine' in script_info['tasks']:
-            kvs = hadoopy.Test.sort_kv(kvs)
+            kvs = _sort_raw_kv(kvs)
             kvs = list(LocalTask(script_path, 'combine', files, max_input, pipe,
-                                 python_cmd, remove_tempdir).run_task(kvs, cmdenvs))
-        kvs = hadoopy.Test.sort_kv(kvs)
+                                 python_cmd, remove_tempdir).run_task(kvs, cmdenvs, raw=True))
+        kvs = _sort_raw_kv(kvs)
         kvs = LocalTask(script_path, 'reduce', files, max_input, pipe,
                         python_cmd, remove_tempdir).run_task(kvs, cmdenvs)
     else:
@@ -21,26 +21,196 @@ import sys
 import os
 import hadoopy
 import hadoopy._runner
+import hadoopy._background_io
 
 
 cdef extern from "stdlib.h":
     void *malloc(size_t size)
+    void *realloc(void *ptr, size_t size)
     void free(void *ptr)
 
+cdef extern from "string.h":
+    void *memchr(void *s, int c, size_t n)
+    void *memmove(void *dest, void *src, size_t n)
+    void *memcpy(void *dest, void *src, size_t n)
 
-cdef extern from "getdelim.h":
-    ssize_t getdelim(char **lineptr, size_t *n, int delim, void *stream)
+cdef extern from "unistd.h":
+    ssize_t read(int fd, void *buf, size_t count) nogil
+    ssize_t write(int fd, void *buf, size_t count) nogil
 
-cdef extern from "stdio.h":
-    #ssize_t getdelim(char **lineptr, size_t *n, int delim, void *stream)
-    void *fdopen(int fd, char *mode)
-    int fflush(void *stream)
-    void *stdin
-    void *stdout
+cdef extern from "errno.h":
+    int errno
+    int EINTR
 
 
+cdef extern from "cookiefile.h":
+    int COOKIEFILE_SUPPORTED
+
 cdef extern from "Python.h":
     object PyString_FromStringAndSize(char *s, Py_ssize_t len)
+    object PyErr_SetFromErrno(object type)
+    int PyString_AsStringAndSize(object obj, char **buffer, Py_ssize_t *length) except -1
+
+
+cdef class _TextReader(object):
+    """Splits lines out of large blocks read from a file descriptor
+
+    One buffer is reused for every line (it only grows for lines longer than
+    it), keys/values are the only allocations.
+
+    :param fd: File descriptor to read
+    :param stream: If not None, read blocks with stream.read(size) instead (e.g., a ReadAhead) (default None)
+    :param block_size: Initial buffer size and max size of each read (default 1048576)
+    """
+    cdef int fd
+    cdef object stream
+    cdef char *buf
+    cdef size_t capacity
+    cdef size_t start  # Unread data is buf[start:end]
+    cdef size_t end
+    cdef size_t scanned  # buf[start:scanned] has no newline
+    cdef int eof
+
+    def __cinit__(self, int fd, stream=None, size_t block_size=1048576):
+        self.fd = fd
+        self.stream = stream
+        self.capacity = max(block_size, 1)
+        self.buf = <char *>malloc(self.capacity)
+        if self.buf == NULL:
+            raise MemoryError
+
+    def __dealloc__(self):
+        free(self.buf)
+
+    cdef int _fill(self) except -1:
+        """Read more data after end (compacting/growing buf), sets eof"""
+        cdef char *buf
+        cdef char *data
+        cdef ssize_t sz
+        cdef Py_ssize_t data_sz
+        if self.start:
+            memmove(self.buf, self.buf + self.start, self.end - self.start)
+            self.end -= self.start
+            self.scanned -= self.start
+            self.start = 0
+        if self.end == self.capacity:
+            buf = <char *>realloc(self.buf, self.capacity * 2)
+            if buf == NULL:
+                raise MemoryError
+            self.buf, self.capacity = buf, self.capacity * 2
+        if self.stream is not None:
+            block = self.stream.read(self.capacity - self.end)
+            PyString_AsStringAndSize(block, &data, &data_sz)
+            memmove(self.buf + self.end, data, data_sz)
+            sz = data_sz
+        else:
+            while True:
+                with nogil:
+                    sz = read(self.fd, self.buf + self.end, self.capacity - self.end)
+                if sz >= 0:
+                    break
+                if errno != EINTR:
+                    PyErr_SetFromErrno(OSError)
+        if sz == 0:
+            self.eof = 1
+        self.end += sz
+
+    cdef int next_line(self, char **line, size_t *line_sz) except -1:
+        """Find the next line (without its newline, a final line may lack one)
+
+        The line is valid until the next call.
+
+        Returns:
+            Number of bytes consumed (including the newline), 0 at the end
+        """
+        cdef char *newline
+        cdef size_t consumed
+        while True:
+            newline = <char *>memchr(self.buf + self.scanned, 10, self.end - self.scanned)  # 10 == ord('\n')
+            if newline != NULL:
+                line_sz[0] = newline - (self.buf + self.start)
+                consumed = line_sz[0] + 1
+                break
+            self.scanned = self.end
+            if self.eof:
+                line_sz[0] = consumed = self.end - self.start
+                break
+            self._fill()
+        line[0] = self.buf + self.start
+        self.start += consumed
+        self.scanned = self.start
+        return consumed
+
+
+cdef class _TextWriter(object):
+    """Formats KeyValue pairs as text lines into a large buffer written with few syscalls
+
+    Keys/values that aren't str are converted with str (unicode is UTF-8).
+
+    :param fd: File descriptor to write (not closed)
+    :param field_separator: Written between the key and value (default '\t')
+    :param record_separator: Written after the value (default '\n')
+    :param buffer_size: Buffered bytes before they are written (default 1048576)
+    """
+    cdef int fd
+    cdef bytes field_separator
+    cdef bytes record_separator
+    cdef char *buf
+    cdef size_t capacity
+    cdef size_t size
+
+    def __cinit__(self, int fd, field_separator='\t', record_separator='\n', size_t buffer_size=1048576):
+        self.fd = fd
+        self.field_separator = field_separator
+        self.record_separator = record_separator
+        self.capacity = max(buffer_size, 1)
+        self.buf = <char *>malloc(self.capacity)
+        if self.buf == NULL:
+            raise MemoryError
+
+    def __dealloc__(self):
+        free(self.buf)
+
+    cdef int _write(self, char *data, size_t sz) except -1:
+        cdef ssize_t num_written
+        while sz:
+            with nogil:
+                num_written = write(self.fd, data, sz)
+            if num_written < 0:
+                if errno != EINTR:
+                    PyErr_SetFromErrno(OSError)
+                continue
+            data += num_written
+            sz -= num_written
+
+    cdef int _append(self, val) except -1:
+        cdef char *data
+        cdef Py_ssize_t sz
+        if type(val) is not str:
+            val = val.encode('utf-8') if isinstance(val, unicode) else str(val)
+        PyString_AsStringAndSize(val, &data, &sz)
+        if self.size + sz > self.capacity:
+            self.flush()
+            if <size_t>sz > self.capacity:
+                return self._write(data, sz)
+        memcpy(self.buf + self.size, data, sz)
+        self.size += sz
+
+    cpdef writes(self, kvs):
+        """
+        Args:
+            kvs: Iterator of (key, value)
+        """
+        for k, v in kvs:
+            self._append(k)
+            self._append(self.field_separator)
+            self._append(v)
+            self._append(self.record_separator)
+
+    cpdef flush(self):
+        cdef size_t sz = self.size
+        self.size = 0
+        self._write(self.buf, sz)
 
 
 cdef class KeyValueStream(object):
@@ -154,23 +324,104 @@ cdef class GroupedKeyValues(object):
         return k, self._prev
 
 
+cdef class _CombineBuffer(object):
+    """Aggregates KeyValue pairs by key in memory (in-mapper combining)
+
+    Keys are grouped by their TypedBytes encoding, as Hadoop groups them.
+    When the approximate size of the pending pairs reaches max_size (and on
+    flush), the groups are passed to flush_func as an iterator of
+    (key, values) and the buffer is emptied.
+    """
+    cdef dict groups  # Encoded key -> (key, values)
+    cdef object flush_func
+    cdef object ordered_keys
+    cdef size_t size
+    cdef size_t max_size
+
+    def __cinit__(self, flush_func, size_t max_size, ordered_keys=False):
+        self.groups = {}
+        self.flush_func = flush_func
+        self.ordered_keys = bool(ordered_keys)
+        self.size = 0
+        self.max_size = max_size
+
+    cpdef writes(self, kvs):
+        dumps = hadoopy.typedbytes.dumps
+        getsizeof = sys.getsizeof
+        for k, v in kvs:
+            key = dumps(k, self.ordered_keys)
+            try:
+                values = self.groups[key][1]
+            except KeyError:
+                values = []
+                self.groups[key] = k, values
+                # Encoded key, key, and the group's tuple/list/dict entry
+                self.size += len(key) + getsizeof(k) + 200
+            values.append(v)
+            self.size += getsizeof(v) + sizeof(void *)
+            if self.size >= self.max_size:
+                self.flush()
+
+    cpdef flush(self):
+        groups = self.groups
+        self.groups = {}
+        self.size = 0
+        if groups:
+            self.flush_func(groups.itervalues())
+
+
+def _batches(in_iter, size_t batch_size, grouped=False):
+    """Chunk task input for batch mode
+
+    Args:
+        in_iter: Iterator of (key, value) or, if grouped, (key, values)
+        batch_size: Max number of KeyValue pairs (groups if grouped) per batch
+        grouped: If True, each group's values are read into a list
+
+    Returns:
+        Iterator of (keys, values) lists
+    """
+    cdef list keys = []
+    cdef list values = []
+    for k, v in in_iter:
+        keys.append(k)
+        values.append(list(v) if grouped else v)
+        if <size_t>len(keys) >= batch_size:
+            yield keys, values
+            keys, values = [], []
+    if keys:
+        yield keys, values
+
+
 cdef class HadoopyTask(object):
     cdef object mapper
     cdef object reducer
     cdef object combiner
     cdef object task_type
-    cdef int line_count
+    cdef long long line_count
     cdef int read_fd
     cdef int write_fd
-    cdef void* read_fp
+    cdef _TextReader text_reader
+    cdef _TextWriter text_writer
     cdef object tb
-
-    def __init__(self, mapper, reducer, combiner, task_type, read_fd=None, write_fd=None):
+    cdef int raw_values
+    cdef object batch_size
+    cdef object batch_dtypes
+    cdef object map_combiner
+    cdef _CombineBuffer combine_buffer
+
+    def __init__(self, mapper, reducer, combiner, task_type, read_fd=None, write_fd=None, map_schema=None, reduce_schema=None,
+                 raw_values=False, ordered_keys=False, batch_size=None, batch_dtypes=None, combine_buffer_size=None):
         self.mapper = mapper
         self.reducer = reducer
         self.combiner = combiner
         self.task_type = task_type
         self.line_count = 0
+        self.raw_values = int(raw_values)
+        self.batch_size = None if batch_size is None else int(batch_size)
+        if self.batch_size is not None and self.batch_size < 1:
+            raise ValueError('batch_size must be positive')
+        self.batch_dtypes = batch_dtypes
         if read_fd is None:
             self.read_fd = sys.stdin.fileno()
         else:
@@ -179,24 +430,79 @@ cdef class HadoopyTask(object):
             self.write_fd = sys.stdout.fileno()
         else:
             self.write_fd = int(write_fd)
-        self.read_fp = fdopen(self.read_fd, 'r')
-        self.tb = hadoopy.TypedBytesFile(read_fd=self.read_fd, write_fd=self.write_fd, flush_writes=self.flush_tb_writes())
+        # Only the input type in use gets read ahead, text or TypedBytes (which needs cookiefile.h)
+        background_io = self.background_io()
+        if not self.is_io_typedbytes():
+            self.text_reader = _TextReader(self.read_fd, hadoopy._background_io.ReadAhead(self.read_fd)
+                                           if background_io else None)
+        hadoopy.typedbytes.set_java_compatible(self.java_compatible_tb())
+        hadoopy.typedbytes.set_compact_ints(self.compact_ints_tb())
+        if not self.is_io_typedbytes():
+            self.text_writer = _TextWriter(self.write_fd, *self.text_separators())
+        # Mapper output (combiner input/output, reducer input) uses map_schema
+        read_schema = None if task_type == 'map' else map_schema
+        write_schema = reduce_schema if task_type == 'reduce' else map_schema
+        # Likewise ordered_keys applies to the mapper output keys
+        ordered_keys = bool(ordered_keys)
+        # Text is only read by text_reader and written by text_writer
+        if self.is_io_typedbytes():
+            self.tb = hadoopy.TypedBytesFile(read_fd=self.read_fd, write_fd=self.write_fd, flush_writes=self.flush_tb_writes(),
+                                             flush_interval=self.flush_tb_interval(), read_schema=read_schema,
+                                             write_schema=write_schema, background_io=background_io and COOKIEFILE_SUPPORTED,
+                                             read_ordered_keys=ordered_keys and task_type != 'map',
+                                             write_ordered_keys=ordered_keys and task_type != 'reduce')
+        # In-mapper combining uses the combiner or, if it is marked associative, the reducer
+        if combine_buffer_size is not None and task_type == 'map':
+            self.map_combiner = combiner if combiner is not None else reducer if getattr(reducer, 'associative', False) else None
+            if self.map_combiner is None:
+                raise ValueError('combine_buffer_size requires a combiner or a reducer with associative = True')
+            self.combine_buffer = _CombineBuffer(self.combine_groups, combine_buffer_size, ordered_keys)
 
     # Core methods
     def run(self):
-        if self.task_type == 'map':
-            return self.process_inout(self.mapper, self.read_in_map(), self.print_out, 'map')
-        elif self.task_type == 'reduce':
-            return self.process_inout(self.reducer, self.read_in_reduce(), self.print_out, 'reduce')
-        elif self.task_type == 'combine':
-            return self.process_inout(self.combiner, self.read_in_reduce(), self.print_out, 'reduce')
-        else:
-            return 1
+        # The output is flushed here (the write-behind thread doesn't outlive the interpreter), write_fd is left open
+        try:
+            if self.task_type == 'map':
+                out_func = self.print_out if self.combine_buffer is None else self.combine_buffer.writes
+                # Arrays are decoded in batches by the TypedBytesFile
+                if self.batch_size is not None and self.batch_dtypes is not None and self.is_io_typedbytes():
+                    ret = self.process_inout(self.mapper, self.read_in_map_arrays(), out_func, 'map')
+                else:
+                    ret = self.process_inout(self.mapper, self.read_in_map(), out_func, 'map', self.batch_size)
+                if self.combine_buffer is not None:
+                    self.combine_buffer.flush()
+                return ret
+            elif self.task_type == 'reduce':
+                return self.process_inout(self.reducer, self.read_in_reduce(), self.print_out, 'reduce', self.batch_size)
+            elif self.task_type == 'combine':
+                return self.process_inout(self.combiner, self.read_in_reduce(), self.print_out, 'reduce', self.batch_size)
+            else:
+                return 1
+        finally:
+            if self.text_writer is not None:
+                self.text_writer.flush()
+            else:
+                self.tb.flush()
 
     @classmethod
-    def process_inout(cls, work_func, in_iter, out_func, attr):
+    def process_inout(cls, work_func, in_iter, out_func, attr, batch_size=None):
+        """Call work_func on each input and output what it returns
+
+        Args:
+            work_func: Function or class (see hadoopy.run)
+            in_iter: Iterator of (key, value) or (key, values) if grouped
+            out_func: Function called with each iterator of (key, value)
+            attr: Method of work_func to use if it has one ('map' or 'reduce')
+            batch_size: If not None, work_func is called with (keys, values)
+                lists of up to batch_size inputs instead (see _batches)
+
+        Returns:
+            0 on success, 1 if work_func is None
+        """
         if work_func == None:
             return 1
+        if batch_size is not None:
+            in_iter = _batches(in_iter, batch_size, attr == 'reduce')
         if isinstance(work_func, type):
             work_func = work_func()
         try:
@@ -220,10 +526,13 @@ cdef class HadoopyTask(object):
                 out_func(work_iter)
         return 0
 
+    def combine_groups(self, groups):
+        """Run the combiner on (key, values) groups from the combine_buffer"""
+        self.process_inout(self.map_combiner, groups, self.print_out, 'reduce', self.batch_size)
+
     # Output methods
     def print_out_text(self, iter):
-        for k, v in iter:
-            os.write(self.write_fd, '%s\t%s\n' % (k, v))
+        self.text_writer.writes(iter)
 
     def print_out_tb(self, iter):
         self.tb.writes(iter)
@@ -238,34 +547,37 @@ cdef class HadoopyTask(object):
 
     # Input methods
     cpdef read_key_value_text(self):
-        cdef ssize_t sz
-        cdef char *lineptr = NULL
-        cdef size_t n = 0
-        sz = getdelim(&lineptr, &n, 9, self.read_fp)  # 9 == ord('\t')
-        if sz == -1:
-            raise StopIteration
-        k = PyString_FromStringAndSize(lineptr, sz - 1)
-        free(lineptr)
-        lineptr = NULL
-        sz = getdelim(&lineptr, &n, 10, self.read_fp)  # 10 == ord('\n')
-        if sz == -1:
+        """Key is the line up to the first tab, value is the rest (empty if there is no tab)"""
+        cdef char *line
+        cdef char *tab
+        cdef size_t sz
+        if not self.text_reader.next_line(&line, &sz):
             raise StopIteration
-        v = PyString_FromStringAndSize(lineptr, sz - 1)
-        free(lineptr)
-        return k, v
+        tab = <char *>memchr(line, 9, sz)  # 9 == ord('\t')
+        if tab == NULL:
+            return PyString_FromStringAndSize(line, sz), ''
+        return (PyString_FromStringAndSize(line, tab - line),
+                PyString_FromStringAndSize(tab + 1, sz - (tab - line) - 1))
 
     cpdef read_offset_value_text(self):
-        cdef ssize_t sz
-        cdef char *lineptr = NULL
-        cdef size_t n = 0
-        sz = getdelim(&lineptr, &n, 10, self.read_fp)  # 10 == ord('\n')
-        if sz == -1:
+        cdef char *line
+        cdef size_t sz, consumed
+        consumed = self.text_reader.next_line(&line, &sz)
+        if not consumed:
             raise StopIteration
-        line = PyString_FromStringAndSize(lineptr, sz - 1)
-        free(lineptr)
         out_count = self.line_count
-        self.line_count += sz
-        return out_count, line
+        self.line_count += consumed
+        return out_count, PyString_FromStringAndSize(line, sz)
+
+    def read_key_value_tb(self):
+        """
+        Returns:
+            Function that returns the next TypedBytes KeyValue pair, values
+            are hadoopy.typedbytes.RawValue if raw_values is set.
+        """
+        if self.raw_values:
+            return self.tb.read_key_raw_value
+        return self.tb.__next__
 
     def read_in_map(self):
         """Provides the input iterator to use
@@ -278,18 +590,32 @@ cdef class HadoopyTask(object):
             Iterator that can be called to get KeyValue pairs.
         """
         if self.is_io_typedbytes():
-            return KeyValueStream(self.tb.__next__)
+            return KeyValueStream(self.read_key_value_tb())
         if self.is_on_hadoop():
             return KeyValueStream(self.read_key_value_text)
         return KeyValueStream(self.read_offset_value_text)
 
+    def read_in_map_arrays(self):
+        """
+        Returns:
+            Iterator of (keys, values) numpy arrays of up to batch_size
+            TypedBytes KeyValue pairs, with batch_dtypes (see
+            TypedBytesFile.read_batch).
+        """
+        while True:
+            keys, values = self.tb.read_batch(self.batch_size, *self.batch_dtypes)
+            if not len(keys):
+                return
+            yield keys, values
+
     def read_in_reduce(self):
         """
         Returns:
             Iterator that can be called to get grouped KeyValues.
         """
         if self.is_io_typedbytes():
-            return GroupedKeyValues(KeyValueStream(self.tb.__next__))
+            # Grouped by encoded key, each key is decoded once
+            return self.tb.iter_groups(self.raw_values)
         return GroupedKeyValues(KeyValueStream(self.read_key_value_text))
 
     # Environment info methods
@@ -304,4 +630,42 @@ cdef class HadoopyTask(object):
         return 'mapred_input_format_class' in os.environ
 
     def flush_tb_writes(self):
-        return 'hadoopy_flush_tb_writes' in os.environ
+        """
+        Returns:
+            Flush after this many records, 0 (only when the buffer is full)
+            if hadoopy_flush_tb_writes isn't set.  As before it was a count,
+            any other value (e.g., '', '0', 'true') means 1.
+        """
+        try:
+            return max(int(os.environ['hadoopy_flush_tb_writes']), 1)
+        except KeyError:
+            return 0
+        except ValueError:
+            return 1
+
+    def background_io(self):
+        return 'hadoopy_background_io' in os.environ
+
+    def flush_tb_interval(self):
+        try:
+            return float(os.environ['hadoopy_flush_tb_interval'])
+        except KeyError:
+            return None
+
+    def text_separators(self):
+        """
+        Returns:
+            (field_separator, record_separator) of text output, the field
+            separator is the one Hadoop splits this task's output with
+            (stream.{map,reduce}.output.field.separator, default '\t') and
+            records end with hadoopy_text_record_separator (default '\n').
+        """
+        task_type = 'reduce' if self.task_type == 'reduce' else 'map'
+        return (os.environ.get('stream_%s_output_field_separator' % task_type, '\t'),
+                os.environ.get('hadoopy_text_record_separator', '\n'))
+
+    def java_compatible_tb(self):
+        return 'hadoopy_java_compatible_tb' in os.environ
+
+    def compact_ints_tb(self):
+        return 'hadoopy_compact_ints_tb' in os.environ
@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+# (C) Copyright 2010 Brandyn A. White
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Pure-Python task runtime, see _main.pyx (selected by _native.py)"""
+
+__author__ = 'Brandyn A. White <bwhite@cs.umd.edu>'
+__license__ = 'GPL V3'
+
+import sys
+import os
+import hadoopy
+
+
+class _TextWriter(object):
+    """Formats KeyValue pairs as text lines into a large buffer written with few syscalls (see _main.pyx)"""
+
+    def __init__(self, fd, field_separator='\t', record_separator='\n', buffer_size=1048576):
+        self._fd = fd
+        self._field_separator = field_separator
+        self._record_separator = record_separator
+        self._buffer_size = buffer_size
+        self._out = []
+        self._size = 0
+
+    def writes(self, kvs):
+        out, field_separator, record_separator = self._out, self._field_separator, self._record_separator
+        for k, v in kvs:
+            if type(k) is not str:
+                k = k.encode('utf-8') if isinstance(k, unicode) else str(k)
+            if type(v) is not str:
+                v = v.encode('utf-8') if isinstance(v, unicode) else str(v)
+            out.append(k)
+            out.append(field_separator)
+            out.append(v)
+            out.append(record_separator)
+            self._size += len(k) + len(v) + len(field_separator) + len(record_separator)
+            if self._size >= self._buffer_size:
+                self.flush()
+                out = self._out
+
+    def flush(self):
+        data = ''.join(self._out)
+        self._out = []
+        self._size = 0
+        num_written = 0
+        while num_written < len(data):
+            num_written += os.write(self._fd, buffer(data, num_written))
+
+
+class KeyValueStream(object):
+    """Represents KeyValue input streams as iterators
+
+    Supports putting back one item
+    """
+
+    def __init__(self, key_value_func):
+        """
+        Args:
+            key_value_func: Function that returns a KeyValue tuple.  Raises
+                StopIteration when it is exhausted.
+        """
+        self._key_value_func = key_value_func
+        self._prev = None
+        self._done = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Get next KeyValue tuple
+
+        If a value was replaced using 'put', then it is used and cleared.
+
+        Returns:
+            (key, value)
+
+        Raises:
+            StopIteration: When key_value_func is exhausted.
+        """
+        if self._prev:
+            prev = self._prev
+            self._prev = None
+            return prev
+        if self._done:
+            raise StopIteration
+        try:
+            return self._key_value_func()
+        except StopIteration:
+            self._done = True
+            raise
+
+    def put(self, kv):
+        """Place an item back into the stream, return following call to 'next'
+
+        Args:
+            kv: Previous KeyValue tuple to place back
+        """
+        self._prev = kv
+
+
+class GroupedValues(object):
+
+    def __init__(self, group_key, key_value_iter):
+        self._key_value_iter = key_value_iter
+        self._group_key = group_key
+        self._done = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._done:
+            raise StopIteration
+        try:
+            k, v = self._key_value_iter.next()
+        except StopIteration:
+            self._done = True
+            raise
+        # If we get to the end, put the value back
+        if k != self._group_key:
+            self._done = True
+            self._key_value_iter.put((k, v))
+            raise StopIteration
+        return v
+
+
+class GroupedKeyValues(object):
+
+    def __init__(self, key_value_iter):
+        self._key_value_iter = key_value_iter
+        self._prev = None
+        self._done = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._done:
+            raise StopIteration
+        # Exhaust prev
+        if self._prev:
+            for x in self._prev:
+                pass
+        try:
+            k, v = self._key_value_iter.next()
+        except StopIteration:
+            self._done = True
+            raise
+        self._key_value_iter.put((k, v))
+        self._prev = GroupedValues(k, self._key_value_iter)
+        return k, self._prev
+
+
+class _CombineBuffer(object):
+    """Aggregates KeyValue pairs by key in memory (in-mapper combining, see _main.pyx)"""
+
+    def __init__(self, flush_func, max_size, ordered_keys=False):
+        self._groups = {}
+        self._flush_func = flush_func
+        self._ordered_keys = bool(ordered_keys)
+        self._size = 0
+        self._max_size = max_size
+
+    def writes(self, kvs):
+        dumps, getsizeof = hadoopy.typedbytes.dumps, sys.getsizeof
+        for k, v in kvs:
+            key = dumps(k, self._ordered_keys)
+            try:
+                values = self._groups[key][1]
+            except KeyError:
+                values = []
+                self._groups[key] = k, values
+                self._size += len(key) + getsizeof(k) + 200
+            values.append(v)
+            self._size += getsizeof(v) + 8
+            if self._size >= self._max_size:
+                self.flush()
+
+    def flush(self):
+        groups = self._groups
+        self._groups = {}
+        self._size = 0
+        if groups:
+            self._flush_func(groups.itervalues())
+
+
+def _batches(in_iter, batch_size, grouped=False):
+    """Chunk task input for batch mode (see _main.pyx)"""
+    keys, values = [], []
+    for k, v in in_iter:
+        keys.append(k)
+        values.append(list(v) if grouped else v)
+        if len(keys) >= batch_size:
+            yield keys, values
+            keys, values = [], []
+    if keys:
+        yield keys, values
+
+
+class HadoopyTask(object):
+    """See _main.pyx, text input is read with readline (background_io only applies to TypedBytes)"""
+
+    def __init__(self, mapper, reducer, combiner, task_type, read_fd=None, write_fd=None, map_schema=None, reduce_schema=None,
+                 raw_values=False, ordered_keys=False, batch_size=None, batch_dtypes=None, combine_buffer_size=None):
+        self.mapper = mapper
+        self.reducer = reducer
+        self.combiner = combiner
+        self.task_type = task_type
+        self.line_count = 0
+        self.raw_values = bool(raw_values)
+        self.batch_size = None if batch_size is None else int(batch_size)
+        if self.batch_size is not None and self.batch_size < 1:
+            raise ValueError('batch_size must be positive')
+        self.batch_dtypes = batch_dtypes
+        self.read_fd = sys.stdin.fileno() if read_fd is None else int(read_fd)
+        self.write_fd = sys.stdout.fileno() if write_fd is None else int(write_fd)
+        # A dup so read_fd stays open
+        self.read_fp = os.fdopen(os.dup(self.read_fd), 'rb', 1048576) if not self.is_io_typedbytes() else None
+        hadoopy.typedbytes.set_java_compatible(self.java_compatible_tb())
+        hadoopy.typedbytes.set_compact_ints(self.compact_ints_tb())
+        self.text_writer = _TextWriter(self.write_fd, *self.text_separators()) if not self.is_io_typedbytes() else None
+        # Mapper output (combiner input/output, reducer input) uses map_schema
+        read_schema = None if task_type == 'map' else map_schema
+        write_schema = reduce_schema if task_type == 'reduce' else map_schema
+        # Likewise ordered_keys applies to the mapper output keys
+        ordered_keys = bool(ordered_keys)
+        self.tb = None
+        if self.is_io_typedbytes():
+            # Dups as self.tb closes its fds when collected (the C version leaves them open)
+            self.tb = hadoopy.TypedBytesFile(read_fd=os.dup(self.read_fd), write_fd=os.dup(self.write_fd),
+                                             flush_writes=self.flush_tb_writes(),
+                                             flush_interval=self.flush_tb_interval(), read_schema=read_schema,
+                                             write_schema=write_schema, background_io=self.background_io(),
+                                             read_ordered_keys=ordered_keys and task_type != 'map',
+                                             write_ordered_keys=ordered_keys and task_type != 'reduce')
+        self.map_combiner = self.combine_buffer = None
+        if combine_buffer_size is not None and task_type == 'map':
+            self.map_combiner = combiner if combiner is not None else reducer if getattr(reducer, 'associative', False) else None
+            if self.map_combiner is None:
+                raise ValueError('combine_buffer_size requires a combiner or a reducer with associative = True')
+            self.combine_buffer = _CombineBuffer(self.combine_groups, combine_buffer_size, ordered_keys)
+
+    # Core methods
+    def run(self):
+        # The output is flushed here (the write-behind thread doesn't outlive the interpreter), write_fd is left open
+        try:
+            if self.task_type == 'map':
+                out_func = self.print_out if self.combine_buffer is None else self.combine_buffer.writes
+                if self.batch_size is not None and self.batch_dtypes is not None and self.is_io_typedbytes():
+                    ret = self.process_inout(self.mapper, self.read_in_map_arrays(), out_func, 'map')
+                else:
+                    ret = self.process_inout(self.mapper, self.read_in_map(), out_func, 'map', self.batch_size)
+                if self.combine_buffer is not None:
+                    self.combine_buffer.flush()
+                return ret
+            elif self.task_type == 'reduce':
+                return self.process_inout(self.reducer, self.read_in_reduce(), self.print_out, 'reduce', self.batch_size)
+            elif self.task_type == 'combine':
+                return self.process_inout(self.combiner, self.read_in_reduce(), self.print_out, 'reduce', self.batch_size)
+            else:
+                return 1
+        finally:
+            if self.text_writer is not None:
+                self.text_writer.flush()
+            else:
+                self.tb.flush()
+
+    @classmethod
+    def process_inout(cls, work_func, in_iter, out_func, attr, batch_size=None):
+        if work_func == None:
+            return 1
+        if batch_size is not None:
+            in_iter = _batches(in_iter, batch_size, attr == 'reduce')
+        if isinstance(work_func, type):
+            work_func = work_func()
+        try:
+            work_func.configure()
+        except AttributeError:
+            pass
+        try:
+            call_work_func = getattr(work_func, attr)
+        except AttributeError:
+            call_work_func = work_func
+        for x in in_iter:
+            work_iter = call_work_func(*x)
+            if work_iter != None:
+                out_func(work_iter)
+        try:
+            work_iter = work_func.close()
+        except AttributeError:
+            pass
+        else:
+            if work_iter != None:
+                out_func(work_iter)
+        return 0
+
+    def combine_groups(self, groups):
+        self.process_inout(self.map_combiner, groups, self.print_out, 'reduce', self.batch_size)
+
+    # Output methods
+    def print_out_text(self, iter):
+        self.text_writer.writes(iter)
+
+    def print_out_tb(self, iter):
+        self.tb.writes(iter)
+
+    def print_out(self, iter):
+        """Given an iterator, output the paired values
+
+        Args:
+            iter: Iterator of (key, value)
+        """
+        self.print_out_tb(iter) if self.is_io_typedbytes() else self.print_out_text(iter)
+
+    # Input methods
+    def read_key_value_text(self):
+        line = self.read_fp.readline()
+        if not line:
+            raise StopIteration
+        if line[-1] == '\n':
+            line = line[:-1]
+        k, _, v = line.partition('\t')
+        return k, v
+
+    def read_offset_value_text(self):
+        line = self.read_fp.readline()
+        if not line:
+            raise StopIteration
+        out_count = self.line_count
+        self.line_count += len(line)
+        return out_count, line[:-1] if line[-1] == '\n' else line
+
+    def read_key_value_tb(self):
+        """
+        Returns:
+            Function that returns the next TypedBytes KeyValue pair, values
+            are hadoopy.typedbytes.RawValue if raw_values is set.
+        """
+        if self.raw_values:
+            return self.tb.read_key_raw_value
+        return self.tb.next
+
+    def read_in_map(self):
+        """Provides the input iterator to use
+
+        If is_io_typedbytes() is true, then use TypedBytes.
+        If is_on_hadoop() is true, then use Text as key\\tvalue\\n.
+        Else, then use Text with key as byte offset and value as line (no \\n)
+
+        Returns:
+            Iterator that can be called to get KeyValue pairs.
+        """
+        if self.is_io_typedbytes():
+            return KeyValueStream(self.read_key_value_tb())
+        if self.is_on_hadoop():
+            return KeyValueStream(self.read_key_value_text)
+        return KeyValueStream(self.read_offset_value_text)
+
+    def read_in_map_arrays(self):
+        while True:
+            keys, values = self.tb.read_batch(self.batch_size, *self.batch_dtypes)
+            if not len(keys):
+                return
+            yield keys, values
+
+    def read_in_reduce(self):
+        """
+        Returns:
+            Iterator that can be called to get grouped KeyValues.
+        """
+        if self.is_io_typedbytes():
+            # Grouped by encoded key, each key is decoded once
+            return self.tb.iter_groups(self.raw_values)
+        return GroupedKeyValues(KeyValueStream(self.read_key_value_text))
+
+    # Environment info methods
+    def is_io_typedbytes(self):
+        # Only all or nothing typedbytes is supported, just check stream_map_input
+        try:
+            return os.environ['stream_map_input'] == 'typedbytes'
+        except KeyError:
+            return False
+
+    def is_on_hadoop(self):
+        return 'mapred_input_format_class' in os.environ
+
+    def flush_tb_writes(self):
+        """
+        Returns:
+            Flush after this many records, 0 (only when the buffer is full)
+            if hadoopy_flush_tb_writes isn't set.  As before it was a count,
+            any other value (e.g., '', '0', 'true') means 1.
+        """
+        try:
+            return max(int(os.environ['hadoopy_flush_tb_writes']), 1)
+        except KeyError:
+            return 0
+        except ValueError:
+            return 1
+
+    def background_io(self):
+        return 'hadoopy_background_io' in os.environ
+
+    def flush_tb_interval(self):
+        try:
+            return float(os.environ['hadoopy_flush_tb_interval'])
+        except KeyError:
+            return None
+
+    def text_separators(self):
+        """
+        Returns:
+            (field_separator, record_separator) of text output (see _main.pyx)
+        """
+        task_type = 'reduce' if self.task_type == 'reduce' else 'map'
+        return (os.environ.get('stream_%s_output_field_separator' % task_type, '\t'),
+                os.environ.get('hadoopy_text_record_separator', '\n'))
+
+    def java_compatible_tb(self):
+        return 'hadoopy_java_compatible_tb' in os.environ
+
+    def compact_ints_tb(self):
+        return 'hadoopy_compact_ints_tb' in os.environ
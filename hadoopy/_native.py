@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# (C) Copyright 2010 Brandyn A. White
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Selects the C extensions or their pure-Python versions
+
+The pure-Python versions (_typedbytes_py, _main_py) are used if
+hadoopy_pure_python is in the environment (e.g., cmdenvs for jobs run with
+python_cmd='pypy') or, with a RuntimeWarning as they are much slower under
+CPython, if the extensions can't be imported or were built from older sources
+and lack part of the API.  Under PyPy the JIT makes them faster than the
+extensions are through cpyext.
+"""
+
+__author__ = 'Brandyn A. White <bwhite@cs.umd.edu>'
+__license__ = 'GPL V3'
+
+import os
+import warnings
+
+# Names used by hadoopy/__init__.py and typedbytes.py
+_TYPEDBYTES_API = ('TypedBytesFile', 'RawValue', 'dumps', 'loads', 'dumps_kvs', 'loads_kvs', 'register_type',
+                   'set_java_compatible', 'set_compact_ints')
+_MAIN_API = ('HadoopyTask', 'GroupedValues')
+
+pure_python = 'hadoopy_pure_python' in os.environ
+if not pure_python:
+    try:
+        import _hadoopy_typedbytes as typedbytes
+        import _hadoopy_main as main
+    except ImportError, e:
+        pure_python = True
+        warnings.warn('Using the pure-Python TypedBytes codec, the C extensions can\'t be imported (%s), '
+                      'set hadoopy_pure_python to silence this' % e, RuntimeWarning)
+    else:
+        missing = ['%s.%s' % (module.__name__, x) for module, names in [(typedbytes, _TYPEDBYTES_API), (main, _MAIN_API)]
+                   for x in names if not hasattr(module, x)]
+        if missing:
+            pure_python = True
+            warnings.warn('Using the pure-Python TypedBytes codec, the C extensions are missing [%s] '
+                          '(rebuild them with "python setup.py build_ext")' % ', '.join(missing), RuntimeWarning)
+if pure_python:
+    import _typedbytes_py as typedbytes
+    import _main_py as main
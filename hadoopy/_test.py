@@ -59,11 +59,12 @@ class Test(unittest.TestCase):
         return cls.groupby_kv(cls.sort_kv(kv))
 
     @classmethod
-    def call_map(cls, func, test_input):
+    def call_map(cls, func, test_input, batch_size=None):
         """Given KeyValue pairs, sort, then group
 
         :param func: Mapper function or class
         :param test_input: Iterator of KeyValue pairs
+        :param batch_size: If not None, call func in batches (see hadoopy.run)
         :returns: List of KeyValue pairs from the mapper
         """
         out = []
@@ -71,15 +72,16 @@ class Test(unittest.TestCase):
         def out_func(out_iter):
             out.extend(out_iter)
         hadoopy._main.HadoopyTask.process_inout(func, test_input,
-                                                out_func, 'map')
+                                                out_func, 'map', batch_size)
         return out
 
     @classmethod
-    def call_reduce(cls, func, test_input):
+    def call_reduce(cls, func, test_input, batch_size=None):
         """Given KeyValue pairs, sort, then group
 
         :param func: Reducer function or class
         :param test_input: Iterator of Grouped KeyValue pairs (e.g., from groupby_kv or shuffle_kv)
+        :param batch_size: If not None, call func in batches (see hadoopy.run)
         :returns: List of KeyValue pairs from the reducer
         """
         out = []
@@ -87,5 +89,5 @@ class Test(unittest.TestCase):
         def out_func(out_iter):
             out.extend(out_iter)
         hadoopy._main.HadoopyTask.process_inout(func, test_input,
-                                                out_func, 'reduce')
+                                                out_func, 'reduce', batch_size)
         return out
@@ -19,25 +19,54 @@ __license__ = 'GPL V3'
 
 import types
 import cPickle as pickle
-from libc.stdint cimport int32_t, int64_t
+import datetime
+import decimal
+import math
+import mmap
+import numbers
+import os
+import time
+try:
+    import numpy as np
+except ImportError:
+    np = None
+from libc.string cimport memcmp
+from libc.stdint cimport int8_t, int16_t, int32_t, int64_t, uint8_t, uint16_t, uint32_t, uint64_t, INT64_MAX
 
 cdef extern from "stdlib.h":
     void *malloc(size_t size)
-    void free(void *ptr)            
+    void *realloc(void *ptr, size_t size)
+    void free(void *ptr)
 
 cdef extern from "stdio.h":
     ssize_t getdelim(char **lineptr, size_t *n, int delim, void *stream)
     void *stdin
     void *stdout
     void *stderr
-    int getc(void *stream)
-    size_t fread(void *ptr, size_t size, size_t nmemb, void *stream)
-    size_t fwrite(void *ptr, size_t size, size_t nmemb, void *stream)
     void *fdopen(int fd, char *mode)
     int fclose(void *fp)
     void *fopen(char *path, char *mode)
     int fflush(void *stream)
     int setvbuf(void *stream, char *buffer, int mode, size_t size)
+    long ftell(void *stream)
+    int ferror(void *stream)
+    int feof(void *stream)
+    int fseek(void *stream, long offset, int whence)
+    void *fmemopen(void *buf, size_t size, char *mode)
+    void *open_memstream(char **ptr, size_t *sizeloc)
+
+cdef extern from "stdio_unlocked.h":
+    int getc "_unlocked_getc"(void *stream)
+    size_t fread "_unlocked_fread"(void *ptr, size_t size, size_t nmemb, void *stream)
+    size_t fwrite "_unlocked_fwrite"(void *ptr, size_t size, size_t nmemb, void *stream)
+
+cdef extern from "cookiefile.h":
+    int COOKIEFILE_SUPPORTED
+    void *_cookiefile_open(object obj, char *mode)
+
+cdef extern from "gzfile.h":
+    int GZFILE_SUPPORTED
+    void *_gzfile_open(char *path, char *mode, int level, unsigned buffer_size)
 
 cdef extern from "byteconversion.h":
     int32_t _be32toh(int32_t val)
@@ -49,9 +78,36 @@ cdef extern from "Python.h":
     object PyString_FromStringAndSize(char *s, Py_ssize_t len)
     int PyString_AsStringAndSize(object obj, char **buffer, Py_ssize_t *length)
     char* PyString_AsString(object string)
-    
+    char* PyString_AS_STRING(object string)
+    object PyUnicode_DecodeUTF8(char *s, Py_ssize_t size, char *errors)
+    int PyObject_CheckBuffer(object obj)
+    int PyObject_GetBuffer(object obj, Py_buffer *view, int flags) except -1
+    void PyBuffer_Release(Py_buffer *view)
+    int PyObject_AsReadBuffer(object obj, void **buffer, Py_ssize_t *buffer_len) except -1
+    int PyBUF_SIMPLE
+    object PyByteArray_FromStringAndSize(char *s, Py_ssize_t len)
+    object PyTuple_New(Py_ssize_t len)
+    void PyTuple_SET_ITEM(object p, Py_ssize_t pos, object o)
+    void Py_INCREF(object o)
+    dict _PyDict_NewPresized(Py_ssize_t minused)
+    size_t _PyLong_NumBits(object v) except? <size_t>-1
+    int _PyLong_AsByteArray(object v, unsigned char *bytes, size_t n, int little_endian, int is_signed) except -1
+    object _PyLong_FromByteArray(unsigned char *bytes, size_t n, int little_endian, int is_signed)
+    char* PyByteArray_AS_STRING(object bytearray)
+
+
+cdef inline int _read_exact(void *fp, void *buf, size_t sz) except -1:
+    """Read exactly sz bytes into buf
+
+    Raises:
+        EOFError: If the stream ends first
+    """
+    if fread(buf, 1, sz, fp) != sz:
+        raise EOFError('Truncated TypedBytes value')
+    return 0
 
-cdef inline int32_t _read_int(void *fp):
+
+cdef inline int32_t _read_int(void *fp) except? -1:
     """Read integer
 
     Code: 3
@@ -61,7 +117,7 @@ cdef inline int32_t _read_int(void *fp):
         Python int
     """
     cdef int32_t val
-    fread(&val, 4, 1, fp)  # = 1
+    _read_exact(fp, &val, 4)
     return _be32toh(val)
 
 
@@ -97,7 +153,7 @@ cdef inline _write_int(void *fp, val):
     fwrite(&cval, 4, 1, fp)  # = 1
 
 
-cdef inline int64_t _read_long(void *fp):
+cdef inline int64_t _read_long(void *fp) except? -1:
     """Read integer
 
     Code: 4
@@ -107,7 +163,7 @@ cdef inline int64_t _read_long(void *fp):
         Python int
     """
     cdef int64_t val
-    fread(&val, 8, 1, fp)  # = 1
+    _read_exact(fp, &val, 8)
     return _be64toh(val)
 
 
@@ -125,7 +181,7 @@ cdef inline _write_long(void *fp, val):
     fwrite(&cval, 8, 1, fp)  # = 1
 
 
-cdef inline float _read_float(void *fp):
+cdef inline float _read_float(void *fp) except? -1:
     """Read float
 
     Code: 5
@@ -135,7 +191,7 @@ cdef inline float _read_float(void *fp):
         Python float
     """
     cdef int32_t val
-    fread(&val, 4, 1, fp)  # = 1
+    _read_exact(fp, &val, 4)
     val = _be32toh(val)
     return (<float*>&val)[0]
 
@@ -154,7 +210,7 @@ cdef inline _write_float(void *fp, val):
     fwrite(&cvalo, 4, 1, fp)  # = 1
 
 
-cdef inline double _read_double(void *fp):
+cdef inline double _read_double(void *fp) except? -1:
     """Read double
 
     Code: 6
@@ -164,7 +220,7 @@ cdef inline double _read_double(void *fp):
         Python float
     """
     cdef int64_t val
-    fread(&val, 8, 1, fp)  # = 1
+    _read_exact(fp, &val, 8)
     val = _be64toh(val)
     return (<double*>&val)[0]
 
@@ -193,7 +249,7 @@ cdef inline _read_byte(void *fp):
         Python int
     """
     cdef signed char val
-    fread(&val, 1, 1, fp)  # = 1
+    _read_exact(fp, &val, 1)
     return int(val)
 
 
@@ -235,6 +291,14 @@ cdef inline _write_bool(void *fp, val):
     fwrite(&cval, 1, 1, fp)  # = 1
 
 
+cdef inline _read_sized_bytes(void *fp, Py_ssize_t sz):
+    if sz < 0:
+        raise ValueError('Bad TypedBytes size %d' % sz)
+    out = PyString_FromStringAndSize(NULL, sz)
+    _read_exact(fp, PyString_AS_STRING(out), sz)
+    return out
+
+
 cdef inline _read_bytes(void *fp):
     """Read bytes
 
@@ -244,12 +308,42 @@ cdef inline _read_bytes(void *fp):
     Returns:
         Python string of bytes
     """
-    sz = _read_int(fp)
-    cdef char *bytes = <char*>malloc(sz)
-    fread(bytes, sz, 1, fp)  # = 1
-    out = PyString_FromStringAndSize(bytes, sz)
-    free(bytes)
-    return out
+    return _read_sized_bytes(fp, _read_int(fp))
+
+
+# Set while loads/loads_kvs are called with view_size, see _read_bytes_value
+cdef void *_view_fp = NULL
+cdef object _view_rbuf = None
+cdef Py_ssize_t _view_offset = 0
+cdef Py_ssize_t _view_size = 0
+
+
+cdef _read_bytes_value(void *fp):
+    """Read bytes, large values from loads(..., view_size) are views
+
+    Code: 0
+    Format: <32-bit signed integer> <as many bytes as indicated by the integer>
+
+    Returns:
+        Python string of bytes, or a memoryview/buffer of the loads input
+        if it is at least view_size bytes long
+    """
+    if fp != _view_fp:
+        return _read_bytes(fp)
+    cdef int32_t sz = _read_int(fp)
+    if sz < _view_size:
+        return _read_sized_bytes(fp, sz)
+    if sz < 0:
+        raise ValueError('Bad TypedBytes size %d' % sz)
+    cdef Py_ssize_t start = _view_offset + ftell(fp)
+    fseek(fp, sz, 1)  # 1 == SEEK_CUR
+    return (<_ReadBuffer>_view_rbuf).slice(start, sz)
+
+
+# Decoding buffer reused for unicode values up to this size
+DEF _UNICODE_SCRATCH_MAX = 1048576
+cdef char *_unicode_scratch = NULL
+cdef size_t _unicode_scratch_size = 0
 
 
 # NOTE(brandyn): This is incompatible with Dumbo's typedbytes as strings and unicode both go to string
@@ -262,15 +356,30 @@ cdef inline _read_unicode(void *fp):
     Returns:
         Python unicode
     """
-    sz = _read_int(fp)
-    cdef char *bytes = <char*>malloc(sz)
-    fread(bytes, sz, 1, fp)  # = 1
-    out = PyString_FromStringAndSize(bytes, sz)
-    free(bytes)
+    global _unicode_scratch, _unicode_scratch_size
+    cdef int32_t sz = _read_int(fp)
+    cdef char *bytes
+    if sz < 0:
+        raise ValueError('Bad TypedBytes size %d' % sz)
+    if sz <= _UNICODE_SCRATCH_MAX:
+        if _unicode_scratch_size < sz:
+            bytes = <char*>realloc(_unicode_scratch, sz)
+            if bytes == NULL:
+                raise MemoryError
+            _unicode_scratch, _unicode_scratch_size = bytes, sz
+        bytes = _unicode_scratch
+    else:
+        bytes = <char*>malloc(sz)
+        if bytes == NULL:
+            raise MemoryError
     try:
-        return unicode(out, 'utf-8')
+        _read_exact(fp, bytes, sz)
+        return PyUnicode_DecodeUTF8(bytes, sz, NULL)
     except UnicodeError:
         raise UnicodeError('Error decoding unicode string.  See hadoopy.com for details on TypedBytes encoding.')
+    finally:
+        if bytes != _unicode_scratch:
+            free(bytes)
 
 
 cdef inline _write_bytes(void *fp, val):
@@ -289,6 +398,14 @@ cdef inline _write_bytes(void *fp, val):
     fwrite(bytes, sz, 1, fp)  # = 1
 
 
+cdef inline _write_bytes_data(void *fp, val):
+    """Write the contents of a Python string (no size or type code)"""
+    cdef char *bytes
+    cdef Py_ssize_t sz
+    PyString_AsStringAndSize(val, &bytes, &sz)  # != -1
+    fwrite(bytes, sz, 1, fp)  # = 1
+
+
 cdef inline _write_unicode(void *fp, val):
     """Write bytes
 
@@ -315,11 +432,16 @@ cdef inline _read_vector(void *fp):
     Returns:
         Python tuple with nested values
     """
-    sz = _read_int(fp)
-    out = []
+    cdef int32_t sz = _read_int(fp)
+    cdef int32_t x
+    if sz < 0:
+        raise ValueError('Bad vector size %d' % sz)
+    out = PyTuple_New(sz)
     for x in range(sz):
-        out.append(_read_tb_code(fp))
-    return tuple(out)
+        val = _read_tb_item(fp)
+        Py_INCREF(val)
+        PyTuple_SET_ITEM(out, x, val)
+    return out
 
 
 cdef inline _write_vector(void *fp, val):
@@ -346,12 +468,11 @@ cdef inline _read_list(void *fp):
     Returns:
         Python list of nested values
     """
-    out = []
-    while True:
-        try:
-            out.append(_read_tb_code(fp))
-        except StopIteration:
-            break
+    cdef list out = []
+    cdef int type_code = getc(fp)
+    while type_code != 255 and type_code >= 0:
+        out.append(_read_tb_value(fp, type_code))
+        type_code = getc(fp)
     return out
 
 
@@ -379,11 +500,12 @@ cdef inline _read_map(void *fp):
     Returns:
         Python dict with nested values
     """
-    sz = _read_int(fp)
-    out = {}
+    cdef int32_t sz = _read_int(fp)
+    cdef int32_t x
+    cdef dict out = _PyDict_NewPresized(sz) if sz > 0 else {}
     for x in range(sz):
-        k, v = _read_tb_code(fp), _read_tb_code(fp)
-        out[k] = v
+        k = _read_tb_item(fp)
+        out[k] = _read_tb_item(fp)
     return out
 
 
@@ -426,6 +548,269 @@ cdef inline _write_pickle(void *fp, val):
     _write_bytes(fp, pickle.dumps(val, -1))
 
 
+cdef inline _read_ndarray(void *fp):
+    """Read a numpy array
+
+    Code: 101 (custom)
+    Format: <32-bit signed integer> <dtype string as bytes> <32-bit signed integer ndim> <ndim 64-bit signed integers shape> <raw C-contiguous data>
+
+    The leading integer is the size of the rest of the value so that other
+    readers can treat it like any other custom type.  The array is backed
+    directly by the buffer that the data is read into.
+
+    Returns:
+        Numpy array
+    """
+    cdef int32_t sz = _read_int(fp)
+    dtype = _read_bytes(fp)
+    cdef int32_t ndim = _read_int(fp)
+    shape = tuple([_read_long(fp) for x in range(ndim)])
+    sz -= 4 + len(dtype) + 4 + 8 * ndim
+    if sz < 0:
+        raise ValueError('Bad TypedBytes size %d' % sz)
+    data = PyByteArray_FromStringAndSize(NULL, sz)
+    _read_exact(fp, PyByteArray_AS_STRING(data), sz)
+    if np is None:
+        raise ImportError('Numpy is required to read ndarray values')
+    return np.frombuffer(data, dtype).reshape(shape)
+
+
+cdef inline _write_ndarray(void *fp, val):
+    """Write a numpy array
+
+    Code: 101 (custom)
+    Format: <32-bit signed integer> <dtype string as bytes> <32-bit signed integer ndim> <ndim 64-bit signed integers shape> <raw C-contiguous data>
+
+    Args:
+        val: Numpy array (see _is_raw_ndarray)
+    """
+    cdef Py_buffer view
+    if not val.flags.c_contiguous:
+        val = val.copy()
+    dtype = val.dtype.str
+    PyObject_GetBuffer(val, &view, PyBUF_SIMPLE)
+    try:
+        _raw_write_int(fp, 4 + len(dtype) + 4 + 8 * val.ndim + view.len)
+        _write_bytes(fp, dtype)
+        _raw_write_int(fp, val.ndim)
+        for x in val.shape:
+            _write_long(fp, x)
+        fwrite(view.buf, view.len, 1, fp)  # = 1
+    finally:
+        PyBuffer_Release(&view)
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+cdef inline _read_none(void *fp):
+    """Read None
+
+    Code: 102 (custom)
+    Format: <32-bit signed integer (always 0)>
+
+    Returns:
+        None
+    """
+    _read_int(fp)
+    return None
+
+
+cdef inline _write_none(void *fp, val):
+    """Write None
+
+    Code: 102 (custom)
+    Format: <32-bit signed integer (always 0)>
+
+    Args:
+        val: None
+    """
+    _raw_write_int(fp, 0)
+
+
+cdef inline _read_set(void *fp):
+    """Read set
+
+    Code: 103 (custom)
+    Format: <32-bit signed integer> <typedbytes vector of the items>
+
+    Returns:
+        Python set
+    """
+    _read_int(fp)
+    return set(_read_tb_item(fp))
+
+
+cdef inline _read_frozenset(void *fp):
+    """Read frozenset
+
+    Code: 104 (custom)
+    Format: <32-bit signed integer> <typedbytes vector of the items>
+
+    Returns:
+        Python frozenset
+    """
+    _read_int(fp)
+    return frozenset(_read_tb_item(fp))
+
+
+cdef inline _write_set(void *fp, val):
+    """Write set or frozenset
+
+    Code: 103 (set) or 104 (frozenset) (custom)
+    Format: <32-bit signed integer> <typedbytes vector of the items>
+
+    Args:
+        val: Python set or frozenset
+    """
+    _write_bytes(fp, _dumps(tuple(val), 0, 0))
+
+
+cdef inline _read_datetime(void *fp):
+    """Read datetime
+
+    Code: 105 (custom)
+    Format: <32-bit signed integer (always 8)> <64-bit signed integer microseconds since 1970-01-01>
+
+    Returns:
+        Python datetime (naive)
+    """
+    _read_int(fp)
+    return _EPOCH + datetime.timedelta(0, 0, _read_long(fp))
+
+
+cdef inline _write_datetime(void *fp, val):
+    """Write datetime
+
+    Code: 105 (custom)
+    Format: <32-bit signed integer (always 8)> <64-bit signed integer microseconds since 1970-01-01>
+
+    Args:
+        val: Python datetime (naive)
+    """
+    delta = val - _EPOCH
+    _raw_write_int(fp, 8)
+    _write_long(fp, (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+
+cdef inline _read_decimal(void *fp):
+    """Read decimal
+
+    Code: 106 (custom)
+    Format: <32-bit signed integer> <as many bytes as indicated by the integer (decimal string)>
+
+    Returns:
+        Python Decimal
+    """
+    return decimal.Decimal(_read_bytes(fp))
+
+
+cdef inline _write_decimal(void *fp, val):
+    """Write decimal
+
+    Code: 106 (custom)
+    Format: <32-bit signed integer> <as many bytes as indicated by the integer (decimal string)>
+
+    Args:
+        val: Python Decimal
+    """
+    _write_bytes(fp, str(val))
+
+
+cdef inline _read_bigint(void *fp):
+    """Read integer (outside of 64-bit signed)
+
+    Code: 107 (custom)
+    Format: <32-bit signed integer> <signed byte (0 = positive and 1 = negative)> <big-endian magnitude (the remaining bytes)>
+
+    Returns:
+        Python long
+    """
+    data = _read_bytes(fp)
+    cdef Py_ssize_t sz = len(data)
+    if sz < 1:
+        raise ValueError('Bad integer size %d' % sz)
+    cdef unsigned char *buf = <unsigned char *>PyString_AS_STRING(data)
+    val = _PyLong_FromByteArray(buf + 1, sz - 1, 0, 0)
+    return -val if buf[0] else val
+
+
+cdef inline _write_bigint(void *fp, val):
+    """Write integer (outside of 64-bit signed)
+
+    Code: 107 (custom)
+    Format: <32-bit signed integer> <signed byte (0 = positive and 1 = negative)> <big-endian magnitude (the remaining bytes)>
+
+    Args:
+        val: Python int/long
+    """
+    cdef unsigned char negative = val < 0
+    magnitude = long(-val if negative else val)
+    cdef size_t sz = (_PyLong_NumBits(magnitude) + 7) // 8
+    data = PyString_FromStringAndSize(NULL, sz + 1)
+    cdef unsigned char *buf = <unsigned char *>PyString_AS_STRING(data)
+    buf[0] = negative
+    _PyLong_AsByteArray(magnitude, buf + 1, sz, 0, 0)
+    _write_bytes(fp, data)
+
+
+cdef int _java_compatible = 0
+
+
+def set_java_compatible(enabled):
+    """Only use types that Java TypedBytesWritable can interpret
+
+    Custom codes (50-200) are still valid TypedBytes and Java passes them
+    through as raw bytes, but it can't interpret them.  When enabled, set is
+    written as a list (9), frozenset as a vector (8, read back as a tuple so
+    it can still be a dict key), naive datetime as ISO 8601 unicode (7), and
+    Decimal as unicode (7).  None and integers outside of 64 bits have no
+    standard TypedBytes type and are always written as codes 102 and 107.
+    Timezone-aware datetimes, datetime.date, and other unsupported types are
+    still pickled (100) which Java can't interpret.  Reading is unaffected.
+
+    :param enabled: If True use standard types where possible (default is False)
+    """
+    global _java_compatible
+    _java_compatible = int(bool(enabled))
+
+
+cdef int _compact_ints = 0
+
+
+def set_compact_ints(enabled):
+    """Write each int/long with the smallest integer type it fits in
+
+    Values in [-128, 127] are written as byte (1) which is 2 bytes instead of
+    5 for int (3), and longs (4) that fit in an int are written as int.  These
+    are standard TypedBytes types (so Java streaming can still handle them),
+    but Java sees a Byte where it would have seen an Integer.  Reading is
+    unaffected (bytes are read as ints).
+
+    :param enabled: If True use the smallest integer type (default is False)
+    """
+    global _compact_ints
+    _compact_ints = int(bool(enabled))
+
+
+cdef inline int _compact_int_code(val):
+    if -128 <= val <= 127:
+        return 1
+    if -2147483648 <= val <= 2147483647:
+        return 3
+    return 4
+
+
+cdef _java_compatible_val(int type_code, val):
+    if type_code == 103:
+        return list(val)
+    if type_code == 104:
+        return tuple(val)
+    if type_code == 105:
+        return unicode(val.isoformat())
+    return unicode(val)
+
+
 # 0: _write_bytes unused
 # 1: _write_byte unused
 # 5: _write_float unused
@@ -437,7 +822,152 @@ _out_types = {types.BooleanType: 2,
               types.UnicodeType: 7,
               types.TupleType: 8,
               types.ListType: 9,
-              types.DictType: 10}
+              types.DictType: 10,
+              types.NoneType: 102,
+              set: 103,
+              frozenset: 104,
+              datetime.datetime: 105,
+              decimal.Decimal: 106}
+if np is not None:
+    _out_types[np.ndarray] = 101
+_resolved_types = {}  # type: type_code, memoized _resolve_type_code results
+_custom_encoders = {}  # type_code: encode
+_custom_decoders = {}  # type_code: decode
+
+
+ctypedef object (*_read_func)(void *fp)
+ctypedef object (*_write_func)(void *fp, object val)
+
+
+cdef _read_int_obj(void *fp):
+    return _read_int(fp)
+
+
+cdef _read_long_obj(void *fp):
+    return _read_long(fp)
+
+
+cdef _read_float_obj(void *fp):
+    return _read_float(fp)
+
+
+cdef _read_double_obj(void *fp):
+    return _read_double(fp)
+
+
+# Indexed by type code, NULL entries are either custom (see register_type) or invalid
+cdef _read_func _read_funcs[256]
+cdef _write_func _write_funcs[256]
+_read_funcs[0], _write_funcs[0] = _read_bytes_value, _write_bytes
+_read_funcs[1], _write_funcs[1] = _read_byte, _write_byte
+_read_funcs[2], _write_funcs[2] = _read_bool, _write_bool
+_read_funcs[3], _write_funcs[3] = _read_int_obj, _write_int
+_read_funcs[4], _write_funcs[4] = _read_long_obj, _write_long
+_read_funcs[5], _write_funcs[5] = _read_float_obj, _write_float
+_read_funcs[6], _write_funcs[6] = _read_double_obj, _write_double
+_read_funcs[7], _write_funcs[7] = _read_unicode, _write_unicode
+_read_funcs[8], _write_funcs[8] = _read_vector, _write_vector
+_read_funcs[9], _write_funcs[9] = _read_list, _write_list
+_read_funcs[10], _write_funcs[10] = _read_map, _write_map
+_read_funcs[100], _write_funcs[100] = _read_pickle, _write_pickle
+_read_funcs[101], _write_funcs[101] = _read_ndarray, _write_ndarray
+_read_funcs[102], _write_funcs[102] = _read_none, _write_none
+_read_funcs[103], _write_funcs[103] = _read_set, _write_set
+_read_funcs[104], _write_funcs[104] = _read_frozenset, _write_set
+_read_funcs[105], _write_funcs[105] = _read_datetime, _write_datetime
+_read_funcs[106], _write_funcs[106] = _read_decimal, _write_decimal
+_read_funcs[107], _write_funcs[107] = _read_bigint, _write_bigint
+
+
+def register_type(type_code, py_type, encode, decode):
+    """Use a custom type code for a Python type instead of pickling it
+
+    Custom values are encoded like bytes (<32-bit signed integer> <bytes>) so
+    that other TypedBytes readers can skip them.  Compared to the pickle
+    fallback this avoids pickling (and its larger output, which includes the
+    class name), but encode/decode are still called for every value.
+
+    :param type_code: Type code (int) in [50, 200] excluding those used by hadoopy (100-107)
+    :param py_type: Python type to encode (exact type, not subclasses)
+    :param encode: Function taking a value of py_type and returning a string
+    :param decode: Function taking a string and returning a value
+    :raises: ValueError: If type_code or py_type are reserved or already registered
+    """
+    type_code = int(type_code)
+    if not 50 <= type_code <= 200 or _read_funcs[type_code] != NULL:
+        raise ValueError('Custom type codes must be in [50, 200] and not used by hadoopy, got [%d]' % type_code)
+    prev_code = _out_types.get(py_type)
+    if prev_code is not None and prev_code != type_code:
+        raise ValueError('Type [%s] already uses type code [%d]' % (py_type, prev_code))
+    if type_code in _custom_encoders and prev_code is None:
+        raise ValueError('Type code [%d] is already registered' % type_code)
+    _out_types[py_type] = type_code
+    _resolved_types.clear()
+    _custom_encoders[type_code] = encode
+    _custom_decoders[type_code] = decode
+
+
+# Checked in order by _resolve_type_code for types missing from _out_types
+_subclass_types = ((types.IntType, 3),
+                   (types.LongType, 4),
+                   (types.FloatType, 6),
+                   (types.StringType, 0),
+                   (types.UnicodeType, 7),
+                   (types.TupleType, 8),
+                   (types.ListType, 9),
+                   (types.DictType, 10))
+
+
+cdef int _resolve_type_code(val_type) except -1:
+    """Find the type code for a type that isn't in _out_types
+
+    Subclasses of native types (e.g., namedtuple, OrderedDict, defaultdict)
+    and numpy scalars use the corresponding native code, everything else is
+    pickled.  Results are memoized in _resolved_types.
+
+    Args:
+        val_type: Python type
+
+    Returns:
+        Type code
+    """
+    code = _resolved_types.get(val_type)
+    if code is not None:
+        return code
+    code = 100
+    # Numpy strings (np.str_, np.unicode_) are str/unicode subclasses
+    if np is not None and issubclass(val_type, np.generic) and not issubclass(val_type, basestring):
+        if issubclass(val_type, np.bool_):
+            code = 2
+        elif issubclass(val_type, np.integer):
+            code = 3
+        elif issubclass(val_type, (np.float16, np.float32)):
+            code = 5
+        elif issubclass(val_type, np.float64):
+            code = 6
+    else:
+        for base_type, base_code in _subclass_types:
+            if issubclass(val_type, base_type):
+                code = base_code
+                break
+    _resolved_types[val_type] = code
+    return code
+
+
+cdef bint _is_raw_ndarray(val) except -1:
+    """True if val can be written as code 101, else it is pickled
+
+    Objects, fields, and dtypes that can't export a buffer (datetime64,
+    timedelta64) are pickled.
+    """
+    dtype = val.dtype
+    if dtype.hasobject or dtype.names is not None or dtype.kind in 'Mm':
+        return False
+    try:
+        memoryview(val)
+    except (ValueError, TypeError, BufferError):
+        return False
+    return True
 
 
 cdef _write_tb_code(void *fp, val):
@@ -445,75 +975,64 @@ cdef _write_tb_code(void *fp, val):
     try:
         type_code = _out_types[type(val)]
     except KeyError:
-        type_code = 100
+        type_code = _resolve_type_code(type(val))
     if type_code == 3 and (val < -2147483648 or 2147483647 < val):
         type_code = 4
     if type_code == 4 and (val < -9223372036854775808L or 9223372036854775807L < val):
+        type_code = 107
+    if _compact_ints and (type_code == 3 or type_code == 4):
+        type_code = _compact_int_code(val)
+    if type_code == 256:
+        return _write_raw_value(fp, val)
+    if type_code == 101 and not _is_raw_ndarray(val):
         type_code = 100
+    if type_code == 105 and val.tzinfo is not None:
+        type_code = 100
+    if _java_compatible and 103 <= type_code <= 106:
+        val = _java_compatible_val(type_code, val)
+        type_code = _out_types[type(val)]
     fwrite(&type_code, 1, 1, fp)  # = 1
-    # TODO Use a func pointer array
-    if type_code == 0:
-        _write_bytes(fp, val)
-    elif type_code == 2:
-        _write_bool(fp, val)
-    elif type_code == 3:
-        _write_int(fp, val)
-    elif type_code == 4:
-        _write_long(fp, val)
-    elif type_code == 6:
-        _write_double(fp, val)
-    elif type_code == 7:
-        _write_unicode(fp, val)
-    elif type_code == 8:
-        _write_vector(fp, val)
-    elif type_code == 9:
-        _write_list(fp, val)
-    elif type_code == 10:
-        _write_map(fp, val)
-    elif type_code == 100:
-        _write_pickle(fp, val)
+    cdef _write_func func = _write_funcs[type_code]
+    if func != NULL:
+        func(fp, val)
     else:
-        raise IndexError('Bad index %d ' % type_code)
+        _write_bytes(fp, _custom_encoders[type_code](val))
 
 
 cdef _read_tb_code(void *fp):
     cdef int type_code = getc(fp)
-    # TODO Use a func pointer array
-    if type_code == 0:
-        return _read_bytes(fp)
-    elif type_code == 1:
-        return _read_byte(fp)
-    elif type_code == 2:
-        return _read_bool(fp)
-    elif type_code == 3:
-        return _read_int(fp)
-    elif type_code == 4:
-        return _read_long(fp)
-    elif type_code == 5:
-        return _read_float(fp)
-    elif type_code == 6:
-        return _read_double(fp)
-    elif type_code == 7:
-        return _read_unicode(fp)
-    elif type_code == 8:
-        return _read_vector(fp)
-    elif type_code == 9:
-        return _read_list(fp)
-    elif type_code == 10:
-        return _read_map(fp)
-    elif type_code == 100:
-        return _read_pickle(fp)
-    elif type_code == 255:
+    if type_code == 255 or type_code < 0:
         raise StopIteration
-    elif type_code < 0:
-        raise StopIteration        
-    else:
+    return _read_tb_value(fp, type_code)
+
+
+cdef _read_tb_item(void *fp):
+    """Read a value that must be present (in a container or a KeyValue pair)
+
+    Raises:
+        EOFError: At the end of the stream
+    """
+    cdef int type_code = getc(fp)
+    if type_code < 0:
+        raise EOFError('Truncated TypedBytes value')
+    return _read_tb_value(fp, type_code)
+
+
+cdef _read_tb_value(void *fp, int type_code):
+    """Read the value that follows type_code (which has already been read)"""
+    cdef _read_func func = _read_funcs[type_code]
+    if func != NULL:
+        return func(fp)
+    try:
+        decode = _custom_decoders[type_code]
+    except KeyError:
         raise IndexError('Bad index %d ' % type_code)
+    return decode(_read_bytes(fp))
 
 
 cdef __read_key_value_tb(void *fp):
     k = _read_tb_code(fp)
-    v = _read_tb_code(fp)
+    v = _read_tb_item(fp)
     return k, v
 
 
@@ -523,6 +1042,742 @@ cdef __write_key_value_tb(void *fp, kv):
     _write_tb_code(fp, v)
     
 
+cdef struct _RawBuffer:
+    char *data
+    size_t size
+    size_t capacity
+
+
+cdef char *_raw_extend(_RawBuffer *buf, size_t sz) except NULL:
+    """Grow buf by sz bytes and return a pointer to them"""
+    cdef size_t capacity = buf.capacity
+    cdef char *data
+    if buf.size + sz > capacity:
+        if capacity < 64:
+            capacity = 64
+        while buf.size + sz > capacity:
+            capacity *= 2
+        data = <char *>realloc(buf.data, capacity)
+        if data == NULL:
+            raise MemoryError
+        buf.data, buf.capacity = data, capacity
+    data = buf.data + buf.size
+    buf.size += sz
+    return data
+
+
+cdef int _raw_read(void *fp, _RawBuffer *buf, size_t sz) except -1:
+    if fread(_raw_extend(buf, sz), 1, sz, fp) != sz:
+        raise EOFError('Truncated TypedBytes value')
+
+
+cdef int _raw_read_int(void *fp, _RawBuffer *buf) except? -1:
+    """Copy a 32-bit integer and return it"""
+    _raw_read(fp, buf, 4)
+    return _be32toh((<int32_t *>(buf.data + buf.size - 4))[0])
+
+
+cdef int _read_raw_tb_value(void *fp, _RawBuffer *buf, int type_code) except -1:
+    """Copy the encoded value that follows type_code into buf (without decoding)
+
+    Every code in [50, 200] is followed by a 32-bit size, as in Java's
+    TypedBytesInput.readRaw.
+    """
+    cdef int32_t sz, x
+    _raw_extend(buf, 1)[0] = <char>type_code
+    if type_code == 0 or type_code == 7 or 50 <= type_code <= 200:
+        sz = _raw_read_int(fp, buf)
+        _raw_read(fp, buf, sz)
+    elif type_code == 1 or type_code == 2:
+        _raw_read(fp, buf, 1)
+    elif type_code == 3 or type_code == 5:
+        _raw_read(fp, buf, 4)
+    elif type_code == 4 or type_code == 6:
+        _raw_read(fp, buf, 8)
+    elif type_code == 8 or type_code == 10:
+        sz = _raw_read_int(fp, buf)
+        if type_code == 10:
+            sz *= 2
+        for x in range(sz):
+            _read_raw_tb_value(fp, buf, getc(fp))
+    elif type_code == 9:
+        type_code = getc(fp)
+        while type_code != 255:
+            _read_raw_tb_value(fp, buf, type_code)
+            type_code = getc(fp)
+        _raw_extend(buf, 1)[0] = <char>255
+    elif type_code < 0:
+        raise EOFError('Truncated TypedBytes value')
+    else:
+        raise IndexError('Bad index %d ' % type_code)
+
+
+cdef int _skip_bytes(void *fp, long sz) except -1:
+    """Move forward sz bytes, seeking if possible else reading (e.g., pipes)
+
+    Seeking past the end of a file succeeds, so the last byte is read to
+    check that the value is all there.
+    """
+    cdef char discard[4096]
+    cdef size_t cur_sz
+    if sz < 0:
+        raise ValueError('Bad TypedBytes size %d' % sz)
+    if sz == 0:
+        return 0
+    if fseek(fp, sz - 1, 1) == 0:  # 1 == SEEK_CUR
+        if getc(fp) < 0:
+            raise EOFError('Truncated TypedBytes value')
+        return 0
+    while sz:
+        cur_sz = min(sz, 4096)
+        if fread(discard, 1, cur_sz, fp) != cur_sz:
+            raise EOFError('Truncated TypedBytes value')
+        sz -= cur_sz
+
+
+cdef int _skip_tb_value(void *fp, int type_code) except -1:
+    """Move past the encoded value that follows type_code (without decoding)
+
+    Nothing is allocated.  See _read_raw_tb_value for the format.
+    """
+    cdef int32_t sz, x
+    if type_code == 0 or type_code == 7 or 50 <= type_code <= 200:
+        _skip_bytes(fp, _read_int(fp))
+    elif type_code == 1 or type_code == 2:
+        _skip_bytes(fp, 1)
+    elif type_code == 3 or type_code == 5:
+        _skip_bytes(fp, 4)
+    elif type_code == 4 or type_code == 6:
+        _skip_bytes(fp, 8)
+    elif type_code == 8 or type_code == 10:
+        sz = _read_int(fp)
+        if sz < 0:
+            raise ValueError('Bad TypedBytes size %d' % sz)
+        if type_code == 10:
+            sz *= 2
+        for x in range(sz):
+            _skip_tb_value(fp, getc(fp))
+    elif type_code == 9:
+        type_code = getc(fp)
+        while type_code != 255:
+            _skip_tb_value(fp, type_code)
+            type_code = getc(fp)
+    elif type_code < 0:
+        raise EOFError('Truncated TypedBytes value')
+    else:
+        raise IndexError('Bad index %d ' % type_code)
+
+
+cdef class RawValue(object):
+    """TypedBytes value that keeps its encoding and is decoded on first use
+
+    When a RawValue is written it is copied verbatim (it is not re-encoded).
+    Changes made to the decoded value are not written, yield a new value
+    instead.
+
+    :param raw: Encoded value including its type code (str)
+    """
+    cdef readonly object raw
+    cdef object _value
+    cdef int _decoded
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._decoded = 0
+
+    property value:
+        """Decoded value (cached)"""
+        def __get__(self):
+            if not self._decoded:
+                self._value = loads(self.raw)
+                self._decoded = 1
+            return self._value
+
+    def __repr__(self):
+        return 'RawValue(%r)' % self.raw
+
+    def __reduce__(self):
+        return RawValue, (self.raw,)
+
+
+cdef _read_raw_value(void *fp):
+    """Read one value as a RawValue
+
+    Raises:
+        StopIteration: At the end of the stream
+    """
+    cdef int type_code = getc(fp)
+    if type_code == 255 or type_code < 0:
+        raise StopIteration
+    cdef _RawBuffer buf
+    buf.data, buf.size, buf.capacity = NULL, 0, 0
+    try:
+        _read_raw_tb_value(fp, &buf, type_code)
+        return RawValue(PyString_FromStringAndSize(buf.data, buf.size))
+    finally:
+        free(buf.data)
+
+
+cdef inline _write_raw_value(void *fp, val):
+    """Write a RawValue verbatim (including its type code)"""
+    _write_bytes_data(fp, (<RawValue>val).raw)
+
+
+# Type codes that a schema can use for a Python type directly
+_schema_type_codes = frozenset([0, 2, 3, 4, 6, 7, 102])
+
+
+cdef class _SchemaNode(object):
+    """Compiled schema for one value, see _compile_schema"""
+    cdef int type_code  # -1 for values handled by the generic codec
+    cdef object py_type
+    cdef tuple children
+    cdef Py_ssize_t num_children
+
+    def __init__(self, int type_code, py_type=None, children=()):
+        self.type_code = type_code
+        self.py_type = py_type
+        self.children = tuple(children)
+        self.num_children = len(self.children)
+
+
+cdef _SchemaNode _compile_schema(spec):
+    """Compile a schema spec for one value
+
+    Specs are built from types and containers of specs
+    - str, unicode, int, long, float, bool, type(None): That exact type
+    - (spec0, spec1, ...): Tuple (vector) with that many items
+    - [spec]: List with each item matching spec
+    - {key_spec: value_spec}: Dict with each pair matching the specs
+    - object (or any other type): Anything, uses the generic codec
+
+    Args:
+        spec: Schema spec
+
+    Returns:
+        _SchemaNode
+
+    Raises:
+        ValueError: If the spec is malformed
+    """
+    if isinstance(spec, tuple):
+        return _SchemaNode(8, tuple, [_compile_schema(x) for x in spec])
+    if isinstance(spec, list):
+        if len(spec) != 1:
+            raise ValueError('List schemas must have one item spec, got [%r]' % (spec,))
+        return _SchemaNode(9, list, [_compile_schema(spec[0])])
+    if isinstance(spec, dict):
+        if len(spec) != 1:
+            raise ValueError('Dict schemas must have one key/value spec, got [%r]' % (spec,))
+        return _SchemaNode(10, dict, map(_compile_schema, spec.items()[0]))
+    if not isinstance(spec, type):
+        raise ValueError('Schema specs must be types, tuples, lists, or dicts, got [%r]' % (spec,))
+    type_code = _out_types.get(spec, -1)
+    if type_code not in _schema_type_codes:
+        type_code = -1
+    return _SchemaNode(type_code, spec)
+
+
+def _compile_kv_schema(schema):
+    """Compile a (key_spec, value_spec) pair, None stays None"""
+    if schema is None:
+        return None
+    key_spec, value_spec = schema
+    return _compile_schema(key_spec), _compile_schema(value_spec)
+
+
+cdef _write_schema(void *fp, _SchemaNode node, val):
+    """Write val using node, values that don't match it use _write_tb_code
+
+    The output is identical to _write_tb_code, only the type discovery is
+    skipped.
+    """
+    cdef int type_code = node.type_code
+    cdef Py_ssize_t x
+    if type_code < 0 or type(val) is not node.py_type:
+        return _write_tb_code(fp, val)
+    if type_code == 3 and (val < -2147483648 or 2147483647 < val):
+        return _write_tb_code(fp, val)
+    if type_code == 4 and (val < -9223372036854775808L or 9223372036854775807L < val):
+        return _write_tb_code(fp, val)
+    if type_code == 8 and len(val) != node.num_children:
+        return _write_tb_code(fp, val)
+    if _compact_ints and (type_code == 3 or type_code == 4):
+        type_code = _compact_int_code(val)
+    fwrite(&type_code, 1, 1, fp)  # = 1
+    if type_code == 8:
+        _raw_write_int(fp, node.num_children)
+        for x in range(node.num_children):
+            _write_schema(fp, <_SchemaNode>node.children[x], val[x])
+    elif type_code == 9:
+        for y in val:
+            _write_schema(fp, <_SchemaNode>node.children[0], y)
+        type_code = 255
+        fwrite(&type_code, 1, 1, fp)  # = 1
+    elif type_code == 10:
+        _raw_write_int(fp, len(val))
+        for y, z in val.iteritems():
+            _write_schema(fp, <_SchemaNode>node.children[0], y)
+            _write_schema(fp, <_SchemaNode>node.children[1], z)
+    else:
+        _write_funcs[type_code](fp, val)
+
+
+cdef _read_schema_value(void *fp, _SchemaNode node, int type_code):
+    """Read the value that follows type_code using node
+
+    Values that were written with a different type code than node expects
+    are read with the generic codec.
+    """
+    cdef int32_t sz, x
+    if type_code != node.type_code:
+        return _read_tb_value(fp, type_code)
+    if type_code == 8:
+        sz = _read_int(fp)
+        if sz != node.num_children:
+            return tuple([_read_tb_item(fp) for x in range(sz)])
+        out = PyTuple_New(sz)
+        for x in range(sz):
+            val = _read_schema_item(fp, <_SchemaNode>node.children[x])
+            Py_INCREF(val)
+            PyTuple_SET_ITEM(out, x, val)
+        return out
+    if type_code == 9:
+        out_list = []
+        type_code = getc(fp)
+        while type_code != 255 and type_code >= 0:
+            out_list.append(_read_schema_value(fp, <_SchemaNode>node.children[0], type_code))
+            type_code = getc(fp)
+        return out_list
+    if type_code == 10:
+        sz = _read_int(fp)
+        out_dict = _PyDict_NewPresized(sz) if sz > 0 else {}
+        for x in range(sz):
+            k = _read_schema_item(fp, <_SchemaNode>node.children[0])
+            out_dict[k] = _read_schema_item(fp, <_SchemaNode>node.children[1])
+        return out_dict
+    return _read_funcs[type_code](fp)
+
+
+cdef _read_schema(void *fp, _SchemaNode node):
+    cdef int type_code = getc(fp)
+    if type_code == 255 or type_code < 0:
+        raise StopIteration
+    return _read_schema_value(fp, node, type_code)
+
+
+cdef _read_schema_item(void *fp, _SchemaNode node):
+    """Read a value that must be present using node (see _read_tb_item)"""
+    cdef int type_code = getc(fp)
+    if type_code < 0:
+        raise EOFError('Truncated TypedBytes value')
+    return _read_schema_value(fp, node, type_code)
+
+
+# Order-preserving key encoding: None < numbers < lists < str/unicode < tuples
+# (Python 2 orders mixed types by type name, except that str and unicode compare
+# as text, so it has no consistent order for tuples among strings)
+cdef enum:
+    _ORD_NONE = 1
+    _ORD_NEG_INF = 2
+    _ORD_NEG = 3
+    _ORD_ZERO = 4
+    _ORD_POS = 5
+    _ORD_POS_INF = 6
+    _ORD_NAN = 7
+    _ORD_LIST = 16
+    _ORD_TEXT = 17
+    _ORD_TUPLE = 18
+    # Number kinds (follow the number so equal numbers stay together)
+    _ORD_INT = 0
+    _ORD_FLOAT = 1
+    _ORD_BOOL = 2
+    # Text kinds (follow the text)
+    _ORD_STR = 0
+    _ORD_UNICODE = 1
+
+
+cdef _encode_ordered_number(val, bytearray out):
+    """Append number val so that byte order is numeric order
+
+    Format: <tag> [<32-bit exponent + 2**31> <fraction groups>] <kind>
+
+    Nonzero finite numbers are 2**(exponent - 1) * 1.fraction.  The fraction
+    bits (trailing zeros removed) are stored 7 per byte in the high bits, the
+    low bit is 1 if more bytes follow.  Negative numbers store the bytes of
+    their magnitude inverted.
+    """
+    cdef int kind, tag, num_groups, x
+    cdef unsigned char invert
+    if type(val) is bool:
+        kind, val = _ORD_BOOL, int(val)
+    elif isinstance(val, numbers.Integral):
+        kind, val = _ORD_INT, long(val)
+    else:
+        kind, val = _ORD_FLOAT, float(val)
+    if val != val:
+        out.append(_ORD_NAN)
+    elif val == 0:
+        out.append(_ORD_ZERO)
+    elif kind == _ORD_FLOAT and math.isinf(val):
+        out.append(_ORD_POS_INF if val > 0 else _ORD_NEG_INF)
+    else:
+        tag, invert = (_ORD_NEG, 255) if val < 0 else (_ORD_POS, 0)
+        val = abs(val)
+        if kind == _ORD_FLOAT:
+            fraction, exponent = math.frexp(val)
+            fraction, num_bits = long(fraction * 2 ** 53) - 2 ** 52, 52
+        else:
+            exponent = val.bit_length()
+            fraction, num_bits = val - (1L << (exponent - 1)), exponent - 1
+        if fraction:
+            x = (fraction & -fraction).bit_length() - 1
+            fraction, num_bits = fraction >> x, num_bits - x
+        else:
+            num_bits = 0
+        num_groups = max(1, (num_bits + 6) // 7)
+        fraction <<= 7 * num_groups - num_bits
+        out.append(tag)
+        exponent += 2 ** 31
+        for x in range(24, -8, -8):
+            out.append(((exponent >> x) & 255) ^ invert)
+        for x in range(num_groups - 1, -1, -1):
+            out.append((((fraction >> (7 * x)) & 127) << 1 | (x > 0)) ^ invert)
+    out.append(kind)
+
+
+cdef _encode_ordered(val, bytearray out):
+    """Append val so that comparing encodings as bytes orders the values
+
+    Values of one type are in Python's order, types are in the order of the
+    _ORD_* tags.  str and unicode are compared as text: str by its bytes,
+    unicode by its UTF-8 bytes (the same as Python 2 for ASCII str), and when
+    the text is equal str comes first.  Text is terminated by 0x00 0x01 (with
+    0x00 escaped as 0x00 0xff) then its kind, tuples/lists are terminated by
+    0x00 (less than any tag).
+    """
+    if val is None:
+        out.append(_ORD_NONE)
+    elif isinstance(val, str):
+        out.append(_ORD_TEXT)
+        out.extend(val.replace('\x00', '\x00\xff'))
+        out.extend('\x00\x01')
+        out.append(_ORD_STR)
+    elif isinstance(val, unicode):
+        out.append(_ORD_TEXT)
+        out.extend(val.encode('utf-8').replace('\x00', '\x00\xff'))
+        out.extend('\x00\x01')
+        out.append(_ORD_UNICODE)
+    elif isinstance(val, (tuple, list)):
+        out.append(_ORD_TUPLE if isinstance(val, tuple) else _ORD_LIST)
+        for x in val:
+            _encode_ordered(x, out)
+        out.append(0)
+    elif isinstance(val, numbers.Real):
+        _encode_ordered_number(val, out)
+    else:
+        raise TypeError('Ordered keys must be None, numbers, str, unicode, tuples or lists, got [%s]' % type(val))
+
+
+cdef _decode_ordered(bytes data, Py_ssize_t *pos):
+    """Decode the value at pos[0] (see _encode_ordered) and move pos past it"""
+    cdef unsigned char *buf = <unsigned char *>PyString_AS_STRING(data)
+    cdef Py_ssize_t end, size = len(data)
+    cdef unsigned char tag, invert, group
+    cdef int kind
+    if pos[0] >= size:
+        raise ValueError('Truncated ordered key')
+    tag = buf[pos[0]]
+    pos[0] += 1
+    if tag == _ORD_NONE:
+        return None
+    if tag == _ORD_TEXT:
+        end = data.find('\x00\x01', pos[0])
+        if end < 0 or end + 2 >= size:
+            raise ValueError('Truncated ordered key')
+        val = data[pos[0]:end].replace('\x00\xff', '\x00')
+        kind = buf[end + 2]
+        pos[0] = end + 3
+        if kind == _ORD_UNICODE:
+            return val.decode('utf-8')
+        if kind != _ORD_STR:
+            raise ValueError('Bad ordered key text kind %d' % kind)
+        return val
+    if tag == _ORD_TUPLE or tag == _ORD_LIST:
+        out = []
+        while pos[0] < size and buf[pos[0]] != 0:
+            out.append(_decode_ordered(data, pos))
+        pos[0] += 1
+        return tuple(out) if tag == _ORD_TUPLE else out
+    if not _ORD_NEG_INF <= tag <= _ORD_NAN:
+        raise ValueError('Bad ordered key tag %d' % tag)
+    if tag == _ORD_NEG or tag == _ORD_POS:
+        if pos[0] + 5 > size:
+            raise ValueError('Truncated ordered key')
+        invert = 255 if tag == _ORD_NEG else 0
+        exponent = 0
+        for end in range(4):
+            exponent = exponent << 8 | (buf[pos[0] + end] ^ invert)
+        exponent -= 2 ** 31
+        pos[0] += 4
+        fraction, num_bits = 0L, 0
+        while True:
+            if pos[0] >= size:
+                raise ValueError('Truncated ordered key')
+            group = buf[pos[0]] ^ invert
+            pos[0] += 1
+            fraction, num_bits = fraction << 7 | group >> 1, num_bits + 7
+            if not group & 1:
+                break
+        mantissa, shift = (1L << num_bits) | fraction, exponent - 1 - num_bits
+    if pos[0] >= size:
+        raise ValueError('Truncated ordered key')
+    kind = buf[pos[0]]
+    pos[0] += 1
+    if tag == _ORD_NAN:
+        return float('nan')
+    if tag == _ORD_POS_INF or tag == _ORD_NEG_INF:
+        return float('inf') if tag == _ORD_POS_INF else float('-inf')
+    if tag == _ORD_ZERO:
+        val = 0
+    elif kind == _ORD_FLOAT:
+        val = math.ldexp(float(mantissa), shift)
+    else:
+        val = int(mantissa << shift if shift >= 0 else mantissa >> -shift)
+    if tag == _ORD_NEG:
+        val = -val
+    if kind == _ORD_FLOAT:
+        return float(val)
+    return bool(val) if kind == _ORD_BOOL else val
+
+
+cdef _write_ordered_key(void *fp, val):
+    """Write key val with the order-preserving encoding
+
+    Code: 9 (list) of 4 (long)
+    Format: The _encode_ordered bytes zero padded to a multiple of 8 and
+        split into longs.  There is no length prefix, so comparing the raw
+        TypedBytes (as Hadoop does when sorting keys) orders the keys (see
+        _encode_ordered).
+    """
+    cdef bytearray out = bytearray()
+    _encode_ordered(val, out)
+    out.extend('\x00' * (-len(out) % 8))
+    cdef char *data = PyByteArray_AS_STRING(out)
+    cdef Py_ssize_t x
+    cdef unsigned char type_code = 9
+    fwrite(&type_code, 1, 1, fp)  # = 1
+    type_code = 4
+    for x in range(0, len(out), 8):
+        fwrite(&type_code, 1, 1, fp)  # = 1
+        fwrite(data + x, 8, 1, fp)  # = 1
+    type_code = 255
+    fwrite(&type_code, 1, 1, fp)  # = 1
+
+
+cdef _read_ordered_key(void *fp):
+    """Read a key written by _write_ordered_key (other keys are read normally)"""
+    cdef int type_code = getc(fp)
+    if type_code == 255 or type_code < 0:
+        raise StopIteration
+    if type_code != 9:
+        return _read_tb_value(fp, type_code)
+    cdef uint64_t num
+    cdef int x
+    chunks = []
+    while True:
+        type_code = getc(fp)
+        if type_code == 255:
+            break
+        if type_code < 0:
+            raise EOFError('Truncated TypedBytes value')
+        if type_code == 4:
+            chunks.append(_read_sized_bytes(fp, 8))
+            continue
+        # Re-encoded by a generic writer (e.g., launch_local's sort), the longs may come back as smaller ints
+        val = _read_tb_value(fp, type_code)
+        if not isinstance(val, numbers.Integral):
+            raise ValueError('Bad ordered key element type %d' % type_code)
+        num = <uint64_t><int64_t>val
+        chunks.append(bytes(bytearray([(num >> x) & 255 for x in range(56, -8, -8)])))
+    cdef Py_ssize_t pos = 0
+    return _decode_ordered(b''.join(chunks), &pos)
+
+
+cdef class _ReadBuffer(object):
+    """Exposes the memory of a buffer object without copying
+
+    New-style buffers (str, bytearray, memoryview) are acquired with
+    PyObject_GetBuffer, old-style ones (mmap, buffer) with
+    PyObject_AsReadBuffer.  The buffer is held until this is deallocated.
+    """
+    cdef Py_buffer view
+    cdef int has_view
+    cdef char *data
+    cdef Py_ssize_t size
+    cdef object obj
+
+    def __cinit__(self, obj):
+        self.obj = obj
+        self.has_view = 0
+        if PyObject_CheckBuffer(obj):
+            PyObject_GetBuffer(obj, &self.view, PyBUF_SIMPLE)
+            self.has_view = 1
+            self.data = <char *>self.view.buf
+            self.size = self.view.len
+        else:
+            PyObject_AsReadBuffer(obj, <void **>&self.data, &self.size)
+
+    def __dealloc__(self):
+        if self.has_view:
+            PyBuffer_Release(&self.view)
+
+    cdef void *open(self, Py_ssize_t offset) except NULL:
+        """Open the buffer as a read-only FILE starting at offset"""
+        if offset < 0 or offset >= self.size:
+            raise EOFError('Offset [%d] is outside of the buffer (length [%d])' % (offset, self.size))
+        cdef void *fp = fmemopen(self.data + offset, self.size - offset, 'r')
+        if fp == NULL:
+            raise MemoryError('Cannot open buffer for reading')
+        return fp
+
+    cdef slice(self, Py_ssize_t start, Py_ssize_t size):
+        """View of [start, start + size) that shares memory with the buffer"""
+        if self.has_view:
+            return memoryview(self.obj)[start:start + size]
+        return buffer(self.obj, start, size)
+
+
+cdef _set_view(_ReadBuffer rbuf, void *fp, Py_ssize_t offset, view_size):
+    """Make bytes values read from fp into views of rbuf (see _read_bytes_value)
+
+    Returns:
+        Previous state to be passed to _restore_view
+    """
+    global _view_fp, _view_rbuf, _view_offset, _view_size
+    prev = (<Py_ssize_t>_view_fp, _view_rbuf, _view_offset, _view_size)
+    if view_size is not None:
+        _view_fp, _view_rbuf, _view_offset, _view_size = fp, rbuf, offset, view_size
+    return prev
+
+
+cdef _restore_view(prev):
+    global _view_fp, _view_rbuf, _view_offset, _view_size
+    fp, _view_rbuf, _view_offset, _view_size = prev
+    _view_fp = <void *><Py_ssize_t>fp
+
+
+def loads(buf, Py_ssize_t offset=0, view_size=None, ordered=False):
+    """Decode one TypedBytes value from a buffer
+
+    The buffer is read in place (no copy is made).
+
+    :param buf: Object supporting the buffer protocol (str, bytearray, memoryview, mmap)
+    :param offset: Byte offset of the value in buf (default 0)
+    :param view_size: If not None, bytes values of at least this many bytes are returned as views of buf (memoryview or buffer) instead of copies (default None)
+    :param ordered: If True, the value uses the order-preserving key encoding (see dumps) (default False)
+    :returns: Python object
+    :raises: EOFError: If there is no value at offset
+    """
+    cdef _ReadBuffer rbuf = _ReadBuffer(buf)
+    cdef void *fp = rbuf.open(offset)
+    prev_view = _set_view(rbuf, fp, offset, view_size)
+    try:
+        if ordered:
+            return _read_ordered_key(fp)
+        return _read_tb_code(fp)
+    except StopIteration:
+        raise EOFError('No value at offset [%d]' % offset)
+    finally:
+        _restore_view(prev_view)
+        fclose(fp)
+
+
+def loads_kvs(buf, Py_ssize_t offset=0, view_size=None, ordered_keys=False):
+    """Decode all KeyValue pairs from a buffer
+
+    The buffer is read in place (no copy is made).
+
+    :param buf: Object supporting the buffer protocol (str, bytearray, memoryview, mmap)
+    :param offset: Byte offset of the first pair in buf (default 0)
+    :param view_size: If not None, bytes values of at least this many bytes are returned as views of buf (memoryview or buffer) instead of copies (default None)
+    :param ordered_keys: If True, keys use the order-preserving encoding (see dumps) (default False)
+    :returns: List of (key, value)
+    """
+    cdef _ReadBuffer rbuf = _ReadBuffer(buf)
+    out = []
+    if offset == rbuf.size:
+        return out
+    cdef void *fp = rbuf.open(offset)
+    prev_view = _set_view(rbuf, fp, offset, view_size)
+    try:
+        while True:
+            try:
+                if ordered_keys:
+                    k = _read_ordered_key(fp)
+                    out.append((k, _read_tb_item(fp)))
+                else:
+                    out.append(__read_key_value_tb(fp))
+            except StopIteration:
+                return out
+    finally:
+        _restore_view(prev_view)
+        fclose(fp)
+
+
+cdef _dumps(val, int is_kvs, int ordered):
+    cdef char *data = NULL
+    cdef size_t sz = 0
+    cdef void *fp = open_memstream(&data, &sz)
+    if fp == NULL:
+        raise MemoryError('Cannot open buffer for writing')
+    try:
+        if is_kvs and ordered:
+            for k, v in val:
+                _write_ordered_key(fp, k)
+                _write_tb_code(fp, v)
+        elif is_kvs:
+            for kv in val:
+                __write_key_value_tb(fp, kv)
+        elif ordered:
+            _write_ordered_key(fp, val)
+        else:
+            _write_tb_code(fp, val)
+    finally:
+        fclose(fp)
+    try:
+        return PyString_FromStringAndSize(data, sz)
+    finally:
+        free(data)
+
+
+def dumps(val, ordered=False):
+    """Encode one value as TypedBytes
+
+    The order-preserving encoding is for keys (None, numbers, str, unicode,
+    and tuples/lists of them): comparing encoded keys as raw bytes, as Hadoop
+    does when sorting, orders keys of the same type as Python does (numbers
+    by value, str and unicode as text).  Mixed types are ordered None,
+    numbers, lists, str/unicode, then tuples.  It is a valid TypedBytes list
+    of longs, so it must be read with ordered=True.
+
+    :param val: Python object
+    :param ordered: If True, use the order-preserving key encoding (default False)
+    :returns: Python string of bytes
+    """
+    return _dumps(val, 0, ordered)
+
+
+def dumps_kvs(kvs, ordered_keys=False):
+    """Encode KeyValue pairs as TypedBytes (the same format as TypedBytesFile)
+
+    :param kvs: Iterator of (key, value)
+    :param ordered_keys: If True, keys use the order-preserving encoding (see dumps) (default False)
+    :returns: Python string of bytes
+    """
+    return _dumps(kvs, 1, ordered_keys)
+
+
 def read_tb():
     return __read_key_value_tb(stdin)
 
@@ -531,6 +1786,324 @@ def write_tb(kv):
     __write_key_value_tb(stdout, kv)
 
 
+_out_types[RawValue] = 256  # Not a TypedBytes code, see _write_tb_code
+
+
+cdef char *_set_buffer(void *fp, Py_ssize_t size) except? NULL:
+    """Fully buffer the (not yet used) stream with size bytes
+
+    Returns:
+        Buffer to free after the stream is closed (NULL if size <= 0)
+    """
+    if size <= 0:
+        return NULL
+    cdef char *buf = <char *>malloc(size)
+    if buf == NULL:
+        raise MemoryError
+    setvbuf(fp, buf, 0, size)  # 0 == _IOFBF
+    return buf
+
+
+cdef object _STORED = object()  # Returned by _ArrayColumn._read_into when stored in the array
+
+
+cdef inline bint _store_int(char *ptr, char kind, int itemsize, int64_t val):
+    """Store val in an array element of kind/itemsize if it fits, returns True if stored
+
+    Floats only store ints that they represent exactly (e.g., not above 2**53 for float64).
+    """
+    cdef double dval
+    cdef float fval
+    if kind == c'f':
+        # Converted back to int64 to check (only when in range), comparing with a double would round val
+        if itemsize == 4:
+            fval = val
+            if not -9223372036854775808.0 <= fval < 9223372036854775808.0 or <int64_t>fval != val:
+                return False
+            (<float *>ptr)[0] = fval
+        else:
+            dval = val
+            if not -9223372036854775808.0 <= dval < 9223372036854775808.0 or <int64_t>dval != val:
+                return False
+            (<double *>ptr)[0] = dval
+        return True
+    if kind == c'i':
+        if itemsize == 8:
+            (<int64_t *>ptr)[0] = val
+        elif itemsize == 4 and val == <int32_t>val:
+            (<int32_t *>ptr)[0] = val
+        elif itemsize == 2 and val == <int16_t>val:
+            (<int16_t *>ptr)[0] = val
+        elif itemsize == 1 and val == <int8_t>val:
+            (<int8_t *>ptr)[0] = val
+        else:
+            return False
+        return True
+    if kind == c'u' and val >= 0:
+        if itemsize == 8:
+            (<uint64_t *>ptr)[0] = val
+        elif itemsize == 4 and val == <uint32_t>val:
+            (<uint32_t *>ptr)[0] = val
+        elif itemsize == 2 and val == <uint16_t>val:
+            (<uint16_t *>ptr)[0] = val
+        elif itemsize == 1 and val == <uint8_t>val:
+            (<uint8_t *>ptr)[0] = val
+        else:
+            return False
+        return True
+    return False
+
+
+cdef _array_dtype(dtype):
+    """Returns: Numpy dtype that _ArrayColumn can store directly, None for object arrays"""
+    if dtype is None:
+        return None
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'O':
+        return None
+    if not ((dtype.kind in 'iu' and dtype.itemsize in (1, 2, 4, 8)) or (dtype.kind == 'f' and dtype.itemsize in (4, 8))
+            or dtype.kind == 'b'):
+        raise ValueError('Unsupported dtype [%s], use bool, (u)int8-64, float32/64, or object' % dtype)
+    if not dtype.isnative:
+        raise ValueError('Dtype [%s] must have native byte order' % dtype)
+    return dtype
+
+
+cdef class _ArrayColumn(object):
+    """Up to n decoded values, numbers are stored directly in an array of dtype
+
+    Once a value isn't a number of dtype's kind (or doesn't fit it) the column
+    becomes an object array.
+    """
+    cdef object arr
+    cdef object objs
+    cdef char *data
+    cdef char kind
+    cdef int itemsize
+    cdef Py_ssize_t size
+
+    def __init__(self, Py_ssize_t n, dtype):
+        dtype = _array_dtype(dtype)
+        if dtype is None:
+            self.objs = []
+        else:
+            self.arr = np.empty(n, dtype)
+            self.data = <char *><size_t>self.arr.ctypes.data
+            self.kind = ord(dtype.kind)
+            self.itemsize = dtype.itemsize
+
+    cdef _read_into(self, void *fp, int type_code):
+        """Read the value following type_code
+
+        Returns:
+            _STORED if it was stored in the array, else the value
+        """
+        cdef char *ptr = self.data + self.size * self.itemsize
+        cdef signed char bval
+        cdef int64_t ival
+        cdef double dval
+        if type_code == 1 or type_code == 2:
+            _read_exact(fp, &bval, 1)
+            if type_code == 2:
+                if self.kind == c'b':
+                    (<uint8_t *>ptr)[0] = bval != 0
+                    return _STORED
+                return bool(bval)
+            ival = bval
+        elif type_code == 3:
+            ival = _read_int(fp)
+        elif type_code == 4:
+            ival = _read_long(fp)
+        elif type_code == 5 or type_code == 6:
+            dval = _read_float(fp) if type_code == 5 else _read_double(fp)
+            if self.kind != c'f':
+                return dval
+            if self.itemsize == 4:
+                (<float *>ptr)[0] = dval
+            else:
+                (<double *>ptr)[0] = dval
+            return _STORED
+        else:
+            return _read_tb_value(fp, type_code)
+        if _store_int(ptr, self.kind, self.itemsize, ival):
+            return _STORED
+        return ival
+
+    cdef append_value(self, val):
+        if self.data != NULL:
+            self.objs = self.arr[:self.size].tolist()
+            self.arr = None
+            self.data = NULL
+        self.objs.append(val)
+        self.size += 1
+
+    cdef append(self, void *fp, int type_code):
+        if self.data != NULL:
+            val = self._read_into(fp, type_code)
+            if val is _STORED:
+                self.size += 1
+                return
+            self.objs = self.arr[:self.size].tolist()
+            self.arr = None
+            self.data = NULL
+        else:
+            val = _read_tb_value(fp, type_code)
+        self.objs.append(val)
+        self.size += 1
+
+    cdef finish(self):
+        if self.data != NULL:
+            return self.arr[:self.size]
+        out = np.empty(self.size, dtype=object)
+        for x, val in enumerate(self.objs):
+            out[x] = val
+        return out
+
+
+cdef class _ArrayWriter(object):
+    """Writes the elements of a 1-D array (or sequence), numbers are encoded directly
+
+    Numbers use the codes the generic encoder would (bool, int/long, float
+    for float32, double for float64).
+    """
+    cdef object arr
+    cdef object objs
+    cdef char *data
+    cdef char kind
+    cdef int itemsize
+
+    def __init__(self, arr):
+        if not isinstance(arr, np.ndarray):
+            self.objs = list(arr)
+            return
+        try:
+            dtype = _array_dtype(arr.dtype) if arr.ndim == 1 else None
+        except ValueError:
+            dtype = None
+        if dtype is None:
+            self.objs = arr.tolist()
+            return
+        self.arr = np.ascontiguousarray(arr)
+        self.data = <char *><size_t>self.arr.ctypes.data
+        self.kind = ord(dtype.kind)
+        self.itemsize = dtype.itemsize
+
+    def __len__(self):
+        return len(self.objs) if self.data == NULL else len(self.arr)
+
+    cdef get(self, Py_ssize_t num):
+        """Returns: The num'th element as a Python object"""
+        return self.objs[num] if self.data == NULL else self.arr[num].item()
+
+    cdef write(self, void *fp, Py_ssize_t num):
+        """Write the num'th element"""
+        cdef char *ptr = self.data + num * self.itemsize
+        cdef unsigned char type_code
+        cdef int64_t ival
+        cdef int32_t ival32
+        cdef signed char bval
+        if self.data == NULL:
+            _write_tb_code(fp, self.objs[num])
+            return
+        if self.kind == c'b':
+            type_code = 2
+            bval = (<uint8_t *>ptr)[0] != 0
+            fwrite(&type_code, 1, 1, fp)  # = 1
+            fwrite(&bval, 1, 1, fp)  # = 1
+            return
+        if self.kind == c'f':
+            type_code = 5 if self.itemsize == 4 else 6
+            fwrite(&type_code, 1, 1, fp)  # = 1
+            if self.itemsize == 4:
+                ival32 = _htobe32((<int32_t *>ptr)[0])
+                fwrite(&ival32, 4, 1, fp)  # = 1
+            else:
+                ival = _htobe64((<int64_t *>ptr)[0])
+                fwrite(&ival, 8, 1, fp)  # = 1
+            return
+        if self.kind == c'u' and self.itemsize == 8 and (<uint64_t *>ptr)[0] > <uint64_t>INT64_MAX:
+            _write_tb_code(fp, (<uint64_t *>ptr)[0])
+            return
+        if self.itemsize == 1:
+            ival = (<int8_t *>ptr)[0] if self.kind == c'i' else (<uint8_t *>ptr)[0]
+        elif self.itemsize == 2:
+            ival = (<int16_t *>ptr)[0] if self.kind == c'i' else (<uint16_t *>ptr)[0]
+        elif self.itemsize == 4:
+            ival = (<int32_t *>ptr)[0] if self.kind == c'i' else (<uint32_t *>ptr)[0]
+        else:
+            ival = (<int64_t *>ptr)[0]
+        if _compact_ints and ival == <int8_t>ival:
+            type_code = 1
+            bval = <signed char>ival
+            fwrite(&type_code, 1, 1, fp)  # = 1
+            fwrite(&bval, 1, 1, fp)  # = 1
+        elif ival == <int32_t>ival:
+            type_code = 3
+            fwrite(&type_code, 1, 1, fp)  # = 1
+            ival32 = _htobe32(<int32_t>ival)
+            fwrite(&ival32, 4, 1, fp)  # = 1
+        else:
+            type_code = 4
+            fwrite(&type_code, 1, 1, fp)  # = 1
+            ival = _htobe64(ival)
+            fwrite(&ival, 8, 1, fp)  # = 1
+
+
+class _FileObjStream(object):
+    """Stream for cookiefile.h over a file-like object or socket (not closed)
+
+    Exceptions are kept in .error which TypedBytesFile raises when a read
+    stops early (stdio sees a failed read as the end of the stream) and on
+    close.  After a failed read every read fails, so the reader can't lose
+    its place in the stream.
+    """
+
+    def __init__(self, fileobj):
+        self.error = None
+        self._read = None
+        if hasattr(fileobj, 'recv_into'):
+            self._readinto, self._write = fileobj.recv_into, fileobj.sendall
+        else:
+            self._readinto = getattr(fileobj, 'readinto', None)
+            self._write = getattr(fileobj, 'write', None)
+            if self._readinto is None:
+                self._read = getattr(fileobj, 'read', None)
+        self._flush = getattr(fileobj, 'flush', None)
+        self.readable = self._readinto is not None or self._read is not None
+        self.writable = self._write is not None
+
+    def readinto(self, buf):
+        if self.error is not None:
+            raise self.error
+        try:
+            if self._readinto is not None:
+                return self._readinto(buf)
+            data = self._read(len(buf))
+            buf[:len(data)] = data
+            return len(data)
+        except Exception, e:
+            self.error = e
+            raise
+
+    def write(self, data):
+        try:
+            num_written = self._write(data)
+            # Raw files/sockets may write less than asked (sendall returns None)
+            while num_written is not None and num_written < len(data):
+                data = buffer(data, num_written)
+                num_written = self._write(data)
+        except Exception, e:
+            self.error = e
+            raise
+
+    def flush(self):
+        if self._flush is not None:
+            self._flush()
+
+    def close(self):
+        self.flush()
+
+
 cdef class TypedBytesFile(object):
     """TypedBytes interface
 
@@ -538,41 +2111,360 @@ cdef class TypedBytesFile(object):
     :param mode: Mode to open the file with (default None)
     :param read_fd: Read file descriptor (int) (default None)
     :param write_fd: Write file descriptor (int) (default None)
-    :param flush_writes: If True then flush the buffer for every write (default False)
+    :param flush_writes: If True then flush the buffer for every write, if an int N then flush after at least N records have been written (default False)
+    :param flush_interval: Flush after this many seconds have passed since the last flush (default None)
+    :param write_buffer_size: Size in bytes of the output buffer, a full buffer is written in one call (default 1048576)
+    :param fileobj: File-like object (readinto/read and/or write, e.g., StringIO, gzip.GzipFile, HTTP response) or socket (recv_into/sendall) to use instead of fn/fds, it is not closed, needs glibc (default None)
+    :param read_buffer_size: Size in bytes of the input buffer for fileobj, filled with one readinto (default 1048576)
+    :param compression: 'gzip' or 'none' for fn, None picks 'gzip' for '.gz' paths if supported (needs glibc, else they are read/written as is) (default None)
+    :param compression_level: 0 (fastest) to 9 (smallest) when writing compressed (default 6)
+    :param background_io: If True, read_fd/write_fd are read ahead/written behind on helper threads (GIL released), needs glibc (default False)
+    :param read_schema: (key_spec, value_spec) of the records read, see below (default None)
+    :param read_ordered_keys: If True, keys read use the order-preserving encoding (see typedbytes.dumps), overrides the read_schema key_spec (default False)
+    :param write_ordered_keys: If True, keys written use the order-preserving encoding, overrides the write_schema key_spec (default False)
+    :param write_schema: (key_spec, value_spec) of the records written, see below (default None)
+    :param use_mmap: If True, memory map fn (mode must be 'r') which allows for seek/len/split using a record index (default False)
+    :param byte_range: With use_mmap, (start, stop) byte offsets of fn to read, they must be record boundaries (e.g., from split) (default None is the whole file)
+
+    Schemas compile a specialized encoder/decoder for records of a fixed shape
+    (e.g., (str, (int, float, str))), skipping per-value type discovery.  The
+    output is standard TypedBytes and values that don't match their spec use
+    the generic codec.  A spec is a type (str, unicode, int, long, float, bool,
+    type(None), or object for anything), a tuple of specs (fixed length
+    tuple), [spec] (list), or {key_spec: value_spec} (dict).
     """
     cdef void* _write_ptr
     cdef void* _read_ptr
     cdef object _repr
     cdef object file_method
     cdef int flush_writes
-    def __init__(self, fn=None, mode=None, read_fd=None, write_fd=None, flush_writes=False, unbuffered_reads=False):
+    cdef double _flush_interval
+    cdef double _last_flush
+    cdef Py_ssize_t _unflushed
+    cdef char *_write_buffer
+    cdef char *_read_buffer
+    cdef object _read_stream
+    cdef object _write_stream
+    cdef int _read_ordered_keys
+    cdef int _write_ordered_keys
+    cdef _SchemaNode _read_key_schema
+    cdef _SchemaNode _read_value_schema
+    cdef _SchemaNode _write_key_schema
+    cdef _SchemaNode _write_value_schema
+    cdef object _mmap
+    cdef object _mmap_buffer
+    cdef object _fn
+    cdef Py_ssize_t _range_start
+    cdef Py_ssize_t _range_stop
+    cdef int64_t *_index
+    cdef Py_ssize_t _index_size
+    cdef int _has_index
+    def __init__(self, fn=None, mode=None, read_fd=None, write_fd=None, flush_writes=False, unbuffered_reads=False,
+                 read_schema=None, write_schema=None, use_mmap=False, byte_range=None, flush_interval=None,
+                 write_buffer_size=1048576, background_io=False, compression=None, compression_level=6,
+                 fileobj=None, read_buffer_size=1048576, read_ordered_keys=False, write_ordered_keys=False):
         self.flush_writes = int(flush_writes)
+        self._read_ordered_keys = int(read_ordered_keys)
+        self._write_ordered_keys = int(write_ordered_keys)
+        self._flush_interval = flush_interval if flush_interval is not None else 0.
+        self._last_flush = time.time()
+        if read_schema is not None:
+            self._read_key_schema, self._read_value_schema = _compile_kv_schema(read_schema)
+        if write_schema is not None:
+            self._write_key_schema, self._write_value_schema = _compile_kv_schema(write_schema)
         cdef char *fnc
         cdef char *modec
         self._repr = "TypedBytesFile(%s, %s, %s, %s)" % (repr(fn), repr(mode), repr(read_fd), repr(write_fd))
-        if fn:
+        if fileobj is not None:
+            self._open_fileobj(fileobj, mode, read_buffer_size, write_buffer_size)
+        elif use_mmap:
+            if not fn or mode not in (None, 'r', 'rb'):
+                raise ValueError('use_mmap requires fn and read mode')
+            self._open_mmap(fn, byte_range)
+        elif fn:
             self.file_method = 'fn'
             if mode == None:
                 mode = 'r'
             fnc = PyString_AsString(fn)
             modec = PyString_AsString(mode)
-            self._write_ptr = self._read_ptr = fopen(fnc, modec)
+            if compression is None:
+                compression = 'gzip' if fn.endswith('.gz') and GZFILE_SUPPORTED else 'none'
+            if compression == 'gzip':
+                if not GZFILE_SUPPORTED:
+                    raise NotImplementedError('gzip compression requires fopencookie (glibc)')
+                self._write_ptr = self._read_ptr = _gzfile_open(fnc, modec, compression_level, write_buffer_size)
+            elif compression == 'none':
+                self._write_ptr = self._read_ptr = fopen(fnc, modec)
+            else:
+                raise ValueError('Unknown compression [%s]' % compression)
             if self._write_ptr == NULL:
                 raise IOError('Cannot open file [%s]' % fn)
+            if mode[0] in 'wa':
+                self._write_buffer = _set_buffer(self._write_ptr, write_buffer_size)
         elif read_fd != None or write_fd != None:
             self.file_method = 'readwritefds'
+            if background_io:
+                self._open_background(read_fd, write_fd, write_buffer_size)
+                return
             self._read_ptr = fdopen(read_fd, 'r') if read_fd != None else <void *>0
             if unbuffered_reads:
                 setvbuf(self._read_ptr, <char *>0, 2, 0)
             self._write_ptr = fdopen(write_fd, 'w') if write_fd != None else <void *>0
+            if self._write_ptr:
+                self._write_buffer = _set_buffer(self._write_ptr, write_buffer_size)
         else:
             self.file_method = 'stdinout'
             self._write_ptr = stdout
             self._read_ptr = stdin
 
+    cdef _open_background(self, read_fd, write_fd, write_buffer_size):
+        import hadoopy._background_io
+        if not COOKIEFILE_SUPPORTED:
+            raise NotImplementedError('background_io requires fopencookie (glibc)')
+        if read_fd != None:
+            self._read_stream = hadoopy._background_io.ReadAhead(read_fd)
+            self._read_ptr = _cookiefile_open(self._read_stream, 'r')
+            if self._read_ptr == NULL:
+                raise MemoryError
+        if write_fd != None:
+            self._write_stream = hadoopy._background_io.WriteBehind(write_fd)
+            self._write_ptr = _cookiefile_open(self._write_stream, 'w')
+            if self._write_ptr == NULL:
+                raise MemoryError
+            self._write_buffer = _set_buffer(self._write_ptr, write_buffer_size)
+
+    cdef _open_fileobj(self, fileobj, mode, read_buffer_size, write_buffer_size):
+        if not COOKIEFILE_SUPPORTED:
+            raise NotImplementedError('fileobj requires fopencookie (glibc)')
+        self.file_method = 'fileobj'
+        stream = _FileObjStream(fileobj)
+        if stream.readable and mode in (None, 'r', 'rb'):
+            self._read_stream = stream
+            self._read_ptr = _cookiefile_open(stream, 'r')
+            if self._read_ptr == NULL:
+                raise MemoryError
+            self._read_buffer = _set_buffer(self._read_ptr, read_buffer_size)
+        if stream.writable and mode in (None, 'w', 'wb'):
+            self._write_stream = stream
+            self._write_ptr = _cookiefile_open(stream, 'w')
+            if self._write_ptr == NULL:
+                raise MemoryError
+            self._write_buffer = _set_buffer(self._write_ptr, write_buffer_size)
+        if self._read_ptr == NULL and self._write_ptr == NULL:
+            raise ValueError('fileobj can\'t be used with mode [%s]' % mode)
+
+    cdef _open_mmap(self, fn, byte_range):
+        cdef _ReadBuffer rbuf
+        self.file_method = 'mmap'
+        self._fn = fn
+        with open(fn, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if size:
+                self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._range_start, self._range_stop = byte_range if byte_range is not None else (0, size)
+        if not 0 <= self._range_start <= self._range_stop <= size:
+            raise ValueError('Bad byte_range [%r] for file of size [%d]' % (byte_range, size))
+        if self._range_start == self._range_stop:
+            self._read_ptr = fopen('/dev/null', 'r')
+        else:
+            # Positions in the stream are file offsets, reads end at stop
+            self._mmap_buffer = rbuf = _ReadBuffer(self._mmap)
+            self._read_ptr = fmemopen(rbuf.data, self._range_stop, 'r')
+            if self._read_ptr == NULL:
+                raise MemoryError('Cannot open buffer for reading')
+            fseek(self._read_ptr, self._range_start, 0)  # 0 == SEEK_SET
+
+    def __dealloc__(self):
+        # Streams that call back into Python (or hold compressor state) can't be left for exit to flush, mmaps would leak
+        if self.file_method in ('fn', 'fileobj', 'mmap') or self._read_stream is not None or self._write_stream is not None:
+            self._close_streams()
+        free(self._index)
+
+    cdef _check_mmap(self):
+        if self.file_method != 'mmap':
+            raise ValueError('Only available with use_mmap=True')
+        if self._read_ptr == NULL:
+            raise ValueError('File is closed')
+
+    cdef int _index_append(self, int64_t offset, Py_ssize_t *capacity) except -1:
+        cdef int64_t *index
+        if self._index_size == capacity[0]:
+            capacity[0] = max(1024, capacity[0] * 2)
+            index = <int64_t *>realloc(self._index, capacity[0] * sizeof(int64_t))
+            if index == NULL:
+                raise MemoryError
+            self._index = index
+        self._index[self._index_size] = offset
+        self._index_size += 1
+
+    def build_index(self):
+        """Find the offset of every record (use_mmap only)
+
+        Values are skipped, not decoded.  The read position is unchanged.
+        """
+        self._check_mmap()
+        cdef long prev_pos = ftell(self._read_ptr)
+        cdef long pos
+        cdef int type_code
+        cdef Py_ssize_t capacity = 0
+        free(self._index)
+        self._index, self._index_size, self._has_index = NULL, 0, 0
+        if self._range_start != self._range_stop:
+            fseek(self._read_ptr, self._range_start, 0)
+            try:
+                while True:
+                    pos = ftell(self._read_ptr)
+                    type_code = getc(self._read_ptr)
+                    if type_code == 255 or type_code < 0:
+                        break
+                    _skip_tb_value(self._read_ptr, type_code)
+                    _skip_tb_value(self._read_ptr, getc(self._read_ptr))
+                    self._index_append(pos, &capacity)
+            finally:
+                fseek(self._read_ptr, prev_pos, 0)
+        self._has_index = 1
+
+    cdef _ensure_index(self):
+        self._check_mmap()
+        if not self._has_index:
+            self.build_index()
+
+    def save_index(self, index_fn=None):
+        """Write the record index to a sidecar file (use_mmap only)
+
+        Format: 'HTBIDX1\\n' <64-bit file size> <64-bit record count> <64-bit offset per record> (big endian)
+
+        :param index_fn: Path to write (default is fn + '.idx')
+        """
+        self._ensure_index()
+        if index_fn is None:
+            index_fn = self._fn + '.idx'
+        cdef Py_ssize_t x
+        cdef void *fp = fopen(index_fn, 'wb')
+        if fp == NULL:
+            raise IOError('Cannot open file [%s]' % index_fn)
+        try:
+            fwrite(<char *>'HTBIDX1\n', 8, 1, fp)
+            _write_long(fp, os.stat(self._fn).st_size)
+            _write_long(fp, self._index_size)
+            for x in range(self._index_size):
+                _write_long(fp, self._index[x])
+        finally:
+            fclose(fp)
+
+    def load_index(self, index_fn=None):
+        """Load a record index written by save_index (use_mmap only)
+
+        Only the records inside of byte_range are kept.
+
+        :param index_fn: Path to read (default is fn + '.idx')
+        :raises: IOError: If the index is missing, malformed, or for a different file size
+        """
+        self._check_mmap()
+        if index_fn is None:
+            index_fn = self._fn + '.idx'
+        cdef char magic[8]
+        cdef int64_t offset, x, num_records
+        cdef Py_ssize_t capacity = 0
+        cdef void *fp = fopen(index_fn, 'rb')
+        if fp == NULL:
+            raise IOError('Cannot open file [%s]' % index_fn)
+        try:
+            if fread(magic, 8, 1, fp) != 1 or PyString_FromStringAndSize(magic, 8) != 'HTBIDX1\n':
+                raise IOError('Not an index file [%s]' % index_fn)
+            if _read_long(fp) != os.stat(self._fn).st_size:
+                raise IOError('Index [%s] is for a different version of [%s]' % (index_fn, self._fn))
+            num_records = _read_long(fp)
+            free(self._index)
+            self._index, self._index_size, self._has_index = NULL, 0, 0
+            for x in range(num_records):
+                offset = _read_long(fp)
+                if self._range_start <= offset < self._range_stop:
+                    self._index_append(offset, &capacity)
+        except EOFError:
+            raise IOError('Truncated index file [%s]' % index_fn)
+        finally:
+            fclose(fp)
+        self._has_index = 1
+
+    def __len__(self):
+        """Number of records (use_mmap only, builds the index if needed)"""
+        if self.file_method != 'mmap':
+            raise TypeError('len() requires use_mmap=True')
+        self._ensure_index()
+        return self._index_size
+
+    def seek(self, Py_ssize_t num):
+        """Move to record num so that it is returned by the next read (use_mmap only, builds the index if needed)
+
+        :param num: Record number (negative values count from the end, len(self) is the end)
+        :raises: IndexError: If num is out of range
+        """
+        self._ensure_index()
+        if num < 0:
+            num += self._index_size
+        if num == self._index_size:
+            fseek(self._read_ptr, self._range_stop, 0)
+            return
+        if not 0 <= num < self._index_size:
+            raise IndexError('Record [%d] out of range' % num)
+        fseek(self._read_ptr, self._index[num], 0)
+
+    def split(self, int num_parts):
+        """Split into byte ranges with about the same size (use_mmap only, builds the index if needed)
+
+        Ranges start/stop on record boundaries and can be read in parallel by
+        TypedBytesFile(fn, use_mmap=True, byte_range=byte_range).
+
+        :param num_parts: Max number of ranges
+        :returns: List of (start, stop) byte offsets, empty ranges are dropped
+        """
+        self._ensure_index()
+        cdef Py_ssize_t lo, hi, mid, prev = 0, x
+        cdef int64_t target, start
+        out = []
+        for x in range(1, num_parts + 1):
+            if x == num_parts:
+                lo = self._index_size
+            else:
+                # First record starting at or after target
+                target = self._range_start + (self._range_stop - self._range_start) * x / num_parts
+                lo, hi = prev, self._index_size
+                while lo < hi:
+                    mid = (lo + hi) / 2
+                    if self._index[mid] < target:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+            if lo > prev:
+                start = self._index[prev]
+                out.append((start, self._index[lo] if lo < self._index_size else self._range_stop))
+                prev = lo
+        return out
+
     cdef _close(self):
-        self.flush()
-        if self.file_method == 'readwritefds':
+        try:
+            self.flush()
+        finally:
+            self._close_streams()
+        streams = self._read_stream, self._write_stream
+        self._read_stream = self._write_stream = None
+        for stream in streams:
+            if stream is not None and stream.error is not None:
+                raise stream.error
+
+    cdef _close_streams(self):
+        if self.file_method == 'mmap':
+            if self._read_ptr:
+                fclose(self._read_ptr)
+            self._mmap_buffer = None
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+        elif self.file_method == 'fn':
+            if self._read_ptr:
+                fclose(self._read_ptr)
+        elif self.file_method == 'readwritefds' or self.file_method == 'fileobj':
             if self._write_ptr:
                 fclose(self._write_ptr)
             if self._read_ptr:
@@ -581,6 +2473,11 @@ cdef class TypedBytesFile(object):
             fclose(self._write_ptr)
         self._write_ptr = NULL
         self._read_ptr = NULL
+        # Only after the stream using it is closed
+        free(self._write_buffer)
+        self._write_buffer = NULL
+        free(self._read_buffer)
+        self._read_buffer = NULL
 
     def __repr__(self):
         return self._repr
@@ -600,26 +2497,378 @@ cdef class TypedBytesFile(object):
     def __next__(self):
         if self._read_ptr == <void *>0:
             raise ValueError("Read pointer not set!")
-        return __read_key_value_tb(self._read_ptr)
+        try:
+            if self._read_key_schema is None and not self._read_ordered_keys:
+                return __read_key_value_tb(self._read_ptr)
+            k = self._next_key()
+            if self._read_value_schema is not None:
+                return k, _read_schema_item(self._read_ptr, self._read_value_schema)
+            return k, _read_tb_item(self._read_ptr)
+        except:
+            self._check_read()
+            raise
+
+    cdef int _check_read(self) except -1:
+        """Raise the exception of a failed read from _read_stream
+
+        stdio reports those as the end of the stream (see cookiefile.h), so
+        this is called whenever reading stops early.
+        """
+        if self._read_stream is not None and self._read_stream.error is not None:
+            raise self._read_stream.error
+        return 0
+
+    cdef _next_key(self):
+        """Read the next key using read_ordered_keys/read_schema"""
+        if self._read_ordered_keys:
+            return _read_ordered_key(self._read_ptr)
+        if self._read_key_schema is not None:
+            return _read_schema(self._read_ptr, self._read_key_schema)
+        return _read_tb_code(self._read_ptr)
+
+    cdef _write(self, kv):
+        if self._write_key_schema is None and not self._write_ordered_keys:
+            __write_key_value_tb(self._write_ptr, kv)
+            return
+        k, v = kv
+        if self._write_ordered_keys:
+            _write_ordered_key(self._write_ptr, k)
+        else:
+            _write_schema(self._write_ptr, self._write_key_schema, k)
+        if self._write_value_schema is not None:
+            _write_schema(self._write_ptr, self._write_value_schema, v)
+        else:
+            _write_tb_code(self._write_ptr, v)
 
-    def write(self, kv):
+    def read_key_raw_value(self, raw_key=False):
+        """Read the next KeyValue pair, the value is a RawValue
+
+        :param raw_key: If True, the key is a RawValue too (e.g., to sort by the encoded key as Hadoop does) (default False)
+        :returns: (key, RawValue)
+        :raises: StopIteration: At the end of the stream
+        """
+        if self._read_ptr == <void *>0:
+            raise ValueError("Read pointer not set!")
+        try:
+            k = _read_raw_value(self._read_ptr) if raw_key else self._next_key()
+            return k, _read_raw_value(self._read_ptr)
+        except:
+            self._check_read()
+            raise
+
+    cdef _read_key(self):
+        """Read the next key and skip its value"""
+        if self._read_ptr == <void *>0:
+            raise ValueError("Read pointer not set!")
+        try:
+            k = self._next_key()
+            _skip_tb_value(self._read_ptr, getc(self._read_ptr))
+            return k
+        except:
+            self._check_read()
+            raise
+
+    def read_batch(self, Py_ssize_t n, key_dtype=None, value_dtype=None):
+        """Decode up to n KeyValue pairs into numpy arrays
+
+        Numbers (TypedBytes byte, bool, int, long, float, double) are stored
+        directly in arrays of key_dtype/value_dtype without making Python
+        objects.  If any key/value isn't a number of the dtype's kind (e.g., a
+        str, a float for an int dtype) or doesn't fit it, that array is an
+        object array instead.
+
+        :param n: Max number of KeyValue pairs
+        :param key_dtype: bool, (u)int8-64, float32/64, or None/object for an object array (default None)
+        :param value_dtype: Same as key_dtype but for values (default None)
+        :returns: (keys, values) arrays, shorter than n at the end of the stream (empty once exhausted)
+        :raises: ImportError: If numpy isn't available
+        """
+        if np is None:
+            raise ImportError('read_batch requires numpy')
+        if self._read_ptr == <void *>0:
+            raise ValueError("Read pointer not set!")
+        cdef _ArrayColumn keys = _ArrayColumn(n, key_dtype)
+        cdef _ArrayColumn values = _ArrayColumn(n, value_dtype)
+        cdef Py_ssize_t x
+        cdef int type_code
+        try:
+            for x in range(n):
+                if self._read_ordered_keys:
+                    try:
+                        keys.append_value(_read_ordered_key(self._read_ptr))
+                    except StopIteration:
+                        break
+                else:
+                    type_code = getc(self._read_ptr)
+                    if type_code == 255 or type_code < 0:
+                        break
+                    keys.append(self._read_ptr, type_code)
+                type_code = getc(self._read_ptr)
+                if type_code == 255 or type_code < 0:
+                    raise EOFError('KeyValue pair missing its value')
+                values.append(self._read_ptr, type_code)
+        except:
+            self._check_read()
+            raise
+        self._check_read()
+        return keys.finish(), values.finish()
+
+    def write_arrays(self, keys, values):
+        """Write KeyValue pairs from arrays (e.g., from read_batch)
+
+        Elements of 1-D numeric arrays are encoded directly, anything else
+        (object arrays, sequences) uses the generic encoder per element.
+
+        :param keys: Array or sequence of keys
+        :param values: Array or sequence of values (same length as keys)
+        """
+        if np is None:
+            raise ImportError('write_arrays requires numpy')
         if self._write_ptr == <void *>0:
             raise ValueError("Write pointer not set!")
-        __write_key_value_tb(self._write_ptr, kv)
-        if self.flush_writes:
+        cdef _ArrayWriter key_writer = _ArrayWriter(keys)
+        cdef _ArrayWriter value_writer = _ArrayWriter(values)
+        cdef Py_ssize_t x, num = len(key_writer)
+        if num != len(value_writer):
+            raise ValueError('keys and values have different lengths (%d and %d)' % (num, len(value_writer)))
+        for x in range(num):
+            if self._write_ordered_keys:
+                _write_ordered_key(self._write_ptr, key_writer.get(x))
+            else:
+                key_writer.write(self._write_ptr, x)
+            value_writer.write(self._write_ptr, x)
+        self._wrote(num)
+
+    def iter_keys(self):
+        """Iterate over the remaining keys, values are skipped without being decoded
+
+        :returns: Iterator of keys
+        """
+        while True:
+            try:
+                k = self._read_key()
+            except StopIteration:
+                return
+            yield k
+
+    def iter_groups(self, raw_values=False):
+        """Iterate over runs of consecutive KeyValue pairs that have the same key (reducer input)
+
+        Keys are compared by their encoded bytes (as Hadoop groups them) and
+        each group's key is decoded once.  Values of a group that aren't
+        iterated over are skipped without being decoded.
+
+        :param raw_values: If True, values are RawValue (see read_key_raw_value) (default False)
+        :returns: Iterator of (key, values iterator)
+        """
+        return _KeyGroups(self, raw_values)
+
+    cdef _decode_key(self, char *data, size_t size):
+        """Decode an encoded key (from iter_groups) using read_ordered_keys/read_schema"""
+        cdef void *fp = fmemopen(data, size, 'r')
+        if fp == NULL:
+            raise MemoryError('Cannot open buffer for reading')
+        try:
+            if self._read_ordered_keys:
+                return _read_ordered_key(fp)
+            if self._read_key_schema is not None:
+                return _read_schema(fp, self._read_key_schema)
+            return _read_tb_code(fp)
+        finally:
+            fclose(fp)
+
+    cdef _read_value(self, int raw_value):
+        """Read the value of a KeyValue pair whose key has been read"""
+        if raw_value:
+            return _read_raw_value(self._read_ptr)
+        if self._read_value_schema is not None:
+            return _read_schema_item(self._read_ptr, self._read_value_schema)
+        return _read_tb_item(self._read_ptr)
+
+    cpdef Py_ssize_t skip(self, Py_ssize_t num=1) except -1:
+        """Skip KeyValue pairs without decoding them
+
+        :param num: Max number of KeyValue pairs to skip (default 1)
+        :returns: Number skipped (less than num at the end of the stream)
+        """
+        if self._read_ptr == <void *>0:
+            raise ValueError("Read pointer not set!")
+        cdef Py_ssize_t x
+        cdef int type_code
+        try:
+            for x in range(num):
+                type_code = getc(self._read_ptr)
+                if type_code == 255 or type_code < 0:
+                    self._check_read()
+                    return x
+                _skip_tb_value(self._read_ptr, type_code)
+                _skip_tb_value(self._read_ptr, getc(self._read_ptr))
+        except:
+            self._check_read()
+            raise
+        return num
+
+    def count(self):
+        """Count the remaining KeyValue pairs without decoding them (consumes them)
+
+        :returns: Number of KeyValue pairs
+        """
+        cdef Py_ssize_t out = 0, cur
+        while True:
+            cur = self.skip(1048576)
+            out += cur
+            if cur < 1048576:
+                return out
+
+    cdef _wrote(self, Py_ssize_t num):
+        """Flush if the flush policy (flush_writes/flush_interval) says to"""
+        self._unflushed += num
+        if self.flush_writes and self._unflushed >= self.flush_writes:
+            self.flush()
+        elif self._flush_interval and time.time() - self._last_flush >= self._flush_interval:
             self.flush()
 
+    def write(self, kv):
+        if self._write_ptr == <void *>0:
+            raise ValueError("Write pointer not set!")
+        self._write(kv)
+        self._wrote(1)
+
     def writes(self, kvs):
         if self._write_ptr == <void *>0:
             raise ValueError("Write pointer not set!")
+        cdef Py_ssize_t num = 0
         for kv in kvs:
-            __write_key_value_tb(self._write_ptr, kv)
-        if self.flush_writes:
-            self.flush()
+            self._write(kv)
+            num += 1
+        self._wrote(num)
 
     cpdef flush(self):
         if self._write_ptr:
             fflush(self._write_ptr)
+            if self._write_stream is not None:
+                self._write_stream.flush()
+        self._unflushed = 0
+        if self._flush_interval:
+            self._last_flush = time.time()
 
     def close(self):
         self._close()
+
+
+cdef class _KeyGroups
+
+
+cdef class _GroupValues(object):
+    """Values of one group from TypedBytesFile.iter_groups"""
+    cdef _KeyGroups groups
+    cdef int done
+
+    def __cinit__(self, _KeyGroups groups):
+        self.groups = groups
+        self.done = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.done or self.groups.group is not self or not self.groups.advance():
+            self.done = 1
+            raise StopIteration
+        self.groups.has_value = 0
+        try:
+            return self.groups.fp._read_value(self.groups.raw_values)
+        except:
+            self.groups.fp._check_read()
+            raise
+
+
+cdef class _KeyGroups(object):
+    """Groups the KeyValue pairs of a TypedBytesFile by their encoded keys
+
+    The encoded keys are read into two reusable buffers, the current
+    group's key and the last one read, so values are streamed without
+    decoding (or allocating) their keys.
+    """
+    cdef TypedBytesFile fp
+    cdef int raw_values
+    cdef _RawBuffer key  # Encoded key of the current group
+    cdef _RawBuffer scan  # Encoded key last read
+    cdef int has_value  # The next value in fp belongs to the current group
+    cdef int pending  # scan holds the key of the next group (its value is next in fp)
+    cdef int done
+    cdef _GroupValues group
+
+    def __cinit__(self, TypedBytesFile fp, raw_values=False):
+        self.fp = fp
+        self.raw_values = int(raw_values)
+        self.key.data, self.key.size, self.key.capacity = NULL, 0, 0
+        self.scan.data, self.scan.size, self.scan.capacity = NULL, 0, 0
+        self.has_value = self.pending = self.done = 0
+
+    def __dealloc__(self):
+        free(self.key.data)
+        free(self.scan.data)
+
+    cdef int read_key(self) except -1:
+        """Read the next encoded key into scan
+
+        Returns:
+            0 at the end of the stream, else 1
+        """
+        cdef void *ptr = self.fp._read_ptr
+        if ptr == <void *>0:
+            raise ValueError("Read pointer not set!")
+        cdef int type_code = getc(ptr)
+        if type_code == 255 or type_code < 0:
+            self.done = 1
+            self.fp._check_read()
+            return 0
+        self.scan.size = 0
+        try:
+            _read_raw_tb_value(ptr, &self.scan, type_code)
+        except:
+            self.fp._check_read()
+            raise
+        return 1
+
+    cdef int advance(self) except -1:
+        """Move to the next value of the current group
+
+        Returns:
+            1 if the next value in fp belongs to the current group, else 0
+        """
+        if self.has_value:
+            return 1
+        if self.pending or self.done or not self.read_key():
+            return 0
+        if self.scan.size == self.key.size and memcmp(self.scan.data, self.key.data, self.key.size) == 0:
+            self.has_value = 1
+            return 1
+        self.pending = 1
+        return 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        cdef _RawBuffer tmp
+        # Skip what's left of the current group
+        if self.group is not None:
+            while self.advance():
+                try:
+                    _skip_tb_value(self.fp._read_ptr, getc(self.fp._read_ptr))
+                except:
+                    self.fp._check_read()
+                    raise
+                self.has_value = 0
+            self.group.done = 1
+        if not self.pending and (self.done or not self.read_key()):
+            raise StopIteration
+        tmp = self.key
+        self.key = self.scan
+        self.scan = tmp
+        self.pending, self.has_value = 0, 1
+        k = self.fp._decode_key(self.key.data, self.key.size)
+        self.group = _GroupValues(self)
+        return k, self.group
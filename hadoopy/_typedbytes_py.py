@@ -0,0 +1,1372 @@
+#!/usr/bin/env python
+# (C) Copyright 2010 Brandyn A. White
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Pure-Python TypedBytes codec, see _typedbytes.pyx for the format
+
+Used instead of the C extension under PyPy (where cpyext makes the extension
+slow and the JIT makes this fast) or when the extension isn't built, see
+_native.py.  Input is read in large blocks and decoded with
+struct.unpack_from at an offset, output is joined into large blocks.
+
+Differences from the extension: read_schema/write_schema are validated
+but the generic codec is used (the output is the same), and with use_mmap
+the mapping is released when the reader is collected (close drops it).
+"""
+
+__author__ = 'Brandyn A. White <bwhite@cs.umd.edu>'
+__license__ = 'GPL V3'
+
+import bisect
+import cPickle as pickle
+import datetime
+import decimal
+import gzip
+import math
+import mmap
+import numbers
+import os
+import struct
+import sys
+import time
+import types
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_INT = struct.Struct('>i')
+_LONG = struct.Struct('>q')
+_FLOAT = struct.Struct('>f')
+_DOUBLE = struct.Struct('>d')
+_BYTE = struct.Struct('>b')
+_CODES = [chr(x) for x in range(256)]
+_EPOCH = datetime.datetime(1970, 1, 1)
+_java_compatible = False
+_compact_ints = False
+
+
+def set_java_compatible(enabled):
+    """Only use types that Java TypedBytesWritable can interpret (see _typedbytes.pyx)
+
+    :param enabled: If True use standard types where possible (default is False)
+    """
+    global _java_compatible
+    _java_compatible = bool(enabled)
+
+
+def set_compact_ints(enabled):
+    """Write each int/long with the smallest integer type it fits in (see _typedbytes.pyx)
+
+    :param enabled: If True use the smallest integer type (default is False)
+    """
+    global _compact_ints
+    _compact_ints = bool(enabled)
+
+
+# 0: _write_bytes unused
+# 1: _write_byte unused
+# 5: _write_float unused
+_out_types = {types.BooleanType: 2,
+              types.IntType: 3,
+              types.LongType: 4,
+              types.FloatType: 6,
+              types.StringType: 0,
+              types.UnicodeType: 7,
+              types.TupleType: 8,
+              types.ListType: 9,
+              types.DictType: 10,
+              types.NoneType: 102,
+              set: 103,
+              frozenset: 104,
+              datetime.datetime: 105,
+              decimal.Decimal: 106}
+if np is not None:
+    _out_types[np.ndarray] = 101
+_resolved_types = {}  # type: type_code, memoized _resolve_type_code results
+_custom_encoders = {}  # type_code: encode
+_custom_decoders = {}  # type_code: decode
+_builtin_codes = frozenset(range(11) + range(100, 108))
+
+
+def register_type(type_code, py_type, encode, decode):
+    """Use a custom type code for a Python type instead of pickling it (see _typedbytes.pyx)
+
+    :param type_code: Type code (int) in [50, 200] excluding those used by hadoopy (100-107)
+    :param py_type: Python type to encode (exact type, not subclasses)
+    :param encode: Function taking a value of py_type and returning a string
+    :param decode: Function taking a string and returning a value
+    :raises: ValueError: If type_code or py_type are reserved or already registered
+    """
+    type_code = int(type_code)
+    if not 50 <= type_code <= 200 or type_code in _builtin_codes:
+        raise ValueError('Custom type codes must be in [50, 200] and not used by hadoopy, got [%d]' % type_code)
+    prev_code = _out_types.get(py_type)
+    if prev_code is not None and prev_code != type_code:
+        raise ValueError('Type [%s] already uses type code [%d]' % (py_type, prev_code))
+    if type_code in _custom_encoders and prev_code is None:
+        raise ValueError('Type code [%d] is already registered' % type_code)
+    _out_types[py_type] = type_code
+    _resolved_types.clear()
+    _custom_encoders[type_code] = encode
+    _custom_decoders[type_code] = decode
+
+
+# Checked in order by _resolve_type_code for types missing from _out_types
+_subclass_types = ((types.IntType, 3),
+                   (types.LongType, 4),
+                   (types.FloatType, 6),
+                   (types.StringType, 0),
+                   (types.UnicodeType, 7),
+                   (types.TupleType, 8),
+                   (types.ListType, 9),
+                   (types.DictType, 10))
+
+
+def _resolve_type_code(val_type):
+    """Find the type code for a type that isn't in _out_types (memoized)"""
+    code = _resolved_types.get(val_type)
+    if code is not None:
+        return code
+    code = 100
+    # Numpy strings (np.str_, np.unicode_) are str/unicode subclasses
+    if np is not None and issubclass(val_type, np.generic) and not issubclass(val_type, basestring):
+        if issubclass(val_type, np.bool_):
+            code = 2
+        elif issubclass(val_type, np.integer):
+            code = 3
+        elif issubclass(val_type, (np.float16, np.float32)):
+            code = 5
+        elif issubclass(val_type, np.float64):
+            code = 6
+    else:
+        for base_type, base_code in _subclass_types:
+            if issubclass(val_type, base_type):
+                code = base_code
+                break
+    _resolved_types[val_type] = code
+    return code
+
+
+class RawValue(object):
+    """TypedBytes value that keeps its encoding and is decoded on first use
+
+    When a RawValue is written it is copied verbatim (it is not re-encoded).
+
+    :param raw: Encoded value including its type code (str)
+    """
+    __slots__ = ('raw', '_value', '_decoded')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._decoded = False
+
+    @property
+    def value(self):
+        """Decoded value (cached)"""
+        if not self._decoded:
+            self._value = loads(self.raw)
+            self._decoded = True
+        return self._value
+
+    def __repr__(self):
+        return 'RawValue(%r)' % self.raw
+
+    def __reduce__(self):
+        return RawValue, (self.raw,)
+
+
+_out_types[RawValue] = 256  # Not a TypedBytes code, see _Encoder.value
+
+
+class _Decoder(object):
+    """Decodes values from a string that is refilled by read(size) as needed
+
+    Bytes before pos are dropped on refill (unless marked, see raw_value).
+    With view_size set, bytes values of at least that many bytes are views of
+    view_buf (which data must be a copy of).
+    """
+
+    def __init__(self, data='', read=None, block_size=1048576, view_buf=None, view_size=None):
+        self.data = data
+        self.pos = 0
+        self.mark = -1
+        self._read = read
+        self._block_size = block_size
+        self._view_buf = view_buf
+        self._view_size = view_size
+
+    def _fill(self, size):
+        """Make size bytes available at pos
+
+        :returns: False if the stream ended first
+        """
+        if self._read is None:
+            return False
+        start = self.pos if self.mark < 0 else self.mark
+        chunks = [self.data[start:]]
+        avail = len(self.data) - self.pos
+        done = False
+        while avail < size:
+            chunk = self._read(max(self._block_size, size - avail))
+            if not chunk:
+                done = True
+                break
+            chunks.append(chunk)
+            avail += len(chunk)
+        self.data = ''.join(chunks)
+        self.pos -= start
+        if self.mark >= 0:
+            self.mark -= start
+        return not done
+
+    def take(self, size):
+        """Returns: The next size bytes"""
+        if size < 0:
+            raise ValueError('Bad TypedBytes size %d' % size)
+        pos = self.pos
+        if pos + size > len(self.data):
+            if not self._fill(size):
+                raise EOFError('Truncated TypedBytes value')
+            pos = self.pos
+        self.pos = pos + size
+        return self.data[pos:pos + size]
+
+    def unpack(self, fmt, size):
+        pos = self.pos
+        if pos + size > len(self.data):
+            if not self._fill(size):
+                raise EOFError('Truncated TypedBytes value')
+            pos = self.pos
+        self.pos = pos + size
+        return fmt.unpack_from(self.data, pos)[0]
+
+    def code(self):
+        """Returns: The next type code, -1 at the end of the stream"""
+        pos = self.pos
+        if pos >= len(self.data):
+            if not self._fill(1):
+                return -1
+            pos = self.pos
+        self.pos = pos + 1
+        return ord(self.data[pos])
+
+    def sized(self):
+        return self.take(self.unpack(_INT, 4))
+
+    def next_value(self):
+        """Returns: The next value
+
+        :raises: StopIteration: At the end of the stream (or of a list)
+        """
+        code = self.code()
+        if code == 255 or code < 0:
+            raise StopIteration
+        return self.value(code)
+
+    def item(self):
+        """Returns: The next value, which must be present (in a container or a KeyValue pair)
+
+        :raises: EOFError: At the end of the stream
+        """
+        code = self.code()
+        if code < 0:
+            raise EOFError('Truncated TypedBytes value')
+        return self.value(code)
+
+    def value(self, code):
+        """Returns: The value that follows code (which has already been read)"""
+        if code == 0:
+            if self._view_size is None:
+                return self.sized()
+            return self._bytes_view()
+        if code == 3:
+            return self.unpack(_INT, 4)
+        if code == 4:
+            return self.unpack(_LONG, 8)
+        if code == 6:
+            return self.unpack(_DOUBLE, 8)
+        if code == 7:
+            try:
+                return self.sized().decode('utf-8')
+            except UnicodeError:
+                raise UnicodeError('Error decoding unicode string.  See hadoopy.com for details on TypedBytes encoding.')
+        if code == 8:
+            size = self.unpack(_INT, 4)
+            if size < 0:
+                raise ValueError('Bad vector size %d' % size)
+            return tuple([self.item() for x in xrange(size)])
+        if code == 9:
+            out = []
+            code = self.code()
+            while code != 255 and code >= 0:
+                out.append(self.value(code))
+                code = self.code()
+            return out
+        if code == 10:
+            out = {}
+            for x in xrange(self.unpack(_INT, 4)):
+                k = self.item()
+                out[k] = self.item()
+            return out
+        if code == 1:
+            return self.unpack(_BYTE, 1)
+        if code == 2:
+            return bool(self.unpack(_BYTE, 1))
+        if code == 5:
+            return self.unpack(_FLOAT, 4)
+        if code == 100:
+            return pickle.loads(self.sized())
+        if code == 101:
+            return self._ndarray()
+        if code == 102:
+            self.unpack(_INT, 4)
+            return None
+        if code == 103 or code == 104:
+            self.unpack(_INT, 4)
+            val = self.item()
+            return set(val) if code == 103 else frozenset(val)
+        if code == 105:
+            self.unpack(_INT, 4)
+            return _EPOCH + datetime.timedelta(0, 0, self.unpack(_LONG, 8))
+        if code == 106:
+            return decimal.Decimal(self.sized())
+        if code == 107:
+            data = self.sized()
+            if not data:
+                raise ValueError('Bad integer size 0')
+            val = long(data[1:].encode('hex') or '0', 16)
+            return -val if data[0] != '\x00' else val
+        try:
+            decode = _custom_decoders[code]
+        except KeyError:
+            raise IndexError('Bad index %d ' % code)
+        return decode(self.sized())
+
+    def _bytes_view(self):
+        size = self.unpack(_INT, 4)
+        if size < self._view_size:
+            return self.take(size)
+        start = self.pos
+        self.take(size)
+        try:
+            return memoryview(self._view_buf)[start:start + size]
+        except TypeError:  # Old-style buffer (mmap, buffer)
+            return buffer(self._view_buf, start, size)
+
+    def _ndarray(self):
+        size = self.unpack(_INT, 4)
+        dtype = self.sized()
+        ndim = self.unpack(_INT, 4)
+        shape = tuple([self.unpack(_LONG, 8) for x in xrange(ndim)])
+        data = bytearray(self.take(size - (4 + len(dtype) + 4 + 8 * ndim)))
+        if np is None:
+            raise ImportError('Numpy is required to read ndarray values')
+        return np.frombuffer(data, dtype).reshape(shape)
+
+    def skip(self, code):
+        """Move past the value that follows code without decoding it"""
+        if code == 0 or code == 7 or 50 <= code <= 200:
+            self.take(self.unpack(_INT, 4))
+        elif code == 1 or code == 2:
+            self.take(1)
+        elif code == 3 or code == 5:
+            self.take(4)
+        elif code == 4 or code == 6:
+            self.take(8)
+        elif code == 8 or code == 10:
+            size = self.unpack(_INT, 4)
+            if size < 0:
+                raise ValueError('Bad TypedBytes size %d' % size)
+            for x in xrange(size * 2 if code == 10 else size):
+                self.skip(self.code())
+        elif code == 9:
+            code = self.code()
+            while code != 255:
+                self.skip(code)
+                code = self.code()
+        elif code < 0:
+            raise EOFError('Truncated TypedBytes value')
+        else:
+            raise IndexError('Bad index %d ' % code)
+
+    def raw_value(self):
+        """Returns: The next value as a RawValue
+
+        :raises: StopIteration: At the end of the stream
+        """
+        self.mark = self.pos
+        try:
+            code = self.code()
+            if code == 255 or code < 0:
+                raise StopIteration
+            self.skip(code)
+            return RawValue(self.data[self.mark:self.pos])
+        finally:
+            self.mark = -1
+
+
+def _is_raw_ndarray(val):
+    """True if val can be written as code 101, else it is pickled (see _typedbytes.pyx)"""
+    dtype = val.dtype
+    if dtype.hasobject or dtype.names is not None or dtype.kind in 'Mm':
+        return False
+    try:
+        memoryview(val)
+    except (ValueError, TypeError, BufferError):
+        return False
+    return True
+
+
+class _Encoder(object):
+    """Encodes values into a list of strings (out), size is their total length"""
+
+    def __init__(self):
+        self.out = []
+        self.size = 0
+
+    def take(self):
+        """Returns: Everything encoded so far as a string (and clears it)"""
+        data = ''.join(self.out)
+        self.out = []
+        self.size = 0
+        return data
+
+    def put(self, data):
+        self.out.append(data)
+        self.size += len(data)
+
+    def sized(self, data):
+        self.out.append(_INT.pack(len(data)))
+        self.out.append(data)
+        self.size += 4 + len(data)
+
+    def value(self, val):
+        val_type = type(val)
+        code = _out_types.get(val_type)
+        if code is None:
+            code = _resolve_type_code(val_type)
+        if code == 3 and not -2147483648 <= val <= 2147483647:
+            code = 4
+        if code == 4 and not -9223372036854775808L <= val <= 9223372036854775807L:
+            code = 107
+        if _compact_ints and (code == 3 or code == 4):
+            code = 1 if -128 <= val <= 127 else 3 if -2147483648 <= val <= 2147483647 else 4
+        if code == 256:
+            return self.put(val.raw)
+        if code == 101 and not _is_raw_ndarray(val):
+            code = 100
+        if code == 105 and val.tzinfo is not None:
+            code = 100
+        if _java_compatible and 103 <= code <= 106:
+            if code == 103:
+                val = list(val)
+            elif code == 104:
+                val = tuple(val)
+            else:
+                val = unicode(val.isoformat() if code == 105 else val)
+            code = _out_types[type(val)]
+        self.put(_CODES[code])
+        if code == 0:
+            self.sized(val)
+        elif code == 3:
+            self.put(_INT.pack(val))
+        elif code == 4:
+            self.put(_LONG.pack(val))
+        elif code == 6:
+            self.put(_DOUBLE.pack(val))
+        elif code == 7:
+            self.sized(val.encode('utf-8'))
+        elif code == 8:
+            self.put(_INT.pack(len(val)))
+            for x in val:
+                self.value(x)
+        elif code == 9:
+            for x in val:
+                self.value(x)
+            self.put('\xff')
+        elif code == 10:
+            self.put(_INT.pack(len(val)))
+            for x, y in val.iteritems():
+                self.value(x)
+                self.value(y)
+        elif code == 1:
+            self.put(_BYTE.pack(val))
+        elif code == 2:
+            self.put('\x01' if val else '\x00')
+        elif code == 5:
+            self.put(_FLOAT.pack(val))
+        elif code == 100:
+            self.sized(pickle.dumps(val, -1))
+        elif code == 101:
+            self._ndarray(val)
+        elif code == 102:
+            self.put('\x00\x00\x00\x00')
+        elif code == 103 or code == 104:
+            self.sized(_dumps(tuple(val), False, False))
+        elif code == 105:
+            delta = val - _EPOCH
+            self.put('\x00\x00\x00\x08')
+            self.put(_LONG.pack((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds))
+        elif code == 106:
+            self.sized(str(val))
+        elif code == 107:
+            magnitude = -val if val < 0 else val
+            data = '%x' % magnitude
+            self.sized(('\x01' if val < 0 else '\x00') + ('0' * (len(data) % 2) + data).decode('hex'))
+        else:
+            self.sized(_custom_encoders[code](val))
+
+    def _ndarray(self, val):
+        if not val.flags.c_contiguous:
+            val = val.copy()
+        dtype = val.dtype.str
+        data = val.tostring()
+        self.put(_INT.pack(4 + len(dtype) + 4 + 8 * val.ndim + len(data)))
+        self.sized(dtype)
+        self.put(_INT.pack(val.ndim))
+        for x in val.shape:
+            self.put(_LONG.pack(x))
+        self.put(data)
+
+
+# Order-preserving key encoding, see _typedbytes.pyx for the format
+_ORD_NONE = 1
+_ORD_NEG_INF = 2
+_ORD_NEG = 3
+_ORD_ZERO = 4
+_ORD_POS = 5
+_ORD_POS_INF = 6
+_ORD_NAN = 7
+_ORD_LIST = 16
+_ORD_TEXT = 17
+_ORD_TUPLE = 18
+_ORD_INT = 0
+_ORD_FLOAT = 1
+_ORD_BOOL = 2
+_ORD_STR = 0
+_ORD_UNICODE = 1
+
+
+def _encode_ordered_number(val, out):
+    if type(val) is bool:
+        kind, val = _ORD_BOOL, int(val)
+    elif isinstance(val, numbers.Integral):
+        kind, val = _ORD_INT, long(val)
+    else:
+        kind, val = _ORD_FLOAT, float(val)
+    if val != val:
+        out.append(_ORD_NAN)
+    elif val == 0:
+        out.append(_ORD_ZERO)
+    elif kind == _ORD_FLOAT and math.isinf(val):
+        out.append(_ORD_POS_INF if val > 0 else _ORD_NEG_INF)
+    else:
+        tag, invert = (_ORD_NEG, 255) if val < 0 else (_ORD_POS, 0)
+        val = abs(val)
+        if kind == _ORD_FLOAT:
+            fraction, exponent = math.frexp(val)
+            fraction, num_bits = long(fraction * 2 ** 53) - 2 ** 52, 52
+        else:
+            exponent = val.bit_length()
+            fraction, num_bits = val - (1L << (exponent - 1)), exponent - 1
+        if fraction:
+            x = (fraction & -fraction).bit_length() - 1
+            fraction, num_bits = fraction >> x, num_bits - x
+        else:
+            num_bits = 0
+        num_groups = max(1, (num_bits + 6) // 7)
+        fraction <<= 7 * num_groups - num_bits
+        out.append(tag)
+        exponent += 2 ** 31
+        for x in range(24, -8, -8):
+            out.append(((exponent >> x) & 255) ^ invert)
+        for x in range(num_groups - 1, -1, -1):
+            out.append((((fraction >> (7 * x)) & 127) << 1 | (x > 0)) ^ invert)
+    out.append(kind)
+
+
+def _encode_ordered(val, out):
+    if val is None:
+        out.append(_ORD_NONE)
+    elif isinstance(val, str):
+        out.append(_ORD_TEXT)
+        out.extend(val.replace('\x00', '\x00\xff'))
+        out.extend('\x00\x01')
+        out.append(_ORD_STR)
+    elif isinstance(val, unicode):
+        out.append(_ORD_TEXT)
+        out.extend(val.encode('utf-8').replace('\x00', '\x00\xff'))
+        out.extend('\x00\x01')
+        out.append(_ORD_UNICODE)
+    elif isinstance(val, (tuple, list)):
+        out.append(_ORD_TUPLE if isinstance(val, tuple) else _ORD_LIST)
+        for x in val:
+            _encode_ordered(x, out)
+        out.append(0)
+    elif isinstance(val, numbers.Real):
+        _encode_ordered_number(val, out)
+    else:
+        raise TypeError('Ordered keys must be None, numbers, str, unicode, tuples or lists, got [%s]' % type(val))
+
+
+def _decode_ordered(data, pos):
+    """Returns: (value at pos, position after it)"""
+    size = len(data)
+    if pos >= size:
+        raise ValueError('Truncated ordered key')
+    tag = ord(data[pos])
+    pos += 1
+    if tag == _ORD_NONE:
+        return None, pos
+    if tag == _ORD_TEXT:
+        end = data.find('\x00\x01', pos)
+        if end < 0 or end + 2 >= size:
+            raise ValueError('Truncated ordered key')
+        val = data[pos:end].replace('\x00\xff', '\x00')
+        kind = ord(data[end + 2])
+        if kind == _ORD_UNICODE:
+            return val.decode('utf-8'), end + 3
+        if kind != _ORD_STR:
+            raise ValueError('Bad ordered key text kind %d' % kind)
+        return val, end + 3
+    if tag == _ORD_TUPLE or tag == _ORD_LIST:
+        out = []
+        while pos < size and data[pos] != '\x00':
+            val, pos = _decode_ordered(data, pos)
+            out.append(val)
+        return (tuple(out) if tag == _ORD_TUPLE else out), pos + 1
+    if not _ORD_NEG_INF <= tag <= _ORD_NAN:
+        raise ValueError('Bad ordered key tag %d' % tag)
+    if tag == _ORD_NEG or tag == _ORD_POS:
+        if pos + 5 > size:
+            raise ValueError('Truncated ordered key')
+        invert = 255 if tag == _ORD_NEG else 0
+        exponent = 0
+        for x in range(4):
+            exponent = exponent << 8 | (ord(data[pos + x]) ^ invert)
+        exponent -= 2 ** 31
+        pos += 4
+        fraction, num_bits = 0L, 0
+        while True:
+            if pos >= size:
+                raise ValueError('Truncated ordered key')
+            group = ord(data[pos]) ^ invert
+            pos += 1
+            fraction, num_bits = fraction << 7 | group >> 1, num_bits + 7
+            if not group & 1:
+                break
+        mantissa, shift = (1L << num_bits) | fraction, exponent - 1 - num_bits
+    if pos >= size:
+        raise ValueError('Truncated ordered key')
+    kind = ord(data[pos])
+    pos += 1
+    if tag == _ORD_NAN:
+        return float('nan'), pos
+    if tag == _ORD_POS_INF or tag == _ORD_NEG_INF:
+        return float('inf') if tag == _ORD_POS_INF else float('-inf'), pos
+    if tag == _ORD_ZERO:
+        val = 0
+    elif kind == _ORD_FLOAT:
+        val = math.ldexp(float(mantissa), shift)
+    else:
+        val = int(mantissa << shift if shift >= 0 else mantissa >> -shift)
+    if tag == _ORD_NEG:
+        val = -val
+    if kind == _ORD_FLOAT:
+        return float(val), pos
+    return (bool(val) if kind == _ORD_BOOL else val), pos
+
+
+def _write_ordered_key(enc, val):
+    """Encode key val as a TypedBytes list of longs (see _typedbytes.pyx)"""
+    out = bytearray()
+    _encode_ordered(val, out)
+    out.extend('\x00' * (-len(out) % 8))
+    out = str(out)
+    enc.put('\x09')
+    for x in xrange(0, len(out), 8):
+        enc.put('\x04')
+        enc.put(out[x:x + 8])
+    enc.put('\xff')
+
+
+def _read_ordered_key(dec):
+    """Read a key written by _write_ordered_key (other keys are read normally)"""
+    code = dec.code()
+    if code == 255 or code < 0:
+        raise StopIteration
+    if code != 9:
+        return dec.value(code)
+    chunks = []
+    while True:
+        code = dec.code()
+        if code == 255:
+            break
+        if code < 0:
+            raise EOFError('Truncated TypedBytes value')
+        if code == 4:
+            chunks.append(dec.take(8))
+            continue
+        # Re-encoded by a generic writer (e.g., launch_local's sort), the longs may come back as smaller ints
+        val = dec.value(code)
+        if not isinstance(val, numbers.Integral):
+            raise ValueError('Bad ordered key element type %d' % code)
+        chunks.append(_LONG.pack(val))
+    return _decode_ordered(''.join(chunks), 0)[0]
+
+
+def _as_str(buf):
+    if isinstance(buf, str):
+        return buf
+    if isinstance(buf, memoryview):
+        return buf.tobytes()
+    if isinstance(buf, mmap.mmap):
+        return buf[:]
+    return str(buffer(buf))
+
+
+def loads(buf, offset=0, view_size=None, ordered=False):
+    """Decode one TypedBytes value from a buffer
+
+    :param buf: Object supporting the buffer protocol (str, bytearray, memoryview, mmap)
+    :param offset: Byte offset of the value in buf (default 0)
+    :param view_size: If not None, bytes values of at least this many bytes are returned as views of buf (memoryview or buffer) instead of copies (default None)
+    :param ordered: If True, the value uses the order-preserving key encoding (see dumps) (default False)
+    :returns: Python object
+    :raises: EOFError: If there is no value at offset
+    """
+    dec = _Decoder(_as_str(buf), view_buf=buf, view_size=view_size)
+    dec.pos = offset
+    try:
+        if ordered:
+            return _read_ordered_key(dec)
+        return dec.next_value()
+    except StopIteration:
+        raise EOFError('No value at offset [%d]' % offset)
+
+
+def loads_kvs(buf, offset=0, view_size=None, ordered_keys=False):
+    """Decode all KeyValue pairs from a buffer
+
+    :param buf: Object supporting the buffer protocol (str, bytearray, memoryview, mmap)
+    :param offset: Byte offset of the first pair in buf (default 0)
+    :param view_size: If not None, bytes values of at least this many bytes are returned as views of buf (memoryview or buffer) instead of copies (default None)
+    :param ordered_keys: If True, keys use the order-preserving encoding (see dumps) (default False)
+    :returns: List of (key, value)
+    """
+    dec = _Decoder(_as_str(buf), view_buf=buf, view_size=view_size)
+    dec.pos = offset
+    out = []
+    while True:
+        try:
+            k = _read_ordered_key(dec) if ordered_keys else dec.next_value()
+            out.append((k, dec.item()))
+        except StopIteration:
+            return out
+
+
+def _dumps(val, is_kvs, ordered):
+    enc = _Encoder()
+    if is_kvs:
+        for k, v in val:
+            if ordered:
+                _write_ordered_key(enc, k)
+            else:
+                enc.value(k)
+            enc.value(v)
+    elif ordered:
+        _write_ordered_key(enc, val)
+    else:
+        enc.value(val)
+    return enc.take()
+
+
+def dumps(val, ordered=False):
+    """Encode one value as TypedBytes
+
+    :param val: Python object
+    :param ordered: If True, use the order-preserving key encoding (default False)
+    :returns: Python string of bytes
+    """
+    return _dumps(val, False, ordered)
+
+
+def dumps_kvs(kvs, ordered_keys=False):
+    """Encode KeyValue pairs as TypedBytes (the same format as TypedBytesFile)
+
+    :param kvs: Iterator of (key, value)
+    :param ordered_keys: If True, keys use the order-preserving encoding (see dumps) (default False)
+    :returns: Python string of bytes
+    """
+    return _dumps(kvs, True, ordered_keys)
+
+
+def _fd_writer(fd):
+    """Returns: Function that writes all of a string to fd"""
+    def write(data):
+        num_written = os.write(fd, data)
+        while num_written < len(data):
+            num_written += os.write(fd, buffer(data, num_written))
+    return write
+
+
+def _check_schema(spec):
+    """Validate a schema spec for one value (see _compile_schema in _typedbytes.pyx)
+
+    :raises: ValueError: If the spec is malformed
+    """
+    if isinstance(spec, tuple):
+        for x in spec:
+            _check_schema(x)
+    elif isinstance(spec, list):
+        if len(spec) != 1:
+            raise ValueError('List schemas must have one item spec, got [%r]' % (spec,))
+        _check_schema(spec[0])
+    elif isinstance(spec, dict):
+        if len(spec) != 1:
+            raise ValueError('Dict schemas must have one key/value spec, got [%r]' % (spec,))
+        map(_check_schema, spec.items()[0])
+    elif not isinstance(spec, type):
+        raise ValueError('Schema specs must be types, tuples, lists, or dicts, got [%r]' % (spec,))
+
+
+def _check_kv_schema(schema):
+    """Validate a (key_spec, value_spec) pair, None is allowed"""
+    if schema is None:
+        return
+    key_spec, value_spec = schema
+    _check_schema(key_spec)
+    _check_schema(value_spec)
+
+
+def _array_items(arr):
+    """Returns: List of the elements of arr, float32 stays float32 (written as float, not double)"""
+    if not isinstance(arr, np.ndarray):
+        return list(arr)
+    if arr.ndim == 1 and arr.dtype == np.float32:
+        return list(arr)
+    return arr.tolist()
+
+
+def _array_dtype(dtype):
+    """Returns: Numpy dtype that read_batch can store directly, None for object arrays"""
+    if dtype is None:
+        return None
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'O':
+        return None
+    if not ((dtype.kind in 'iu' and dtype.itemsize in (1, 2, 4, 8)) or (dtype.kind == 'f' and dtype.itemsize in (4, 8))
+            or dtype.kind == 'b'):
+        raise ValueError('Unsupported dtype [%s], use bool, (u)int8-64, float32/64, or object' % dtype)
+    if not dtype.isnative:
+        raise ValueError('Dtype [%s] must have native byte order' % dtype)
+    return dtype
+
+
+def _to_array(vals, dtype):
+    """Returns: Array of dtype if every value is a number of its kind that fits, else an object array"""
+    if dtype is not None:
+        if dtype.kind == 'b':
+            fits = all(type(x) is bool for x in vals)
+        elif dtype.kind == 'f':
+            # Ints must be represented exactly (e.g., not above 2**53 for float64)
+            fits = all(type(x) is float or (type(x) in (int, long) and float(dtype.type(x)) == x) for x in vals)
+        else:
+            info = np.iinfo(dtype)
+            fits = all(type(x) in (int, long) and info.min <= x <= info.max for x in vals)
+        if fits:
+            return np.array(vals, dtype=dtype)
+    out = np.empty(len(vals), dtype=object)
+    for x, val in enumerate(vals):
+        out[x] = val
+    return out
+
+
+class TypedBytesFile(object):
+    """TypedBytes interface (pure Python, see _typedbytes.pyx for the parameters)
+
+    read_schema/write_schema are validated but don't change anything, and
+    unbuffered_reads is implied (fd reads return what is available).
+    """
+
+    def __init__(self, fn=None, mode=None, read_fd=None, write_fd=None, flush_writes=False, unbuffered_reads=False,
+                 read_schema=None, write_schema=None, use_mmap=False, byte_range=None, flush_interval=None,
+                 write_buffer_size=1048576, background_io=False, compression=None, compression_level=6,
+                 fileobj=None, read_buffer_size=1048576, read_ordered_keys=False, write_ordered_keys=False):
+        _check_kv_schema(read_schema)
+        _check_kv_schema(write_schema)
+        self._dec = self._enc = None
+        self._write_func = self._flush_func = None
+        self._mmap = self._index = None
+        self._to_close = []  # Closed in order by close
+        self._fds = []  # os.close'd by close
+        self.flush_writes = int(flush_writes)
+        self._read_ordered_keys = bool(read_ordered_keys)
+        self._write_ordered_keys = bool(write_ordered_keys)
+        self._flush_interval = flush_interval if flush_interval is not None else 0.
+        self._last_flush = time.time()
+        self._unflushed = 0
+        self._write_buffer_size = write_buffer_size
+        self._repr = "TypedBytesFile(%s, %s, %s, %s)" % (repr(fn), repr(mode), repr(read_fd), repr(write_fd))
+        read_func = None
+        if fileobj is not None:
+            self.file_method = 'fileobj'
+            if hasattr(fileobj, 'recv_into'):
+                read_func, write_func = fileobj.recv, fileobj.sendall
+            else:
+                read_func, write_func = getattr(fileobj, 'read', None), getattr(fileobj, 'write', None)
+            if read_func is not None and mode in (None, 'r', 'rb'):
+                self._dec = _Decoder(read=read_func, block_size=read_buffer_size)
+            if write_func is not None and mode in (None, 'w', 'wb'):
+                self._write_func, self._flush_func = write_func, getattr(fileobj, 'flush', None)
+            if self._dec is None and self._write_func is None:
+                raise ValueError('fileobj can\'t be used with mode [%s]' % mode)
+        elif use_mmap:
+            if not fn or mode not in (None, 'r', 'rb'):
+                raise ValueError('use_mmap requires fn and read mode')
+            self._open_mmap(fn, byte_range)
+        elif fn:
+            self.file_method = 'fn'
+            if mode == None:
+                mode = 'r'
+            if compression is None:
+                compression = 'gzip' if fn.endswith('.gz') else 'none'
+            try:
+                if compression == 'gzip':
+                    fp = gzip.open(fn, mode.replace('b', '') + 'b', compression_level)
+                elif compression == 'none':
+                    fp = open(fn, mode if 'b' in mode else mode + 'b')
+                else:
+                    raise ValueError('Unknown compression [%s]' % compression)
+            except IOError:
+                raise IOError('Cannot open file [%s]' % fn)
+            self._to_close.append(fp)
+            if mode[0] in 'wa':
+                self._write_func, self._flush_func = fp.write, fp.flush
+            else:
+                self._dec = _Decoder(read=fp.read, block_size=read_buffer_size)
+        elif read_fd != None or write_fd != None:
+            self.file_method = 'readwritefds'
+            if background_io:
+                import hadoopy._background_io
+            if read_fd != None:
+                if background_io:
+                    stream = hadoopy._background_io.ReadAhead(read_fd)
+                    self._to_close.append(stream)
+                    read_func = stream.read
+                else:
+                    self._fds.append(read_fd)
+                    read_func = lambda size: os.read(read_fd, size)
+                self._dec = _Decoder(read=read_func, block_size=read_buffer_size)
+            if write_fd != None:
+                if background_io:
+                    stream = hadoopy._background_io.WriteBehind(write_fd)
+                    self._to_close.insert(0, stream)
+                    self._write_func, self._flush_func = stream.write, stream.flush
+                else:
+                    self._fds.insert(0, write_fd)
+                    self._write_func = _fd_writer(write_fd)
+        else:
+            self.file_method = 'stdinout'
+            read_fd = sys.stdin.fileno()
+            self._dec = _Decoder(read=lambda size: os.read(read_fd, size), block_size=read_buffer_size)
+            self._write_func, self._flush_func = sys.stdout.write, sys.stdout.flush
+        if self._write_func is not None:
+            self._enc = _Encoder()
+
+    def _open_mmap(self, fn, byte_range):
+        self.file_method = 'mmap'
+        self._fn = fn
+        try:
+            fp = open(fn, 'rb')
+        except IOError:
+            raise IOError('Cannot open file [%s]' % fn)
+        with fp:
+            size = os.fstat(fp.fileno()).st_size
+            if size:
+                self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._range_start, self._range_stop = byte_range if byte_range is not None else (0, size)
+        if not 0 <= self._range_start <= self._range_stop <= size:
+            raise ValueError('Bad byte_range [%r] for file of size [%d]' % (byte_range, size))
+        # Positions are file offsets, reads end at stop
+        self._dec = _Decoder(buffer(self._mmap, 0, self._range_stop) if size else '')
+        self._dec.pos = self._range_start
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            # The mapping isn't closed explicitly as decoders (e.g., in iter_groups) may still reference it
+            self._mmap = self._index = None
+            self._dec = self._enc = None
+            self._write_func = self._flush_func = None
+            to_close, fds = self._to_close, self._fds
+            self._to_close, self._fds = [], []
+            errors = []
+            for stream in to_close:
+                stream.close()
+                if getattr(stream, 'error', None) is not None:
+                    errors.append(stream.error)
+            for fd in fds:
+                os.close(fd)
+            if errors:
+                raise errors[0]
+
+    def __repr__(self):
+        return self._repr
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def _reader(self):
+        if self._dec is None:
+            raise ValueError("Read pointer not set!")
+        return self._dec
+
+    def _next_key(self, dec):
+        if self._read_ordered_keys:
+            return _read_ordered_key(dec)
+        return dec.next_value()
+
+    def next(self):
+        dec = self._reader()
+        if self._read_ordered_keys:
+            k = _read_ordered_key(dec)
+        else:
+            k = dec.next_value()
+        return k, dec.item()
+
+    __next__ = next
+
+    def read_key_raw_value(self, raw_key=False):
+        """Read the next KeyValue pair, the value is a RawValue
+
+        :param raw_key: If True, the key is a RawValue too (default False)
+        :returns: (key, RawValue)
+        :raises: StopIteration: At the end of the stream
+        """
+        dec = self._reader()
+        k = dec.raw_value() if raw_key else self._next_key(dec)
+        return k, dec.raw_value()
+
+    def read_batch(self, n, key_dtype=None, value_dtype=None):
+        """Decode up to n KeyValue pairs into numpy arrays (see _typedbytes.pyx)
+
+        :param n: Max number of KeyValue pairs
+        :param key_dtype: bool, (u)int8-64, float32/64, or None/object for an object array (default None)
+        :param value_dtype: Same as key_dtype but for values (default None)
+        :returns: (keys, values) arrays, shorter than n at the end of the stream (empty once exhausted)
+        :raises: ImportError: If numpy isn't available
+        """
+        if np is None:
+            raise ImportError('read_batch requires numpy')
+        dec = self._reader()
+        key_dtype, value_dtype = _array_dtype(key_dtype), _array_dtype(value_dtype)
+        keys, values = [], []
+        for x in xrange(n):
+            try:
+                keys.append(self._next_key(dec))
+            except StopIteration:
+                break
+            try:
+                values.append(dec.next_value())
+            except StopIteration:
+                raise EOFError('KeyValue pair missing its value')
+        return _to_array(keys, key_dtype), _to_array(values, value_dtype)
+
+    def write_arrays(self, keys, values):
+        """Write KeyValue pairs from arrays (e.g., from read_batch)
+
+        :param keys: Array or sequence of keys
+        :param values: Array or sequence of values (same length as keys)
+        """
+        if np is None:
+            raise ImportError('write_arrays requires numpy')
+        if self._write_ordered_keys and isinstance(keys, np.ndarray):
+            keys = keys.tolist()
+        keys, values = _array_items(keys), _array_items(values)
+        if len(keys) != len(values):
+            raise ValueError('keys and values have different lengths (%d and %d)' % (len(keys), len(values)))
+        self.writes(zip(keys, values))
+
+    def iter_keys(self):
+        """Iterate over the remaining keys, values are skipped without being decoded
+
+        :returns: Iterator of keys
+        """
+        dec = self._reader()
+        while True:
+            try:
+                k = self._next_key(dec)
+            except StopIteration:
+                return
+            dec.skip(dec.code())
+            yield k
+
+    def iter_groups(self, raw_values=False):
+        """Iterate over runs of consecutive KeyValue pairs that have the same key (see _typedbytes.pyx)
+
+        :param raw_values: If True, values are RawValue (see read_key_raw_value) (default False)
+        :returns: Iterator of (key, values iterator)
+        """
+        dec = self._reader()
+        key = None  # Encoded key of the current group
+        while True:
+            if key is None:
+                try:
+                    key = dec.raw_value().raw
+                except StopIteration:
+                    return
+            state = {'next_key': None, 'has_value': True}
+
+            def values(key=key, state=state, skip=False):
+                while True:
+                    if not state['has_value']:
+                        if state['next_key'] is not None:
+                            return
+                        try:
+                            next_key = dec.raw_value().raw
+                        except StopIteration:
+                            state['next_key'] = ''
+                            return
+                        if next_key != key:
+                            state['next_key'] = next_key
+                            return
+                    state['has_value'] = False
+                    if skip:
+                        dec.skip(dec.code())
+                        yield None
+                    else:
+                        yield dec.raw_value() if raw_values else dec.item()
+            group = values()
+            yield loads(key, ordered=self._read_ordered_keys), group
+            # Skip what's left of the group
+            for x in values(state=state, skip=True):
+                pass
+            key = state['next_key'] or None
+
+    def skip(self, num=1):
+        """Skip KeyValue pairs without decoding them
+
+        :param num: Max number of KeyValue pairs to skip (default 1)
+        :returns: Number skipped (less than num at the end of the stream)
+        """
+        dec = self._reader()
+        for x in xrange(num):
+            code = dec.code()
+            if code == 255 or code < 0:
+                return x
+            dec.skip(code)
+            dec.skip(dec.code())
+        return num
+
+    def count(self):
+        """Count the remaining KeyValue pairs without decoding them (consumes them)
+
+        :returns: Number of KeyValue pairs
+        """
+        out = 0
+        while True:
+            cur = self.skip(1048576)
+            out += cur
+            if cur < 1048576:
+                return out
+
+    def _check_mmap(self):
+        if self.file_method != 'mmap':
+            raise ValueError('Only available with use_mmap=True')
+        if self._dec is None:
+            raise ValueError('File is closed')
+
+    def build_index(self):
+        """Find the offset of every record (use_mmap only)
+
+        Values are skipped, not decoded.  The read position is unchanged.
+        """
+        self._check_mmap()
+        dec = self._dec
+        prev_pos = dec.pos
+        self._index = None
+        index = []
+        dec.pos = self._range_start
+        try:
+            while True:
+                pos = dec.pos
+                code = dec.code()
+                if code == 255 or code < 0:
+                    break
+                dec.skip(code)
+                dec.skip(dec.code())
+                index.append(pos)
+        finally:
+            dec.pos = prev_pos
+        self._index = index
+
+    def _ensure_index(self):
+        self._check_mmap()
+        if self._index is None:
+            self.build_index()
+        return self._index
+
+    def save_index(self, index_fn=None):
+        """Write the record index to a sidecar file (use_mmap only)
+
+        Format: 'HTBIDX1\\n' <64-bit file size> <64-bit record count> <64-bit offset per record> (big endian)
+
+        :param index_fn: Path to write (default is fn + '.idx')
+        """
+        index = self._ensure_index()
+        if index_fn is None:
+            index_fn = self._fn + '.idx'
+        try:
+            fp = open(index_fn, 'wb')
+        except IOError:
+            raise IOError('Cannot open file [%s]' % index_fn)
+        with fp:
+            fp.write('HTBIDX1\n')
+            fp.write(struct.pack('>qq%dq' % len(index), os.stat(self._fn).st_size, len(index), *index))
+
+    def load_index(self, index_fn=None):
+        """Load a record index written by save_index (use_mmap only)
+
+        Only the records inside of byte_range are kept.
+
+        :param index_fn: Path to read (default is fn + '.idx')
+        :raises: IOError: If the index is missing, malformed, or for a different file size
+        """
+        self._check_mmap()
+        if index_fn is None:
+            index_fn = self._fn + '.idx'
+        try:
+            fp = open(index_fn, 'rb')
+        except IOError:
+            raise IOError('Cannot open file [%s]' % index_fn)
+        with fp:
+            data = fp.read()
+        if data[:8] != 'HTBIDX1\n':
+            raise IOError('Not an index file [%s]' % index_fn)
+        if len(data) < 24:
+            raise IOError('Truncated index file [%s]' % index_fn)
+        size, num_records = struct.unpack_from('>qq', data, 8)
+        if size != os.stat(self._fn).st_size:
+            raise IOError('Index [%s] is for a different version of [%s]' % (index_fn, self._fn))
+        if num_records < 0 or len(data) < 24 + 8 * num_records:
+            raise IOError('Truncated index file [%s]' % index_fn)
+        start, stop = self._range_start, self._range_stop
+        self._index = [x for x in struct.unpack_from('>%dq' % num_records, data, 24) if start <= x < stop]
+
+    def __len__(self):
+        """Number of records (use_mmap only, builds the index if needed)"""
+        if self.file_method != 'mmap':
+            raise TypeError('len() requires use_mmap=True')
+        return len(self._ensure_index())
+
+    def seek(self, num):
+        """Move to record num so that it is returned by the next read (use_mmap only, builds the index if needed)
+
+        :param num: Record number (negative values count from the end, len(self) is the end)
+        :raises: IndexError: If num is out of range
+        """
+        index = self._ensure_index()
+        if num < 0:
+            num += len(index)
+        if num == len(index):
+            self._dec.pos = self._range_stop
+            return
+        if not 0 <= num < len(index):
+            raise IndexError('Record [%d] out of range' % num)
+        self._dec.pos = index[num]
+
+    def split(self, num_parts):
+        """Split into byte ranges with about the same size (use_mmap only, builds the index if needed)
+
+        Ranges start/stop on record boundaries and can be read in parallel by
+        TypedBytesFile(fn, use_mmap=True, byte_range=byte_range).
+
+        :param num_parts: Max number of ranges
+        :returns: List of (start, stop) byte offsets, empty ranges are dropped
+        """
+        index = self._ensure_index()
+        out = []
+        prev = 0
+        for x in xrange(1, num_parts + 1):
+            if x == num_parts:
+                cur = len(index)
+            else:
+                # First record starting at or after target
+                target = self._range_start + (self._range_stop - self._range_start) * x / num_parts
+                cur = bisect.bisect_left(index, target, prev)
+            if cur > prev:
+                out.append((index[prev], index[cur] if cur < len(index) else self._range_stop))
+                prev = cur
+        return out
+
+    def _write(self, kv):
+        enc = self._enc
+        k, v = kv
+        if self._write_ordered_keys:
+            _write_ordered_key(enc, k)
+        else:
+            enc.value(k)
+        enc.value(v)
+
+    def _wrote(self, num):
+        """Write out a full buffer, flush if the flush policy (flush_writes/flush_interval) says to"""
+        self._unflushed += num
+        if self.flush_writes and self._unflushed >= self.flush_writes:
+            self.flush()
+        elif self._flush_interval and time.time() - self._last_flush >= self._flush_interval:
+            self.flush()
+        elif self._enc.size >= self._write_buffer_size:
+            self._write_func(self._enc.take())
+
+    def write(self, kv):
+        if self._enc is None:
+            raise ValueError("Write pointer not set!")
+        self._write(kv)
+        self._wrote(1)
+
+    def writes(self, kvs):
+        if self._enc is None:
+            raise ValueError("Write pointer not set!")
+        num = 0
+        enc = self._enc
+        for kv in kvs:
+            self._write(kv)
+            num += 1
+            if enc.size >= self._write_buffer_size:
+                self._write_func(enc.take())
+        self._wrote(num)
+
+    def flush(self):
+        if self._enc is not None:
+            if self._enc.size:
+                self._write_func(self._enc.take())
+            if self._flush_func is not None:
+                self._flush_func()
+        self._unflushed = 0
+        if self._flush_interval:
+            self._last_flush = time.time()
+
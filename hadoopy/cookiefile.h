@@ -0,0 +1,104 @@
+#ifndef COOKIEFILE_H
+#define COOKIEFILE_H
+#include <Python.h>
+#include <stdio.h>
+#include <string.h>
+#include <errno.h>
+
+/* A FILE backed by a Python object with readinto(buffer) -> int (or
+   read(size) -> str), write(str), and close() methods (only those used by
+   mode are needed).  The FILE holds a
+   reference to the object until it is closed.  Exceptions raised by the
+   methods are cleared and reported as stdio errors/EOF, the object is
+   expected to keep them (e.g., as .error) for its owner. */
+
+#ifdef __GLIBC__
+#define COOKIEFILE_SUPPORTED 1
+
+static ssize_t _cookiefile_readinto(PyObject *cookie, char *buf, size_t size) {
+    /* Reads directly into the FILE's buffer */
+    ssize_t out = -1;
+    PyObject *data = NULL;
+    PyObject *view_obj = PyBuffer_FromReadWriteMemory(buf, size);
+    if (view_obj != NULL)
+        data = PyObject_CallMethod(cookie, "readinto", "O", view_obj);
+    if (data != NULL && (PyInt_Check(data) || PyLong_Check(data))) {
+        out = PyInt_AsSsize_t(data);
+        if (out < 0 || out > (ssize_t)size)
+            out = -1;
+    }
+    Py_XDECREF(view_obj);
+    Py_XDECREF(data);
+    return out;
+}
+
+static ssize_t _cookiefile_read(void *cookie, char *buf, size_t size) {
+    ssize_t out = -1;
+    PyGILState_STATE state = PyGILState_Ensure();
+    PyObject *data = NULL;
+    if (PyObject_HasAttrString((PyObject *)cookie, "readinto")) {
+        out = _cookiefile_readinto((PyObject *)cookie, buf, size);
+    } else {
+        data = PyObject_CallMethod((PyObject *)cookie, "read", "n", (Py_ssize_t)size);
+        if (data != NULL && PyString_Check(data) && PyString_GET_SIZE(data) <= (Py_ssize_t)size) {
+            out = PyString_GET_SIZE(data);
+            memcpy(buf, PyString_AS_STRING(data), out);
+        }
+    }
+    Py_XDECREF(data);
+    PyErr_Clear();
+    PyGILState_Release(state);
+    return out;
+}
+
+static ssize_t _cookiefile_write(void *cookie, const char *buf, size_t size) {
+    ssize_t out = 0;
+    PyGILState_STATE state = PyGILState_Ensure();
+    PyObject *data = PyString_FromStringAndSize(buf, size);
+    PyObject *ret = NULL;
+    if (data != NULL)
+        ret = PyObject_CallMethod((PyObject *)cookie, "write", "O", data);
+    if (ret != NULL)
+        out = size;
+    Py_XDECREF(data);
+    Py_XDECREF(ret);
+    PyErr_Clear();
+    PyGILState_Release(state);
+    return out;
+}
+
+static int _cookiefile_close(void *cookie) {
+    int out = 0;
+    PyGILState_STATE state = PyGILState_Ensure();
+    PyObject *ret = PyObject_CallMethod((PyObject *)cookie, "close", NULL);
+    if (ret == NULL)
+        out = EOF;
+    Py_XDECREF(ret);
+    Py_DECREF((PyObject *)cookie);
+    PyErr_Clear();
+    PyGILState_Release(state);
+    return out;
+}
+
+static FILE *_cookiefile_open(PyObject *obj, const char *mode) {
+    FILE *fp;
+    cookie_io_functions_t funcs;
+    funcs.read = _cookiefile_read;
+    funcs.write = _cookiefile_write;
+    funcs.seek = NULL;
+    funcs.close = _cookiefile_close;
+    fp = fopencookie(obj, mode, funcs);
+    if (fp != NULL)
+        Py_INCREF(obj);
+    return fp;
+}
+#else
+#define COOKIEFILE_SUPPORTED 0
+
+static FILE *_cookiefile_open(PyObject *obj, const char *mode) {
+    errno = ENOSYS;  /* Needs fopencookie */
+    return NULL;
+}
+#endif
+
+#endif /* COOKIEFILE_H */
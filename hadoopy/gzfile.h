@@ -0,0 +1,57 @@
+#ifndef GZFILE_H
+#define GZFILE_H
+#include <stdio.h>
+#include <errno.h>
+#include <zlib.h>
+
+/* A FILE that transparently (de)compresses gzip through zlib's gz* functions,
+   inflating/deflating buffer_size blocks.  Reads of files that aren't
+   gzip'd pass through unchanged. */
+
+#ifdef __GLIBC__
+#define GZFILE_SUPPORTED 1
+
+static ssize_t _gzfile_read(void *cookie, char *buf, size_t size) {
+    return gzread((gzFile)cookie, buf, size);  /* -1 on error */
+}
+
+static ssize_t _gzfile_write(void *cookie, const char *buf, size_t size) {
+    return gzwrite((gzFile)cookie, buf, size);  /* 0 on error */
+}
+
+static int _gzfile_close(void *cookie) {
+    return gzclose((gzFile)cookie) == Z_OK ? 0 : EOF;
+}
+
+static FILE *_gzfile_open(const char *path, const char *mode, int level, unsigned buffer_size) {
+    FILE *fp;
+    gzFile gz;
+    char gz_mode[4] = {mode[0], 'b', '0' + level, 0};
+    cookie_io_functions_t funcs;
+    if (level < 0 || level > 9) {
+        errno = EINVAL;
+        return NULL;
+    }
+    gz = gzopen(path, gz_mode);
+    if (gz == NULL)
+        return NULL;
+    gzbuffer(gz, buffer_size);
+    funcs.read = _gzfile_read;
+    funcs.write = _gzfile_write;
+    funcs.seek = NULL;
+    funcs.close = _gzfile_close;
+    fp = fopencookie(gz, mode[0] == 'r' ? "r" : "w", funcs);
+    if (fp == NULL)
+        gzclose(gz);
+    return fp;
+}
+#else
+#define GZFILE_SUPPORTED 0
+
+static FILE *_gzfile_open(const char *path, const char *mode, int level, unsigned buffer_size) {
+    errno = ENOSYS;  /* Needs fopencookie */
+    return NULL;
+}
+#endif
+
+#endif /* GZFILE_H */
@@ -0,0 +1,16 @@
+#ifndef STDIO_UNLOCKED_H
+#define STDIO_UNLOCKED_H
+#include <stdio.h>
+
+/* A TypedBytesFile's FILE is only used by one thread at a time, so skip the
+   per call stream locking where the libc provides unlocked variants */
+#ifdef __GLIBC__
+#define _unlocked_fwrite(ptr, size, nmemb, stream) (fwrite_unlocked(ptr, size, nmemb, (FILE *)(stream)))
+#define _unlocked_fread(ptr, size, nmemb, stream) (fread_unlocked(ptr, size, nmemb, (FILE *)(stream)))
+#else
+#define _unlocked_fwrite(ptr, size, nmemb, stream) (fwrite(ptr, size, nmemb, (FILE *)(stream)))
+#define _unlocked_fread(ptr, size, nmemb, stream) (fread(ptr, size, nmemb, (FILE *)(stream)))
+#endif
+#define _unlocked_getc(stream) (getc_unlocked((FILE *)(stream)))
+
+#endif /* STDIO_UNLOCKED_H */
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# (C) Copyright 2010 Brandyn A. White
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Public TypedBytes codec (file and in-memory interfaces)"""
+
+__author__ = 'Brandyn A. White <bwhite@cs.umd.edu>'
+__license__ = 'GPL V3'
+
+from _native import typedbytes as _impl
+TypedBytesFile, RawValue = _impl.TypedBytesFile, _impl.RawValue
+dumps, loads, dumps_kvs, loads_kvs = _impl.dumps, _impl.loads, _impl.dumps_kvs, _impl.loads_kvs
+register_type, set_java_compatible, set_compact_ints = _impl.register_type, _impl.set_java_compatible, _impl.set_compact_ints
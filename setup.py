@@ -82,7 +82,7 @@ thirdparty_paths = map(_remove_prefix, _glob_recursive('hadoopy/thirdparty/*'))
 ext_modules = [Extension("_hadoopy_main", ["hadoopy/_main" + source_ext,
                                    "hadoopy/getdelim.c"]),
                Extension("_hadoopy_typedbytes", ["hadoopy/_typedbytes" + source_ext],
-                         extra_compile_args=tb_extra_args)]
+                         extra_compile_args=tb_extra_args, libraries=['z'])]
 setup(name='hadoopy',
       cmdclass=cmdclass,
       version='0.6.0',
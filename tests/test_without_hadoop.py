@@ -22,6 +22,13 @@ import tempfile
 import subprocess
 import os
 import re
+import shutil
+import gzip
+import io
+import socket
+import StringIO
+import threading
+import time
 
 try:
     import unittest2 as unittest
@@ -77,6 +84,791 @@ class Test(unittest.TestCase):
             k, v = hadoopy.TypedBytesFile(f.name, 'r').next()
             self.assertEquals((unicode(k, 'utf-8'), unicode(v, 'utf-8')), kv)
 
+    def test_dumps_loads(self):
+        vals = [0, -2**32, 2**128, .25, 'abc', u'\xe9', (1, 'a'), [1, [2]], {'a': (1,)}, '']
+        for val in vals:
+            s = hadoopy.typedbytes.dumps(val)
+            self.assertEquals(hadoopy.typedbytes.loads(s), val)
+            self.assertEquals(hadoopy.typedbytes.loads(bytearray(s)), val)
+            self.assertEquals(hadoopy.typedbytes.loads(memoryview(s)), val)
+            self.assertEquals(hadoopy.typedbytes.loads('xx' + s, 2), val)
+        kvs = [(x, vals[-x]) for x in range(len(vals))]
+        s = hadoopy.typedbytes.dumps_kvs(kvs)
+        self.assertEquals(hadoopy.typedbytes.loads_kvs(s), kvs)
+        self.assertEquals(hadoopy.typedbytes.loads_kvs(''), [])
+        self.assertRaises(EOFError, hadoopy.typedbytes.loads, '')
+        f = tempfile.NamedTemporaryFile()
+        with hadoopy.TypedBytesFile(f.name, 'w') as fp:
+            fp.writes(kvs)
+        self.assertEquals(open(f.name).read(), s)
+
+    def test_register_type(self):
+        import struct
+
+        class Point(object):
+
+            def __init__(self, x, y):
+                self.x, self.y = x, y
+
+        point_struct = struct.Struct('>ii')
+        hadoopy.typedbytes.register_type(150, Point,
+                                         lambda p: point_struct.pack(p.x, p.y),
+                                         lambda s: Point(*point_struct.unpack(s)))
+        s = hadoopy.typedbytes.dumps((Point(3, -4), 1))
+        self.assertEquals(s[:2], '\x08\x00')
+        self.assertEquals(s[5:11], '\x96\x00\x00\x00\x08\x00')
+        p, x = hadoopy.typedbytes.loads(s)
+        self.assertEquals((p.x, p.y, x), (3, -4, 1))
+        self.assertRaises(ValueError, hadoopy.typedbytes.register_type, 100, Point, str, str)
+        self.assertRaises(ValueError, hadoopy.typedbytes.register_type, 151, Point, str, str)
+        self.assertRaises(ValueError, hadoopy.typedbytes.register_type, 150, set, str, str)
+        self.assertRaises(IndexError, hadoopy.typedbytes.loads, '\x97\x00\x00\x00\x00')
+
+    def test_ndarray(self):
+        try:
+            import numpy as np
+        except ImportError:
+            raise unittest.SkipTest('Needs numpy')
+        arrays = [np.arange(12, dtype=np.float32).reshape((3, 4)),
+                  np.arange(12, dtype='>i8').reshape((3, 4)).T,
+                  np.array(5, dtype=np.uint8), np.zeros((0, 3)),
+                  np.array(['a', 'bc']), np.array([1, 'a'], dtype=object)]
+        for a in arrays:
+            s = hadoopy.typedbytes.dumps(a)
+            self.assertEquals(s[0], '\x64' if a.dtype == object else '\x65')
+            b = hadoopy.typedbytes.loads(s)
+            self.assertEquals(a.dtype, b.dtype)
+            self.assertEquals(a.shape, b.shape)
+            self.assertTrue(np.all(a == b))
+        b = hadoopy.typedbytes.loads(hadoopy.typedbytes.dumps(arrays[0]))
+        b[0, 0] = 1
+        self.assertEquals(b[0, 0], 1)
+        # Dtypes that can't export a buffer are pickled
+        import hadoopy._typedbytes_py as tb_py
+        for a in [np.array(['2020-01-01', '2021-06-30'], dtype='datetime64[D]'),
+                  np.array([1, -2], dtype='timedelta64[s]')]:
+            s = hadoopy.typedbytes.dumps(a)
+            self.assertEquals(s[0], '\x64')
+            self.assertEquals(tb_py.dumps(a), s)
+            b = hadoopy.typedbytes.loads(s)
+            self.assertEquals(a.dtype, b.dtype)
+            self.assertTrue(np.all(a == b))
+
+    def test_none_set_datetime_decimal(self):
+        import datetime
+        import decimal
+        vals = [None, set([1, 'a']), frozenset([(1, 2)]), set(),
+                datetime.datetime(2012, 8, 23, 1, 32, 17, 123456),
+                datetime.datetime(1900, 1, 1), decimal.Decimal('-1.0001')]
+        for val in vals:
+            s = hadoopy.typedbytes.dumps(val)
+            self.assertTrue(102 <= ord(s[0]) <= 106)
+            self.assertEquals(len(s) - 5, int(s[1:5].encode('hex'), 16))
+            out = hadoopy.typedbytes.loads(s)
+            self.assertEquals(type(out), type(val))
+            self.assertEquals(out, val)
+        self.assertEquals(hadoopy.typedbytes.dumps(None), '\x66\x00\x00\x00\x00')
+        hadoopy.typedbytes.set_java_compatible(True)
+        try:
+            self.assertEquals(hadoopy.typedbytes.loads(hadoopy.typedbytes.dumps(vals[1:3])),
+                              [list(vals[1]), ((1, 2),)])
+            # Frozensets can be dict keys
+            self.assertEquals(hadoopy.typedbytes.loads(hadoopy.typedbytes.dumps({frozenset([1]): 'a'})), {(1,): 'a'})
+            self.assertEquals(ord(hadoopy.typedbytes.dumps(datetime.date(2012, 8, 23))[0]), 100)
+            self.assertEquals(hadoopy.typedbytes.loads(hadoopy.typedbytes.dumps(vals[-3:])),
+                              [u'2012-08-23T01:32:17.123456', u'1900-01-01T00:00:00', u'-1.0001'])
+            self.assertEquals(hadoopy.typedbytes.loads(hadoopy.typedbytes.dumps(None)), None)
+        finally:
+            hadoopy.typedbytes.set_java_compatible(False)
+
+    def test_subclass_types(self):
+        import collections
+        point = collections.namedtuple('Point', ['x', 'y'])
+        vals = [(point(1, 2), '\x08', (1, 2)),
+                (collections.OrderedDict([('a', 1)]), '\x0a', {'a': 1}),
+                (collections.defaultdict(int, a=1), '\x0a', {'a': 1})]
+        try:
+            import numpy as np
+        except ImportError:
+            pass
+        else:
+            vals += [(np.int64(-5), '\x03', -5), (np.uint32(2**31), '\x04', 2**31),
+                     (np.float32(.5), '\x05', .5), (np.float64(.1), '\x06', .1),
+                     (np.bool_(True), '\x02', True), (np.str_('ab'), '\x00', 'ab'),
+                     (np.unicode_(u'\xe9'), '\x07', u'\xe9')]
+        for val, code, out in vals:
+            for x in range(2):  # Second time uses the memoized type code
+                s = hadoopy.typedbytes.dumps(val)
+                self.assertEquals(s[0], code)
+                self.assertEquals(hadoopy.typedbytes.loads(s), out)
+
+    def test_bytes_views(self):
+        kvs = [('a', 'b' * 1000), (u'\xe9' * 1000, ('c' * 10, 'd' * 100))]
+        s = hadoopy.typedbytes.dumps_kvs(kvs)
+        self.assertEquals(hadoopy.typedbytes.loads_kvs(s), kvs)
+        for buf in [s, bytearray(s)]:
+            out = hadoopy.typedbytes.loads_kvs(buf, view_size=100)
+            self.assertEquals(type(out[0][1]), memoryview)
+            self.assertEquals(out[0][1].tobytes(), kvs[0][1])
+            self.assertEquals(type(out[1][1][0]), str)
+            self.assertEquals(out[1][1][1].tobytes(), kvs[1][1][1])
+            self.assertEquals(out[1][0], kvs[1][0])
+        out = hadoopy.typedbytes.loads(bytearray(s), 6, view_size=0)
+        self.assertEquals(out.tobytes(), kvs[0][1])
+        # Views are only used inside of the call that asked for them
+        self.assertEquals(type(hadoopy.typedbytes.loads(s, 6)), str)
+
+    def test_containers(self):
+        vals = [(), [], {}, (1, (2, [3, {4: (5,)}])), [[], [[]], ()],
+                dict((x, [x] * x) for x in range(100)), tuple(range(1000))]
+        for val in vals:
+            self.assertEquals(hadoopy.typedbytes.loads(hadoopy.typedbytes.dumps(val)), val)
+        # A list at the end of the input is ended by EOF as before
+        self.assertEquals(hadoopy.typedbytes.loads(hadoopy.typedbytes.dumps([1, 2])[:-1]), [1, 2])
+
+    def test_truncated(self):
+        import hadoopy._typedbytes_py as tb_py
+        vals = ['hello world', u'\xe9abc', (1, 2, 3), {1: 2}, 1.5, 2**40, 2**100, set([1]), None, True]
+        kvs = [(1, 2), (3, 4)]
+        f = tempfile.NamedTemporaryFile()
+        for tb in [hadoopy.typedbytes, tb_py]:
+            for val in vals:
+                s = tb.dumps(val)
+                for x in range(1, len(s)):
+                    self.assertRaises(EOFError, tb.loads, s[:x])
+            s = tb.dumps_kvs(kvs)
+            for x in [1, 2, 5]:
+                self.assertRaises(EOFError, tb.loads_kvs, s[:-x])
+            self.assertRaises(ValueError, tb.loads, '\x00\xff\xff\xff\xffabc')
+            self.assertRaises(ValueError, tb.loads, '\x07\xff\xff\xff\xffabc')
+            with open(f.name, 'w') as fp:
+                fp.write(s[:-2])
+            fp = tb.TypedBytesFile(f.name, 'r')
+            self.assertEquals(fp.next(), kvs[0])
+            self.assertRaises(EOFError, fp.next)
+
+    def test_schema(self):
+        f = tempfile.NamedTemporaryFile()
+        schema = (str, (int, float, str, [int], {str: float}, object))
+        kvs = [('a', (1, .5, 'b', [1, 2], {'c': .25}, None)),
+               ('a', (2**40, 1, u'b', [1, 'x'], {}, (1, 2))),  # Fallbacks
+               (u'a', ('a', 'b')),
+               (1, None)]
+        with hadoopy.TypedBytesFile(f.name, 'w', write_schema=schema) as fp:
+            fp.writes(kvs)
+        self.assertEquals(open(f.name).read(), hadoopy.typedbytes.dumps_kvs(kvs))
+        self.assertEquals(list(hadoopy.TypedBytesFile(f.name, 'r', read_schema=schema)), kvs)
+        self.assertRaises(ValueError, hadoopy.TypedBytesFile, f.name, 'r', read_schema=(str, [int, int]))
+        self.assertRaises(ValueError, hadoopy.TypedBytesFile, f.name, 'r', read_schema=(str, 1))
+
+    def test_raw_values(self):
+        f = tempfile.NamedTemporaryFile()
+        kvs = [('a', 1), ('b', [1, [2, {3: (4, 'x')}], None]), ('c', 2**100), (u'd', [])]
+        with hadoopy.TypedBytesFile(f.name, 'w') as fp:
+            fp.writes(kvs)
+        out = []
+        fp = hadoopy.TypedBytesFile(f.name, 'r')
+        while True:
+            try:
+                out.append(fp.read_key_raw_value())
+            except StopIteration:
+                break
+        self.assertEquals([(k, v.value) for k, v in out], kvs)
+        self.assertEquals([v.raw for k, v in out], [hadoopy.typedbytes.dumps(v) for k, v in kvs])
+        self.assertEquals(hadoopy.typedbytes.dumps_kvs(out), open(f.name).read())
+        k, v = hadoopy.TypedBytesFile(f.name, 'r').read_key_raw_value(raw_key=True)
+        self.assertEquals((k.raw, v.raw), tuple(map(hadoopy.typedbytes.dumps, kvs[0])))
+        with open(f.name, 'w') as fp:
+            fp.write(hadoopy.typedbytes.dumps_kvs(kvs)[:-1])
+        fp = hadoopy.TypedBytesFile(f.name, 'r')
+        for x in range(3):
+            fp.read_key_raw_value()
+        self.assertRaises(EOFError, fp.read_key_raw_value)
+
+    def test_mmap_index(self):
+        f = tempfile.NamedTemporaryFile()
+        kvs = [(x, [x, {'a': (x, None)}, 'b' * x]) for x in range(100)]
+        with hadoopy.TypedBytesFile(f.name, 'w') as fp:
+            fp.writes(kvs)
+        with hadoopy.TypedBytesFile(f.name, use_mmap=True) as fp:
+            self.assertEquals(list(fp), kvs)
+            self.assertEquals(len(fp), 100)
+            fp.seek(50)
+            self.assertEquals(fp.next(), kvs[50])
+            fp.seek(-1)
+            self.assertEquals(fp.next(), kvs[-1])
+            self.assertRaises(StopIteration, fp.next)
+            self.assertRaises(IndexError, fp.seek, 101)
+            fp.save_index()
+            ranges = fp.split(7)
+        self.assertEquals(len(ranges), 7)
+        out = []
+        for byte_range in ranges:
+            with hadoopy.TypedBytesFile(f.name, use_mmap=True, byte_range=byte_range) as fp:
+                fp.load_index()
+                num = len(fp)
+                fp.seek(-1)
+                last_kv = fp.next()
+                fp.seek(0)
+                cur_kvs = list(fp)
+                self.assertEquals(num, len(cur_kvs))
+                self.assertEquals(last_kv, cur_kvs[-1])
+                out += cur_kvs
+        self.assertEquals(out, kvs)
+        # Readers that aren't closed release their mapping (which holds an fd) when collected
+        if os.path.isdir('/proc/self/fd'):
+            num_fds = len(os.listdir('/proc/self/fd'))
+            fp = hadoopy.TypedBytesFile(f.name, use_mmap=True)
+            fp.next()
+            del fp
+            self.assertEquals(len(os.listdir('/proc/self/fd')), num_fds)
+        os.remove(f.name + '.idx')
+        with open(f.name, 'w'):
+            pass
+        with hadoopy.TypedBytesFile(f.name, use_mmap=True) as fp:
+            self.assertEquals(list(fp), [])
+            self.assertEquals(len(fp), 0)
+            self.assertEquals(fp.split(3), [])
+            self.assertRaises(IOError, fp.load_index)
+
+    def test_skip_keys_count(self):
+        f = tempfile.NamedTemporaryFile()
+        kvs = [(x, [x, {'a': (x, None, 'c' * 5000)}, [[]], 2**100, .5]) for x in range(100)]
+        with hadoopy.TypedBytesFile(f.name, 'w') as fp:
+            fp.writes(kvs)
+        self.assertEquals(hadoopy.TypedBytesFile(f.name, 'r').count(), 100)
+        self.assertEquals(list(hadoopy.TypedBytesFile(f.name, 'r').iter_keys()), range(100))
+        fp = hadoopy.TypedBytesFile(f.name, 'r')
+        self.assertEquals(fp.skip(), 1)
+        self.assertEquals(fp.skip(10), 10)
+        self.assertEquals(fp.next(), kvs[11])
+        self.assertEquals(fp.skip(100), 88)
+        self.assertRaises(StopIteration, fp.next)
+        # Truncated inside of a value that is skipped by seeking
+        import hadoopy._typedbytes_py as tb_py
+        with open(f.name, 'r+') as fp:
+            fp.truncate(os.path.getsize(f.name) - 100)
+        for kw in [{}, {'use_mmap': True}]:
+            self.assertRaises(EOFError, hadoopy.TypedBytesFile(f.name, **kw).count)
+            self.assertRaises(EOFError, tb_py.TypedBytesFile(f.name, **kw).count)
+        # Non-seekable
+        read_fd, write_fd = os.pipe()
+        with hadoopy.TypedBytesFile(write_fd=write_fd) as fp:
+            fp.writes(kvs[:10])
+        with hadoopy.TypedBytesFile(read_fd=read_fd) as fp:
+            self.assertEquals(fp.skip(3), 3)
+            self.assertEquals(fp.next(), kvs[3])
+            self.assertEquals(fp.count(), 6)
+
+    def test_write_flush_policy(self):
+        kvs = [(x, 'a' * 100) for x in range(10)]
+        record_size = len(hadoopy.typedbytes.dumps_kvs(kvs[:1]))
+        for flush_writes, flush_interval, sizes in [(False, None, [0] * 10),
+                                                    (True, None, range(1, 11)),
+                                                    (3, None, [0, 0, 3, 3, 3, 6, 6, 6, 9, 9]),
+                                                    (False, 0.000001, range(1, 11))]:
+            read_fd, write_fd = os.pipe()
+            fp = hadoopy.TypedBytesFile(write_fd=write_fd, flush_writes=flush_writes, flush_interval=flush_interval)
+            out = ''
+            for kv, size in zip(kvs, sizes):
+                time.sleep(.00001)
+                fp.write(kv)
+                if size * record_size > len(out):
+                    out += os.read(read_fd, size * record_size - len(out))
+                self.assertEquals(len(out), size * record_size)
+            fp.close()
+            self.assertEquals(out + os.read(read_fd, 10000), hadoopy.typedbytes.dumps_kvs(kvs))
+            os.close(read_fd)
+        # Buffer smaller than a record
+        read_fd, write_fd = os.pipe()
+        with hadoopy.TypedBytesFile(write_fd=write_fd, write_buffer_size=16) as fp:
+            fp.writes(kvs)
+        self.assertEquals(hadoopy.TypedBytesFile(read_fd=read_fd).count(), 10)
+
+    def test_background_io(self):
+        kvs = [(x, {'a': 'b' * x}) for x in range(2000)]
+        in_file, out_file = tempfile.NamedTemporaryFile(), tempfile.NamedTemporaryFile()
+        with hadoopy.TypedBytesFile(write_fd=os.open(in_file.name, os.O_WRONLY), background_io=True) as fp:
+            fp.writes(kvs)
+        with hadoopy.TypedBytesFile(read_fd=os.open(in_file.name, os.O_RDONLY),
+                                    write_fd=os.open(out_file.name, os.O_WRONLY), background_io=True,
+                                    write_buffer_size=4096) as fp:
+            for kv in fp:
+                fp.write(kv)
+        self.assertEquals(list(hadoopy.TypedBytesFile(out_file.name)), kvs)
+        # Write errors are raised
+        read_fd, write_fd = os.pipe()
+        os.close(read_fd)
+        fp = hadoopy.TypedBytesFile(write_fd=write_fd, background_io=True)
+        fp.write(kvs[0])
+        self.assertRaises(OSError, fp.close)
+        # Text input in a task
+        read_fd, write_fd = os.pipe()
+        out_read_fd, out_write_fd = os.pipe()
+        os.write(write_fd, 'a\nbc\n')
+        os.close(write_fd)
+        os.environ['hadoopy_background_io'] = '1'
+        try:
+            hadoopy._main.HadoopyTask(lambda k, v: [(k, v)], None, None, 'map', read_fd, out_write_fd).run()
+            # Read errors (reading a directory fails) aren't the end of the input
+            read_fd = os.open(tempfile.gettempdir(), os.O_RDONLY)
+            self.assertRaises(EnvironmentError, lambda: hadoopy._main.HadoopyTask(
+                lambda k, v: [(k, v)], None, None, 'map', read_fd, os.open(os.devnull, os.O_WRONLY)).run())
+        finally:
+            del os.environ['hadoopy_background_io']
+        self.assertEquals(os.read(out_read_fd, 100), '0\ta\n2\tbc\n')
+        fp = hadoopy.TypedBytesFile(read_fd=os.open(tempfile.gettempdir(), os.O_RDONLY), background_io=True)
+        self.assertRaises(EnvironmentError, list, fp)
+        self.assertRaises(EnvironmentError, fp.close)
+
+    def test_gzip(self):
+        kvs = [(x, {'a': 'b' * (x % 100)}) for x in range(10000)]
+        f = tempfile.NamedTemporaryFile(suffix='.tb.gz')
+        with hadoopy.TypedBytesFile(f.name, 'w') as fp:
+            fp.writes(kvs)
+        self.assertEquals(list(hadoopy.TypedBytesFile(f.name, 'r')), kvs)
+        self.assertEquals(gzip.open(f.name).read(), hadoopy.typedbytes.dumps_kvs(kvs))
+        self.assertTrue(os.path.getsize(f.name) < len(hadoopy.typedbytes.dumps_kvs(kvs)) / 10)
+        # Written by gzip, explicit compression argument
+        f = tempfile.NamedTemporaryFile()
+        with gzip.GzipFile(f.name, 'w') as fp:
+            fp.write(hadoopy.typedbytes.dumps_kvs(kvs))
+        self.assertEquals(list(hadoopy.TypedBytesFile(f.name, 'r', compression='gzip')), kvs)
+        self.assertRaises(ValueError, hadoopy.TypedBytesFile, f.name, 'r', compression='lzma')
+
+    def test_fileobj(self):
+        kvs = [(x, {'a': 'b' * (x % 100)}) for x in range(10000)]
+        data = hadoopy.typedbytes.dumps_kvs(kvs)
+        fileobj = StringIO.StringIO()
+        with hadoopy.TypedBytesFile(fileobj=fileobj, mode='w') as fp:
+            fp.writes(kvs)
+        self.assertEquals(fileobj.getvalue(), data)
+        gzip_data = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=gzip_data, mode='w') as fp:
+            fp.write(data)
+        gzip_data.seek(0)
+        # readinto, read only, and a short read buffer
+        for fileobj in [io.BytesIO(data), StringIO.StringIO(data), gzip.GzipFile(fileobj=gzip_data)]:
+            self.assertEquals(list(hadoopy.TypedBytesFile(fileobj=fileobj)), kvs)
+        self.assertEquals(list(hadoopy.TypedBytesFile(fileobj=io.BytesIO(data), read_buffer_size=7)), kvs)
+        # Sockets
+        sock0, sock1 = socket.socketpair()
+
+        def _write():
+            with hadoopy.TypedBytesFile(fileobj=sock0) as fp:
+                fp.writes(kvs)
+            sock0.close()
+        thread = threading.Thread(target=_write)
+        thread.start()
+        self.assertEquals(list(hadoopy.TypedBytesFile(fileobj=sock1)), kvs)
+        thread.join()
+        self.assertRaises(ValueError, hadoopy.TypedBytesFile, fileobj=io.BytesIO(), mode='a')
+
+        # Read errors are raised, not treated as the end of the stream
+        class FailingReader(object):
+
+            def __init__(self, data, fail_at, block_size):
+                self._fp = io.BytesIO(data)
+                self._num_reads = 0
+                self._fail_at = fail_at
+                self._block_size = block_size
+
+            def read(self, size):
+                self._num_reads += 1
+                if self._num_reads == self._fail_at:
+                    raise IOError('Read failed')
+                return self._fp.read(min(size, self._block_size))
+        for block_size in [1000, 4096]:
+            self.assertRaises(IOError, list, hadoopy.TypedBytesFile(fileobj=FailingReader(data, 3, block_size)))
+            self.assertRaises(IOError, hadoopy.TypedBytesFile(fileobj=FailingReader(data, 3, block_size)).count)
+            self.assertRaises(IOError, list, hadoopy.TypedBytesFile(fileobj=FailingReader(data, 3, block_size)).iter_keys())
+
+    def test_read_batch_write_arrays(self):
+        try:
+            import numpy as np
+        except ImportError:
+            raise unittest.SkipTest('Needs numpy')
+        f = tempfile.NamedTemporaryFile()
+        kvs = [(x, x / 3.) for x in range(-5, 5)] + [(2**40, True), (x, 'a')]
+        with hadoopy.TypedBytesFile(f.name, 'w') as fp:
+            fp.writes(kvs)
+        fp = hadoopy.TypedBytesFile(f.name, 'r')
+        keys, values = fp.read_batch(10, np.int32, np.float64)
+        self.assertEquals((keys.dtype, values.dtype), (np.int32, np.float64))
+        np.testing.assert_equal(keys, np.arange(-5, 5))
+        np.testing.assert_equal(values, np.arange(-5, 5) / 3.)
+        # Doesn't fit int32, not a float, end of stream
+        keys, values = fp.read_batch(10, np.int32, np.float64)
+        self.assertEquals((keys.dtype, values.dtype), (object, object))
+        self.assertEquals(zip(keys, values), kvs[10:])
+        self.assertEquals(map(len, fp.read_batch(10, np.int32)), [0, 0])
+        keys, values = hadoopy.TypedBytesFile(f.name, 'r').read_batch(100, np.int64, None)
+        self.assertEquals((keys.dtype, values.dtype, len(keys)), (np.int64, object, 12))
+        self.assertEquals(zip(keys.tolist(), values), kvs)
+        self.assertRaises(ValueError, fp.read_batch, 10, np.complex64)
+        # Ints that a float dtype can't represent exactly make an object array
+        import hadoopy._typedbytes_py as tb_py
+        for vals, dtype, out_dtype in [([1, 2**53 + 1], np.float64, object), ([1, 2**53, 2**62], np.float64, np.float64),
+                                       ([2**24 + 1], np.float32, object), ([2**63 - 1], np.float64, object),
+                                       ([-2**63, 3], np.float32, np.float32)]:
+            with hadoopy.TypedBytesFile(f.name, 'w') as fp:
+                fp.writes((x, x) for x in vals)
+            for tb in [hadoopy, tb_py]:
+                keys, values = tb.TypedBytesFile(f.name, 'r').read_batch(10, dtype, None)
+                self.assertEquals(keys.dtype, out_dtype)
+                self.assertEquals(keys.tolist(), vals)
+        # Written arrays decode like their Python values
+        arrays = [np.array([-1, 2**40], dtype=np.int64), np.array([1, 2], dtype=np.uint8),
+                  np.array([2**64 - 1, 0], dtype=np.uint64), np.array([.5, 2], dtype=np.float32),
+                  np.array([.5, 2], dtype=np.float64), np.array([True, False]), np.array(['a', 'bc']),
+                  np.array([{'a': 1}, None]), [(1, 2), 'b']]
+        for array in arrays:
+            with hadoopy.TypedBytesFile(f.name, 'w') as fp:
+                fp.write_arrays(array, array[::-1])
+            vals = list(array.tolist() if isinstance(array, np.ndarray) else array)
+            self.assertEquals(list(hadoopy.TypedBytesFile(f.name, 'r')), zip(vals, vals[::-1]))
+            with hadoopy.TypedBytesFile(f.name, 'w') as fp:
+                fp.writes(zip(vals, vals[::-1]))
+            dtype = getattr(array, 'dtype', None)
+            dtype = dtype if dtype is not None and dtype.kind in 'iufb' else None
+            self.assertEquals(hadoopy.TypedBytesFile(f.name, 'r').read_batch(2, dtype)[0].tolist(), vals)
+        self.assertRaises(ValueError, hadoopy.TypedBytesFile(f.name, 'w').write_arrays, [1], [])
+        with hadoopy.TypedBytesFile(f.name, 'w') as fp:
+            fp.write_arrays(np.array([.5], dtype=np.float32), [1])
+        self.assertEquals(open(f.name).read()[0], '\x05')
+
+    def test_compact_ints(self):
+        vals = [5, -128, 128, 5L, 2**40, 2**31L, [1, {2: (3, 'a')}]]
+        normal = [hadoopy.typedbytes.dumps(val) for val in vals]
+        hadoopy.typedbytes.set_compact_ints(True)
+        try:
+            compact = [hadoopy.typedbytes.dumps(val) for val in vals]
+            f = tempfile.NamedTemporaryFile()
+            with hadoopy.TypedBytesFile(f.name, 'w', write_schema=(int, [{int: (int, str)}])) as fp:
+                fp.write((5, vals[-1:]))
+            schema_out = open(f.name).read()
+        finally:
+            hadoopy.typedbytes.set_compact_ints(False)
+        self.assertEquals(compact[:6], ['\x01\x05', '\x01\x80', '\x03\x00\x00\x00\x80', '\x01\x05',
+                                        normal[4], '\x04\x00\x00\x00\x00\x80\x00\x00\x00'])
+        self.assertEquals(len(compact[6]), len(normal[6]) - 9)
+        self.assertEquals(map(hadoopy.typedbytes.loads, compact), vals)
+        self.assertEquals(schema_out, '\x01\x05' + compact[6].join(['\x09', '\xff']))
+
+    def test_bigint(self):
+        vals = [2**63, -2**63 - 1, 2**128 - 1, -2**128, 3**1000]
+        for val in vals:
+            s = hadoopy.typedbytes.dumps(val)
+            self.assertEquals(s[0], '\x6b')
+            self.assertEquals(hadoopy.typedbytes.loads(s), val)
+        self.assertEquals(hadoopy.typedbytes.dumps(2**128 - 1), '\x6b\x00\x00\x00\x11\x00' + '\xff' * 16)
+        self.assertEquals(hadoopy.typedbytes.dumps(-2**64), '\x6b\x00\x00\x00\x0a\x01\x01' + '\x00' * 8)
+        self.assertEquals(hadoopy.typedbytes.loads_kvs(hadoopy.typedbytes.dumps_kvs([(vals, 1)])), [(vals, 1)])
+
+    def test_ordered_keys(self):
+        dumps, loads = hadoopy.typedbytes.dumps, hadoopy.typedbytes.loads
+        vals = [None, -2**70, -1e20, -3, -2.5, -1, -0.25, 0, 1e-300, 0.5, 1, 1.5, 2, 3, 10, 255, 256, 2**62, 1e19,
+                2**64, float('inf'), float('-inf'), '', '\x00', '\x00\x00', '\x01', 'a', 'a\x00', 'ab', 'b', u'', u'a',
+                u'\xe9', (), (None,), (1, 'a'), (1, 'b'), (2,), (2, ''), ('a', (1,)), [1, 2], [2], True, False]
+        for val in vals:
+            s = dumps(val, ordered=True)
+            self.assertEquals(s[0], '\x09')
+            self.assertEquals(loads(s, ordered=True), val)
+            self.assertEquals(type(loads(s, ordered=True)), type(val))
+        # str and unicode compare as text (equal text puts str first), tuples aren't ordered against unicode
+        for group in [[x for x in vals if not isinstance(x, unicode)], [u'', u'\x00', u'a', u'ab', u'\xe9', u'\u4e2d'],
+                      ['', 'a', 'b', 'a\x00', u'', u'a', u'ab', u'\x00', u'\xe9']]:
+            by_bytes = sorted(group, key=lambda x: dumps(x, ordered=True))
+            self.assertEquals(by_bytes, sorted(group))
+        # Plain keys are still readable
+        self.assertEquals(loads(dumps('a'), ordered=True), 'a')
+        kvs = [(x, repr(x)) for x in vals]
+        self.assertEquals(hadoopy.typedbytes.loads_kvs(hadoopy.typedbytes.dumps_kvs(kvs, ordered_keys=True),
+                                                       ordered_keys=True), kvs)
+        self.assertRaises(TypeError, dumps, {}, ordered=True)
+        fn = tempfile.mktemp()
+        try:
+            with hadoopy.TypedBytesFile(fn, 'w', write_ordered_keys=True) as fp:
+                fp.writes(kvs)
+            with open(fn) as fp:
+                self.assertEquals(fp.read(), hadoopy.typedbytes.dumps_kvs(kvs, ordered_keys=True))
+            with hadoopy.TypedBytesFile(fn, 'r', read_ordered_keys=True) as fp:
+                self.assertEquals(list(fp), kvs)
+            with hadoopy.TypedBytesFile(fn, 'r', read_ordered_keys=True) as fp:
+                self.assertEquals(list(fp.iter_keys()), vals)
+        finally:
+            os.remove(fn)
+
+    def test_pure_python(self):
+        import datetime
+        import decimal
+        import sys
+        import hadoopy._typedbytes_py as tb_py
+        vals = [0, -1, 127, 2 ** 31, 2 ** 63, -2 ** 70, 1.5, '', 'a\x00b', u'\xe9', (1, [2, {3: None}]), set([1]),
+                frozenset(['a']), datetime.datetime(2012, 1, 2, 3, 4, 5, 6), decimal.Decimal('1.25'), True, [], {}]
+        for val in vals:
+            s = hadoopy.typedbytes.dumps(val)
+            self.assertEquals(tb_py.dumps(val), s)
+            self.assertEquals(tb_py.loads(s), val)
+            self.assertEquals(type(tb_py.loads(s)), type(val))
+        for val in [0, -1, 2 ** 63, -2 ** 70, 1.5, float('-inf'), 'a\x00b', u'\xe9', (1, ['a', None]), True]:
+            s = hadoopy.typedbytes.dumps(val, ordered=True)
+            self.assertEquals(tb_py.dumps(val, ordered=True), s)
+            self.assertEquals(tb_py.loads(s, ordered=True), val)
+        kvs = [(x, vals[x % len(vals)]) for x in range(1000)]
+        s = hadoopy.typedbytes.dumps_kvs(kvs)
+        self.assertEquals(tb_py.dumps_kvs(kvs), s)
+        self.assertEquals(tb_py.loads_kvs(s), kvs)
+        self.assertRaises(EOFError, tb_py.loads, '')
+        # Files (written by one, read by the other), with blocks smaller than a value
+        fn = tempfile.mktemp(suffix='.tb.gz')
+        try:
+            with tb_py.TypedBytesFile(fn, 'w', write_buffer_size=100) as fp:
+                fp.writes(kvs)
+            self.assertEquals(list(hadoopy.TypedBytesFile(fn)), kvs)
+            with hadoopy.TypedBytesFile(fn, 'w') as fp:
+                fp.writes(kvs)
+            self.assertEquals(list(tb_py.TypedBytesFile(fn, read_buffer_size=3)), kvs)
+            with tb_py.TypedBytesFile(fn, read_buffer_size=3) as fp:
+                self.assertEquals(fp.skip(10), 10)
+                self.assertEquals(list(fp.iter_keys())[:2], [10, 11])
+            with tb_py.TypedBytesFile(fn, read_buffer_size=3) as fp:
+                k, v = fp.read_key_raw_value()
+                self.assertEquals((k, v.raw, v.value), (0, hadoopy.typedbytes.dumps(0), 0))
+                self.assertEquals(tb_py.dumps(v), v.raw)
+                self.assertEquals(fp.count(), 999)
+            # Memory mapped with an index, schemas are validated, views
+            os.remove(fn)
+            fn = fn[:-3]
+            with hadoopy.TypedBytesFile(fn, 'w') as fp:
+                fp.writes(kvs)
+            with tb_py.TypedBytesFile(fn, use_mmap=True, read_schema=(int, object)) as fp:
+                self.assertEquals(len(fp), 1000)
+                fp.seek(-2)
+                self.assertEquals(list(fp), kvs[-2:])
+                fp.save_index()
+                ranges = fp.split(3)
+            self.assertEquals(ranges, hadoopy.TypedBytesFile(fn, use_mmap=True).split(3))
+            out = []
+            for byte_range in ranges:
+                with tb_py.TypedBytesFile(fn, use_mmap=True, byte_range=byte_range) as fp:
+                    fp.load_index()
+                    self.assertEquals(len(fp), len(list(fp)))
+                    fp.seek(0)
+                    out += list(fp)
+            self.assertEquals(out, kvs)
+            os.remove(fn + '.idx')
+            self.assertRaises(ValueError, tb_py.TypedBytesFile, fn, 'r', read_schema=(str, [int, int]))
+            self.assertRaises(ValueError, tb_py.TypedBytesFile, fn, 'r', use_mmap=True, byte_range=(0, 2**40))
+            self.assertEquals(tb_py.loads(bytearray(tb_py.dumps('abc')), view_size=3).tobytes(), 'abc')
+        finally:
+            if os.path.exists(fn):
+                os.remove(fn)
+        # File descriptors and file-like objects
+        read_fd, write_fd = os.pipe()
+        with tb_py.TypedBytesFile(write_fd=write_fd) as fp:
+            fp.writes(kvs[:10])
+        with tb_py.TypedBytesFile(read_fd=read_fd) as fp:
+            self.assertEquals(list(fp), kvs[:10])
+        out = StringIO.StringIO()
+        with tb_py.TypedBytesFile(fileobj=out, write_ordered_keys=True) as fp:
+            fp.writes(kvs)
+        self.assertEquals(out.getvalue(), hadoopy.typedbytes.dumps_kvs(kvs, ordered_keys=True))
+        out.seek(0)
+        with tb_py.TypedBytesFile(fileobj=out, read_ordered_keys=True) as fp:
+            self.assertEquals(list(fp), kvs)
+        # Selected by the environment, text input with a final line lacking a newline
+        env = dict(os.environ, hadoopy_pure_python='1', mapred_input_format_class='')
+        cmd = 'import hadoopy; print hadoopy.TypedBytesFile.__module__, hadoopy._main.__name__'
+        self.assertEquals(subprocess.Popen([sys.executable, '-c', cmd], env=env, stdout=subprocess.PIPE).communicate()[0],
+                          'hadoopy._typedbytes_py hadoopy._main_py\n')
+        cmd = 'import hadoopy; hadoopy._main.HadoopyTask(lambda k, v: [(v, k)], None, None, "map").run()'
+        p = subprocess.Popen([sys.executable, '-c', cmd], env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.assertEquals(p.communicate('a\tb\nc')[0], 'b\ta\n\tc\n')
+        # Selected with a warning when an extension is stale (lacks part of the API)
+        stale_dir = tempfile.mkdtemp()
+        try:
+            open(os.path.join(stale_dir, '_hadoopy_main.py'), 'w').close()
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join([stale_dir] + sys.path))
+            env.pop('hadoopy_pure_python', None)
+            cmd = 'import hadoopy; print hadoopy._main.__name__'
+            out, err = subprocess.Popen([sys.executable, '-c', cmd], env=env, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE).communicate()
+            self.assertEquals(out, 'hadoopy._main_py\n')
+            self.assertTrue('_hadoopy_main.HadoopyTask' in err)
+        finally:
+            shutil.rmtree(stale_dir)
+
+    def test_text_input(self):
+        lines = ['a\tb', '', 'c', 'd\te\tf', 'x' * 3000000 + '\t' + 'y' * 10, '\tg', 'h\t']
+        data = '\n'.join(lines)  # The final line has no newline
+
+        def run_map(env):
+            in_file, out_file = tempfile.NamedTemporaryFile(), tempfile.NamedTemporaryFile()
+            in_file.write(data)
+            in_file.flush()
+            os.environ.update(env)
+            try:
+                hadoopy._main.HadoopyTask(lambda k, v: [(k, v)], None, None, 'map', os.open(in_file.name, os.O_RDONLY),
+                                          os.open(out_file.name, os.O_WRONLY)).run()
+            finally:
+                for x in env:
+                    del os.environ[x]
+            return open(out_file.name).read()
+        offsets = [sum(len(y) + 1 for y in lines[:x]) for x in range(len(lines))]
+        expected = ''.join('%d\t%s\n' % x for x in zip(offsets, lines))
+        self.assertEquals(run_map({}), expected)
+        self.assertEquals(run_map({'hadoopy_background_io': '1'}), expected)
+        expected = ''.join('%s\t%s\n' % x.partition('\t')[::2] for x in lines)
+        self.assertEquals(run_map({'mapred_input_format_class': ''}), expected)
+
+    def test_text_output(self):
+        kvs = [('a', 'b'), (1, 2.5), ((1, 'c'), None), (u'\xe9', 'x' * 3000000)]
+        expected = 'a,b\r\n1,2.5\r\n(1, \'c\'),None\r\n\xc3\xa9,%s\r\n' % ('x' * 3000000)
+        # Small buffer (values are larger than it)
+        out_file = tempfile.NamedTemporaryFile()
+        fd = os.open(out_file.name, os.O_WRONLY)
+        writer = hadoopy._main._TextWriter(fd, ',', '\r\n', 10)
+        writer.writes(kvs)
+        writer.flush()
+        os.close(fd)
+        self.assertEquals(open(out_file.name).read(), expected)
+        # In a task, the field separator is the one Hadoop splits the output with
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, 'line\n')
+        os.close(write_fd)
+        env = {'stream_map_output_field_separator': ',', 'hadoopy_text_record_separator': '\r\n'}
+        os.environ.update(env)
+        try:
+            fd = os.open(out_file.name, os.O_WRONLY | os.O_TRUNC)
+            hadoopy._main.HadoopyTask(lambda k, v: kvs, None, None, 'map', read_fd, fd).run()
+        finally:
+            for x in env:
+                del os.environ[x]
+        self.assertEquals(open(out_file.name).read(), expected)
+        # The task's output is left open (as it is stdout), in either output mode
+        os.write(fd, 'end')
+        os.close(fd)
+        self.assertTrue(open(out_file.name).read().endswith('\r\nend'))
+        os.environ['stream_map_input'] = 'typedbytes'
+        try:
+            read_fd, write_fd = os.pipe()
+            os.write(write_fd, hadoopy.typedbytes.dumps_kvs(kvs[:2]))
+            os.close(write_fd)
+            fd = os.open(out_file.name, os.O_WRONLY | os.O_TRUNC)
+            hadoopy._main.HadoopyTask(lambda k, v: [(k, v)], None, None, 'map', read_fd, fd).run()
+        finally:
+            del os.environ['stream_map_input']
+        os.write(fd, 'end')
+        os.close(fd)
+        self.assertEquals(open(out_file.name).read(), hadoopy.typedbytes.dumps_kvs(kvs[:2]) + 'end')
+
+    def test_batches(self):
+        process_inout = hadoopy._main.HadoopyTask.process_inout
+        out, sizes = [], []
+
+        def mapper(keys, values):
+            sizes.append(len(keys))
+            return zip(values, keys)
+        self.assertEquals(process_inout(mapper, [(x, str(x)) for x in range(7)], out.extend, 'map', 3), 0)
+        self.assertEquals(sizes, [3, 3, 1])
+        self.assertEquals(out, [(str(x), x) for x in range(7)])
+        # Reducers get each group's values as a list
+        out = []
+        process_inout(lambda keys, values: [(len(keys), values)], [('a', iter([1, 2])), ('b', iter([3]))], out.extend,
+                      'reduce', 2)
+        self.assertEquals(out, [(2, [[1, 2], [3]])])
+        self.assertRaises(ValueError, hadoopy._main.HadoopyTask, None, None, None, 'map', batch_size=0)
+        try:
+            import numpy as np
+        except ImportError:
+            raise unittest.SkipTest('Needs numpy')
+        # Numpy arrays from a TypedBytes task
+        in_file, out_file = tempfile.NamedTemporaryFile(), tempfile.NamedTemporaryFile()
+        with hadoopy.TypedBytesFile(in_file.name, 'w') as fp:
+            fp.writes((x, x / 2.) for x in range(10))
+        sizes = []
+
+        def array_mapper(keys, values):
+            self.assertEquals((keys.dtype, values.dtype), (np.int64, np.float64))
+            sizes.append(len(keys))
+            return zip(keys.tolist(), (values * 2).tolist())
+        os.environ['stream_map_input'] = 'typedbytes'
+        try:
+            hadoopy._main.HadoopyTask(array_mapper, None, None, 'map', os.open(in_file.name, os.O_RDONLY),
+                                      os.open(out_file.name, os.O_WRONLY), batch_size=4,
+                                      batch_dtypes=(np.int64, np.float64)).run()
+        finally:
+            del os.environ['stream_map_input']
+        self.assertEquals(sizes, [4, 4, 2])
+        self.assertEquals(list(hadoopy.TypedBytesFile(out_file.name)), [(x, float(x)) for x in range(10)])
+
+    def test_combine_buffer(self):
+        words = ['a', 'bb', 'a', 'c', 'a', 'bb'] * 500
+
+        def mapper(k, v):
+            for word in v.split():
+                yield word, 1
+
+        def reducer(k, vs):
+            yield k, sum(vs)
+
+        def run(combine_buffer_size, **kw):
+            in_file, out_file = tempfile.NamedTemporaryFile(), tempfile.NamedTemporaryFile()
+            in_file.write('\n'.join(' '.join(words[x:x + 10]) for x in range(0, len(words), 10)))
+            in_file.flush()
+            hadoopy._main.HadoopyTask(mapper, kw.get('reducer'), kw.get('combiner'), 'map',
+                                      os.open(in_file.name, os.O_RDONLY), os.open(out_file.name, os.O_WRONLY),
+                                      combine_buffer_size=combine_buffer_size).run()
+            out = [x.split('\t') for x in open(out_file.name).read().splitlines()]
+            counts = {}
+            for k, v in out:
+                counts[k] = counts.get(k, 0) + int(v)
+            self.assertEquals(counts, {'a': 1500, 'bb': 1000, 'c': 500})
+            return len(out)
+        # Everything fits, then flushes under pressure
+        self.assertEquals(run(1000000, combiner=reducer), 3)
+        self.assertTrue(3 < run(10000, combiner=reducer) < 100)
+        reducer.associative = True
+        self.assertEquals(run(1000000, reducer=reducer), 3)
+        del reducer.associative
+        self.assertRaises(ValueError, run, 1000000, reducer=reducer)
+        self.assertEquals(run(None), len(words))
+
+    def test_iter_groups(self):
+        kvs = [('a', 1), ('a', 2), ('b', 3), (1, 4), (1.0, 5), (('t',), 6), (('t',), 7), ('a', 8)]
+        expected = [('a', [1, 2]), ('b', [3]), (1, [4]), (1.0, [5]), (('t',), [6, 7]), ('a', [8])]
+        fn = tempfile.mktemp()
+        try:
+            with hadoopy.TypedBytesFile(fn, 'w') as fp:
+                fp.writes(kvs)
+            # Keys are compared by encoding, 1 and 1.0 are different groups
+            with hadoopy.TypedBytesFile(fn, 'r') as fp:
+                out = [(k, list(vs)) for k, vs in fp.iter_groups()]
+            self.assertEquals(out, expected)
+            self.assertEquals([type(k) for k, vs in out], [type(k) for k, vs in expected])
+            # Unread values are skipped, old groups are exhausted
+            with hadoopy.TypedBytesFile(fn, 'r') as fp:
+                groups = fp.iter_groups(raw_values=True)
+                k, vs = groups.next()
+                self.assertEquals((k, vs.next().value), ('a', 1))
+                self.assertEquals(groups.next()[0], 'b')
+                self.assertEquals(list(vs), [])
+                self.assertEquals([(k, [v.value for v in vs]) for k, vs in groups], expected[2:])
+            # Reducer input with ordered keys
+            with hadoopy.TypedBytesFile(fn, 'w', write_ordered_keys=True) as fp:
+                fp.writes(sorted(kvs[:-1]))
+            out_file = tempfile.NamedTemporaryFile()
+            os.environ['stream_map_input'] = 'typedbytes'
+            try:
+                hadoopy._main.HadoopyTask(None, lambda k, vs: [(k, sum(vs))], None, 'reduce', os.open(fn, os.O_RDONLY),
+                                          os.open(out_file.name, os.O_WRONLY), ordered_keys=True).run()
+            finally:
+                del os.environ['stream_map_input']
+            self.assertEquals(list(hadoopy.TypedBytesFile(out_file.name)), [(1, 4), (1.0, 5), ('a', 3), ('b', 3), (('t',), 13)])
+        finally:
+            os.remove(fn)
+
     @unittest.skipIf(not has_endian(), 'Needs endian.h which is in a newer glibc')
     def test_fail(self):
         subprocess.check_call('gcc -o endian_test endian_test.c -Wall -D FAIL_TEST'.split())